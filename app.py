@@ -1,16 +1,27 @@
 # Archivo principal de la aplicación Flask para el GMAO
 # =============================================================================
 
-from flask import Flask, render_template, redirect, url_for, request, jsonify, flash
+from flask import (Flask, render_template, redirect, url_for, request, jsonify, flash,
+                   Response, stream_with_context)
 from sqlalchemy.orm import joinedload
-from sqlalchemy import or_, and_, func, case
+from sqlalchemy import or_, and_, func, case, type_coerce
 from models import (db, Empresa, Planta, Zona, Linea, Maquina, Elemento, 
                     Activo, Intervencion, Recambio, RecambioEquipo, MovimientoStock,
                     OrdenTrabajo, ConsumoRecambio, PlanPreventivo, TareaPreventivo,
                     GamaMantenimiento, TareaGama, RecambioGama, AsignacionGama,
                     RegistroTiempo, TipoIntervencion, Tecnico,
                     ChecklistItem, RespuestaChecklist,
-                    ConfiguracionGeneral, Usuario)
+                    ConfiguracionGeneral, Usuario, RutaActivo, CosteExterno, Festivo)
+from jerarquia import (obtenerRuta, obtenerRutas, asegurarRutas, asegurarAncestrosOrdenes,
+                       obtenerSnapshot, buscarEquipos, filtroOrdenesSubarbol, NIVELES,
+                       MODELOS, HIJOS)
+from versiones import (condicional, VERSION_JERARQUIA, VERSION_TECNICOS,
+                       VERSION_TIPOS_INTERVENCION, VERSION_GAMAS)
+from migraciones import aplicarMigraciones
+from busqueda import buscarOrdenes
+from eventos import flujoEventos, reservarFlujo, liberarFlujo, RECONEXION_MS
+import costes  # registra el mantenimiento del resumen de costes y del agregado mensual por OT
+from calendario import TURNOS
 from datetime import datetime, date, timedelta
 from flask_jwt_extended import (
     JWTManager, create_access_token, set_access_cookies,
@@ -19,6 +30,7 @@ from flask_jwt_extended import (
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 
+import base64
 import json
 import re
 import os
@@ -75,6 +87,8 @@ def getEquipoNombre(tipo, id):
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///gmao.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Caché compartida de resultados de KPIs y dashboards (ver cache_kpis.py)
+app.config['CACHE_KPIS'] = os.environ.get('CACHE_KPIS', 'true').lower() == 'true'
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'gmao-secret-key-2024')
 
 db.init_app(app)
@@ -201,7 +215,9 @@ def formato_espanol_filter(value, max_decimals=2):
 @app.before_request
 def createTables():
     if not hasattr(app, 'dbInitialized'):
-        db.create_all()
+        aplicarMigraciones()
+        asegurarRutas()
+        asegurarAncestrosOrdenes()
         # Create default admin user if none exists
         if not Usuario.query.first():
             admin_user = Usuario(
@@ -224,195 +240,46 @@ def createTables():
 
 @app.after_request
 def add_header(response):
+    # Respuestas con política propia (GET condicional, estáticos) la conservan
+    if 'Cache-Control' in response.headers:
+        return response
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '-1'
     return response
 
 # Helper function para obtener nombre de equipo por tipo/id
-def getEquipoNombre(equipoTipo, equipoId):
+def getEquipoNombre(equipoTipo, equipoId, ruta=None):
     """Obtiene el nombre del equipo según su tipo e ID"""
-    modelos = {
-        'empresa': Empresa,
-        'planta': Planta,
-        'zona': Zona,
-        'linea': Linea,
-        'maquina': Maquina,
-        'elemento': Elemento
-    }
-    if equipoTipo in modelos and equipoId:
-        entidad = modelos[equipoTipo].query.get(equipoId)
-        if entidad:
-            return entidad.nombre
-    return ''
+    ruta = ruta or obtenerRuta(equipoTipo, equipoId)
+    return ruta.nombre if ruta else ''
 
-def getEquipoInfo(equipoTipo, equipoId):
+def getEquipoInfo(equipoTipo, equipoId, ruta=None):
     """Obtiene el nombre y código del equipo según su tipo e ID"""
-    modelos = {
-        'empresa': Empresa,
-        'planta': Planta,
-        'zona': Zona,
-        'linea': Linea,
-        'maquina': Maquina,
-        'elemento': Elemento
-    }
-    if equipoTipo in modelos and equipoId:
-        entidad = modelos[equipoTipo].query.get(equipoId)
-        if entidad:
-            return {
-                'nombre': entidad.nombre,
-                'codigo': entidad.codigo
-            }
+    ruta = ruta or obtenerRuta(equipoTipo, equipoId)
+    if ruta:
+        return {
+            'nombre': ruta.nombre,
+            'codigo': ruta.codigo
+        }
     return {'nombre': '', 'codigo': ''}
 
-def getEquipoRutaCompleta(equipoTipo, equipoId):
+def getEquipoRutaCompleta(equipoTipo, equipoId, ruta=None):
     """Construye la ruta jerárquica completa del equipo (Empresa > Planta > Zona > Línea > Máquina > Elemento)"""
     if not equipoTipo or not equipoId:
         return ''
-    
-    ruta = []
-    
-    if equipoTipo == 'elemento':
-        elemento = Elemento.query.get(equipoId)
-        if elemento:
-            ruta.append(f"{elemento.codigo}")
-            maquina = Maquina.query.get(elemento.maquinaId)
-            if maquina:
-                ruta.insert(0, f"{maquina.codigo}")
-                linea = Linea.query.get(maquina.lineaId)
-                if linea:
-                    ruta.insert(0, f"{linea.codigo}")
-                    zona = Zona.query.get(linea.zonaId)
-                    if zona:
-                        ruta.insert(0, f"{zona.codigo}")
-                        planta = Planta.query.get(zona.plantaId)
-                        if planta:
-                            ruta.insert(0, f"{planta.codigo}")
-                            empresa = Empresa.query.get(planta.empresaId)
-                            if empresa:
-                                ruta.insert(0, f"{empresa.codigo}")
-    
-    elif equipoTipo == 'maquina':
-        maquina = Maquina.query.get(equipoId)
-        if maquina:
-            ruta.append(f"{maquina.codigo}")
-            linea = Linea.query.get(maquina.lineaId)
-            if linea:
-                ruta.insert(0, f"{linea.codigo}")
-                zona = Zona.query.get(linea.zonaId)
-                if zona:
-                    ruta.insert(0, f"{zona.codigo}")
-                    planta = Planta.query.get(zona.plantaId)
-                    if planta:
-                        ruta.insert(0, f"{planta.codigo}")
-                        empresa = Empresa.query.get(planta.empresaId)
-                        if empresa:
-                            ruta.insert(0, f"{empresa.codigo}")
-    
-    elif equipoTipo == 'linea':
-        linea = Linea.query.get(equipoId)
-        if linea:
-            ruta.append(f"{linea.codigo}")
-            zona = Zona.query.get(linea.zonaId)
-            if zona:
-                ruta.insert(0, f"{zona.codigo}")
-                planta = Planta.query.get(zona.plantaId)
-                if planta:
-                    ruta.insert(0, f"{planta.codigo}")
-                    empresa = Empresa.query.get(planta.empresaId)
-                    if empresa:
-                        ruta.insert(0, f"{empresa.codigo}")
-    
-    elif equipoTipo == 'zona':
-        zona = Zona.query.get(equipoId)
-        if zona:
-            ruta.append(f"{zona.codigo}")
-            planta = Planta.query.get(zona.plantaId)
-            if planta:
-                ruta.insert(0, f"{planta.codigo}")
-                empresa = Empresa.query.get(planta.empresaId)
-                if empresa:
-                    ruta.insert(0, f"{empresa.codigo}")
-    
-    elif equipoTipo == 'planta':
-        planta = Planta.query.get(equipoId)
-        if planta:
-            ruta.append(f"{planta.codigo}")
-            empresa = Empresa.query.get(planta.empresaId)
-            if empresa:
-                ruta.insert(0, f"{empresa.codigo}")
-    
-    elif equipoTipo == 'empresa':
-        empresa = Empresa.query.get(equipoId)
-        if empresa:
-            ruta.append(f"{empresa.codigo}")
-    
-    return ' > '.join(ruta) if ruta else ''
-
-
-def getEquipoRutaNombres(equipoTipo, equipoId):
+    ruta = ruta or obtenerRuta(equipoTipo, equipoId)
+    return ruta.rutaCodigos if ruta else ''
+
+
+def getEquipoRutaNombres(equipoTipo, equipoId, ruta=None):
     """Construye la ruta jerárquica como lista de {nombre, tipo} desde Planta hasta el equipo."""
     if not equipoTipo or not equipoId:
         return []
-
-    ruta = []
-
-    if equipoTipo == 'elemento':
-        elem = Elemento.query.get(equipoId)
-        if elem:
-            ruta.append({'nombre': elem.nombre, 'tipo': 'elemento'})
-            maq = Maquina.query.get(elem.maquinaId)
-            if maq:
-                ruta.insert(0, {'nombre': maq.nombre, 'tipo': 'maquina'})
-                linea = Linea.query.get(maq.lineaId)
-                if linea:
-                    ruta.insert(0, {'nombre': linea.nombre, 'tipo': 'linea'})
-                    zona = Zona.query.get(linea.zonaId)
-                    if zona:
-                        ruta.insert(0, {'nombre': zona.nombre, 'tipo': 'zona'})
-                        planta = Planta.query.get(zona.plantaId)
-                        if planta:
-                            ruta.insert(0, {'nombre': planta.nombre, 'tipo': 'planta'})
-
-    elif equipoTipo == 'maquina':
-        maq = Maquina.query.get(equipoId)
-        if maq:
-            ruta.append({'nombre': maq.nombre, 'tipo': 'maquina'})
-            linea = Linea.query.get(maq.lineaId)
-            if linea:
-                ruta.insert(0, {'nombre': linea.nombre, 'tipo': 'linea'})
-                zona = Zona.query.get(linea.zonaId)
-                if zona:
-                    ruta.insert(0, {'nombre': zona.nombre, 'tipo': 'zona'})
-                    planta = Planta.query.get(zona.plantaId)
-                    if planta:
-                        ruta.insert(0, {'nombre': planta.nombre, 'tipo': 'planta'})
-
-    elif equipoTipo == 'linea':
-        linea = Linea.query.get(equipoId)
-        if linea:
-            ruta.append({'nombre': linea.nombre, 'tipo': 'linea'})
-            zona = Zona.query.get(linea.zonaId)
-            if zona:
-                ruta.insert(0, {'nombre': zona.nombre, 'tipo': 'zona'})
-                planta = Planta.query.get(zona.plantaId)
-                if planta:
-                    ruta.insert(0, {'nombre': planta.nombre, 'tipo': 'planta'})
-
-    elif equipoTipo == 'zona':
-        zona = Zona.query.get(equipoId)
-        if zona:
-            ruta.append({'nombre': zona.nombre, 'tipo': 'zona'})
-            planta = Planta.query.get(zona.plantaId)
-            if planta:
-                ruta.insert(0, {'nombre': planta.nombre, 'tipo': 'planta'})
-
-    elif equipoTipo == 'planta':
-        planta = Planta.query.get(equipoId)
-        if planta:
-            ruta.append({'nombre': planta.nombre, 'tipo': 'planta'})
-
-    return ruta
+    ruta = ruta or obtenerRuta(equipoTipo, equipoId)
+    if not ruta:
+        return []
+    return [{'nombre': n['nombre'], 'tipo': n['tipo']} for n in ruta.rutaNombresLista]
 
 # =============================================================================
 
@@ -501,6 +368,7 @@ def verActivos():
     return render_template('assets.html')
 
 @app.route('/getActivosTree')
+@condicional(VERSION_JERARQUIA)
 def getActivosTree():
     tree = []
     empresas = Empresa.query.options(
@@ -575,12 +443,100 @@ def getActivosTree():
         tree.append(empresaNode)
     return jsonify(tree)
 
+LIMITE_HIJOS_ARBOL = 200
+
+def _nodoArbol(tipo, entidad, numHijos):
+    """Nodo jsTree para carga diferida: children=True si tiene hijos por cargar"""
+    texto = entidad.nombre
+    if tipo == 'maquina':
+        estadoIcon = '🟢' if entidad.estado == 'operativo' else ('🔴' if entidad.estado == 'averiado' else '🟡')
+        texto = f'{estadoIcon} {entidad.nombre}'
+    return {
+        'id': f'{tipo}-{entidad.id}',
+        'text': texto,
+        'icon': f'{tipo}-icon',
+        'a_attr': {'class': f'{tipo}-icon'},
+        'children': numHijos > 0,
+        'data': {'numHijos': numHijos}
+    }
+
+@app.route('/api/activos-arbol/hijos')
+@condicional(VERSION_JERARQUIA)
+def apiActivosArbolHijos():
+    """Hijos directos de un nodo del árbol de activos, paginados.
+
+    Parámetros: id ('#' para la raíz o '<tipo>-<id>'), offset y limite.
+    Cada nodo incluye el número de hijos propios, calculado con una única
+    consulta agrupada sobre la FK del nivel siguiente.
+    """
+    nodoId = request.args.get('id', '#')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limite = min(max(request.args.get('limite', LIMITE_HIJOS_ARBOL, type=int), 1), 1000)
+
+    if nodoId == '#':
+        tipoHijo = 'empresa'
+        query = Empresa.query
+    else:
+        tipoPadre, _, padreId = nodoId.partition('-')
+        if tipoPadre not in HIJOS or not padreId.isdigit():
+            return jsonify({'error': 'Nodo no válido'}), 400
+        tipoHijo, fkPadre = HIJOS[tipoPadre]
+        modelo = MODELOS[tipoHijo]
+        query = modelo.query.filter(getattr(modelo, fkPadre) == int(padreId))
+
+    modelo = MODELOS[tipoHijo]
+    total = query.count()
+    entidades = query.order_by(modelo.id).offset(offset).limit(limite).all()
+
+    numHijos = {}
+    if entidades and tipoHijo in HIJOS:
+        tipoNieto, fkNieto = HIJOS[tipoHijo]
+        columnaFk = getattr(MODELOS[tipoNieto], fkNieto)
+        numHijos = dict(
+            db.session.query(columnaFk, func.count())
+            .filter(columnaFk.in_([e.id for e in entidades]))
+            .group_by(columnaFk)
+            .all()
+        )
+
+    return jsonify({
+        'nodos': [_nodoArbol(tipoHijo, e, numHijos.get(e.id, 0)) for e in entidades],
+        'total': total,
+        'offset': offset,
+        'limite': limite
+    })
+
+@app.route('/api/activos-arbol/buscar')
+def apiActivosArbolBuscar():
+    """Ids de los nodos a expandir para mostrar las coincidencias de una búsqueda.
+
+    Devuelve, de arriba abajo, los ancestros de cada activo cuyo código o
+    nombre contiene el texto, para que jsTree los cargue antes de marcar.
+    """
+    texto = request.args.get('str', '').strip()
+    if len(texto) < 2:
+        return jsonify([])
+    patron = f'%{texto}%'
+    rutas = RutaActivo.query.filter(
+        or_(RutaActivo.codigo.ilike(patron), RutaActivo.nombre.ilike(patron))
+    ).limit(200).all()
+
+    # Ancestros por nivel (sin el propio nodo), de arriba abajo
+    ids = {}
+    for tipo in ('empresa', 'planta', 'zona', 'linea', 'maquina'):
+        for ruta in rutas:
+            ancestroId = getattr(ruta, f'{tipo}Id')
+            if ancestroId and ruta.tipo != tipo:
+                ids[f'{tipo}-{ancestroId}'] = None
+    return jsonify(list(ids))
+
 
 # =============================================================================
 # API: Lista de equipos para selectores (todos los niveles)
 # =============================================================================
 
 @app.route('/api/equipos-lista')
+@condicional(VERSION_JERARQUIA)
 def getEquiposLista():
     """Devuelve lista de todos los niveles de la jerarquía para selectores"""
     equipos = []
@@ -669,6 +625,41 @@ def getEquiposLista():
     return jsonify(equipos)
 
 
+_ICONOS_NIVEL = {'empresa': '🏢', 'planta': '🏭', 'zona': '📍', 'linea': '⚡', 'elemento': '🔧'}
+
+@app.route('/api/equipos/buscar')
+def apiEquiposBuscar():
+    """Búsqueda de equipos para selectores con autocompletado (top N por relevancia)"""
+    q = request.args.get('q', '').strip()
+    tipo = request.args.get('tipo') or None
+    limite = min(max(request.args.get('limite', 20, type=int), 1), 50)
+    if not q:
+        return jsonify([])
+
+    jer = obtenerSnapshot()
+    resultados = []
+    for r in buscarEquipos(q, limite, tipo):
+        empresa = jer.get('empresa', r.empresaId)
+        nombres = ([empresa.nombre] if empresa and r.tipo != 'empresa' else []) + \
+            [n['nombre'] for n in r.rutaNombresLista]
+        item = {
+            'id': r.equipoId,
+            'tipo': r.tipo,
+            'nombre': r.nombre,
+            'codigo': r.codigo,
+            'ruta': ' > '.join(nombres) or r.nombre,
+            'nivel': NIVELES.index(r.tipo),
+            'icono': _ICONOS_NIVEL.get(r.tipo, '')
+        }
+        if r.tipo == 'maquina':
+            maquina = jer.get('maquina', r.equipoId)
+            estado = maquina.estado if maquina else None
+            item['icono'] = '🟢' if estado == 'operativo' else ('🔴' if estado == 'averiado' else '🟡')
+            item['estado'] = estado
+            item['criticidad'] = maquina.criticidad if maquina else None
+        resultados.append(item)
+    return jsonify(resultados)
+
 # Mantener endpoint antiguo para compatibilidad
 @app.route('/api/maquinas-lista')
 def getMaquinasLista():
@@ -869,16 +860,29 @@ def eliminarZona(id):
 @app.route('/api/lineas/<int:zonaId>')
 def apiLineas(zonaId):
     lineas = Linea.query.filter_by(zonaId=zonaId).all()
-    return jsonify([{'id': l.id, 'codigo': l.codigo, 'nombre': l.nombre} for l in lineas])
+    return jsonify([{'id': l.id, 'codigo': l.codigo, 'nombre': l.nombre, 'turno': l.turno} for l in lineas])
+
+def _turnoLinea(valor):
+    """Turno propio de una línea: clave de TURNOS o vacío (turno de la planta)"""
+    if not valor:
+        return None
+    if valor not in TURNOS:
+        raise ValueError('Turno no válido')
+    return valor
 
 @app.route('/api/linea', methods=['POST'])
 def crearLinea():
     data = request.get_json()
+    try:
+        turno = _turnoLinea(data.get('turno'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     linea = Linea(
         zonaId=data['zonaId'],
         codigo=data['codigo'],
         nombre=data['nombre'],
-        descripcion=data.get('descripcion', '')
+        descripcion=data.get('descripcion', ''),
+        turno=turno
     )
     db.session.add(linea)
     db.session.commit()
@@ -891,6 +895,11 @@ def actualizarLinea(id):
     linea.codigo = data.get('codigo', linea.codigo)
     linea.nombre = data.get('nombre', linea.nombre)
     linea.descripcion = data.get('descripcion', linea.descripcion)
+    if 'turno' in data:
+        try:
+            linea.turno = _turnoLinea(data['turno'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
     db.session.commit()
     return jsonify({'mensaje': 'Línea actualizada correctamente'})
 
@@ -1199,17 +1208,49 @@ def obtenerMovimientos(id):
 def verOrdenes():
     return render_template('ordenes.html')
 
-@app.route('/api/ordenes')
-def apiOrdenes():
-    estado = request.args.get('estado', '')
-    tipo = request.args.get('tipo', '')
-    maquinaId = request.args.get('maquinaId', '')
-    equipoTipo = request.args.get('equipoTipo', '')
-    equipoId = request.args.get('equipoId', '')
-    incluirCerradas = request.args.get('incluirCerradas', 'false') == 'true'
-    
+# Rango de prioridad para ordenar (urgente > alta > media > baja)
+_RANGO_PRIORIDAD = case(
+    (OrdenTrabajo.prioridad == 'urgente', 1),
+    (OrdenTrabajo.prioridad == 'alta', 2),
+    (OrdenTrabajo.prioridad == 'media', 3),
+    (OrdenTrabajo.prioridad == 'baja', 4),
+    else_=5
+)
+# Orden del tipo de intervención; los tipos sin configurar van primero
+_ORDEN_TIPO = func.coalesce(TipoIntervencion.orden, -1)
+
+LIMITE_ORDENES = 50
+
+def _parseFechaFiltro(valor):
+    """Convierte 'YYYY-MM-DD' en datetime; None si no es válida"""
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def _consultaOrdenes(args):
+    """Aplica a OrdenTrabajo los filtros del listado (compartidos con el conteo)"""
+    estado = args.get('estado', '')
+    tipo = args.get('tipo', '')
+    prioridad = args.get('prioridad', '')
+    maquinaId = args.get('maquinaId', '')
+    equipoTipo = args.get('equipoTipo', '')
+    equipoId = args.get('equipoId', '')
+    incluirCerradas = args.get('incluirCerradas', 'false') == 'true'
+    texto = args.get('q', '').strip()
+    tecnico = args.get('tecnico', '').strip()
+    nivel = args.get('nivel', '')
+    nivelId = args.get('nivelId', type=int)
+    desde = _parseFechaFiltro(args.get('desde'))
+    hasta = _parseFechaFiltro(args.get('hasta'))
+    ordenId = args.get('id', type=int)
+
     query = OrdenTrabajo.query
 
+    # Una sola OT, si cumple el resto de filtros (cambios en vivo del listado)
+    if ordenId:
+        query = query.filter(OrdenTrabajo.id == ordenId)
+
     # Excluir cerradas por defecto
     if not incluirCerradas and not estado:
         query = query.filter(OrdenTrabajo.estado != 'cerrada')
@@ -1221,38 +1262,109 @@ def apiOrdenes():
     else:
         # Las órdenes preventivas se gestionan en la página de Preventivo
         query = query.filter(OrdenTrabajo.tipo != 'preventivo')
-    
+    if prioridad:
+        query = query.filter_by(prioridad=prioridad)
+
     # Filtrar por equipo (nuevo formato)
     if equipoTipo and equipoId:
         query = query.filter_by(equipoTipo=equipoTipo, equipoId=int(equipoId))
     elif maquinaId:
         # Compatibilidad con formato antiguo
         query = query.filter_by(maquinaId=maquinaId)
-    
-    # Join con TipoIntervencion para ordenar por el campo orden configurado
-    query = query.outerjoin(TipoIntervencion, OrdenTrabajo.tipo == TipoIntervencion.codigo)
-
-    # Ordenar por TipoIntervencion.orden y luego por prioridad (urgente > alta > media > baja)
-    ordenes = query.order_by(
-        TipoIntervencion.orden,
-        case(
-            (OrdenTrabajo.prioridad == 'urgente', 1),
-            (OrdenTrabajo.prioridad == 'alta', 2),
-            (OrdenTrabajo.prioridad == 'media', 3),
-            (OrdenTrabajo.prioridad == 'baja', 4),
-            else_=5
-        )
-    ).all()
 
-    
+    # Alcance jerárquico: todo lo que cuelga del nodo
+    if nivel and nivelId:
+        query = query.filter(filtroOrdenesSubarbol(nivel, nivelId))
+
+    # Se compara el texto guardado: hay fechas importadas sin hora ('YYYY-MM-DD')
+    fechaTexto = type_coerce(OrdenTrabajo.fechaCreacion, db.String)
+    if desde:
+        query = query.filter(fechaTexto >= desde.strftime('%Y-%m-%d'))
+    if hasta:
+        query = query.filter(fechaTexto < (hasta + timedelta(days=1)).strftime('%Y-%m-%d'))
+    if tecnico:
+        query = query.filter(OrdenTrabajo.tecnicoAsignado.ilike(f'%{tecnico}%'))
+    if texto:
+        patron = f'%{texto}%'
+        query = query.filter(or_(
+            OrdenTrabajo.numero.ilike(patron),
+            OrdenTrabajo.titulo.ilike(patron),
+            OrdenTrabajo.descripcionProblema.ilike(patron)
+        ))
+    return query
+
+def _codificarCursor(valores):
+    return base64.urlsafe_b64encode(json.dumps(valores).encode()).decode()
+
+def _decodificarCursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+
+def _paginarOrdenes(query, orden, cursor=None, limite=None):
+    """
+    Paginación por cursor (keyset) sobre una clave de orden total:
+      - 'prioridad': orden del tipo de intervención, prioridad y más reciente primero (id)
+      - 'reciente':  fechaCreacion y id descendentes (índice ix_ot_creacion)
+    Sin límite devuelve todas. Devuelve (ordenes, cursor siguiente o None).
+    """
+    if orden == 'reciente':
+        # Se compara el valor tal como está guardado (hay fechas importadas sin
+        # hora), para que el cursor use el mismo orden que el ORDER BY
+        fecha = type_coerce(OrdenTrabajo.fechaCreacion, db.String)
+        query = query.order_by(fecha.desc(), OrdenTrabajo.id.desc())
+        if cursor:
+            f, i = cursor
+            if f is None:
+                # Las OTs sin fecha van al final
+                query = query.filter(fecha.is_(None), OrdenTrabajo.id < i)
+            else:
+                query = query.filter(or_(fecha < f, and_(fecha == f, OrdenTrabajo.id < i),
+                                         fecha.is_(None)))
+        query = query.add_columns(fecha)
+    else:
+        query = query.outerjoin(TipoIntervencion, OrdenTrabajo.tipo == TipoIntervencion.codigo)
+        query = query.order_by(_ORDEN_TIPO, _RANGO_PRIORIDAD, OrdenTrabajo.id.desc())
+        if cursor:
+            t, p, i = cursor
+            query = query.filter(or_(
+                _ORDEN_TIPO > t,
+                and_(_ORDEN_TIPO == t, _RANGO_PRIORIDAD > p),
+                and_(_ORDEN_TIPO == t, _RANGO_PRIORIDAD == p, OrdenTrabajo.id < i)
+            ))
+        query = query.add_columns(_ORDEN_TIPO, _RANGO_PRIORIDAD)
+
+    query = query.options(joinedload(OrdenTrabajo.maquina))
+    filas = query.limit(limite + 1).all() if limite else query.all()
+    haySiguiente = bool(limite) and len(filas) > limite
+    filas = filas[:limite] if limite else filas
+
+    ordenes = [f[0] for f in filas]
+    if not filas:
+        clave = None
+    elif orden == 'reciente':
+        clave = [filas[-1][1], filas[-1][0].id]
+    else:
+        clave = [filas[-1][1], filas[-1][2], filas[-1][0].id]
+    return ordenes, (_codificarCursor(clave) if haySiguiente else None)
+
+def _serializarOrdenesLista(ordenes):
+    """Filas del listado de OTs, con las rutas de todos los equipos en una consulta"""
+    rutas = obtenerRutas(
+        (o.equipoTipo or ('maquina' if o.maquinaId else None), o.equipoId or o.maquinaId)
+        for o in ordenes
+    )
+
     result = []
     for o in ordenes:
         # Para compatibilidad con órdenes antiguas sin equipoTipo/equipoId
         equipoTipo = o.equipoTipo if o.equipoTipo else ('maquina' if o.maquinaId else None)
         equipoId = o.equipoId if o.equipoId else o.maquinaId
-        equipoInfo = getEquipoInfo(equipoTipo, equipoId) if equipoTipo and equipoId else {'nombre': '', 'codigo': ''}
-        equipoRuta = getEquipoRutaCompleta(equipoTipo, equipoId) if equipoTipo and equipoId else ''
-        equipoRutaItems = getEquipoRutaNombres(equipoTipo, equipoId) if equipoTipo and equipoId else []
+        ruta = rutas.get((equipoTipo, equipoId))
+        equipoInfo = getEquipoInfo(equipoTipo, equipoId, ruta) if ruta else {'nombre': '', 'codigo': ''}
+        equipoRuta = getEquipoRutaCompleta(equipoTipo, equipoId, ruta) if ruta else ''
+        equipoRutaItems = getEquipoRutaNombres(equipoTipo, equipoId, ruta) if ruta else []
 
         result.append({
             'id': o.id,
@@ -1276,11 +1388,100 @@ def apiOrdenes():
             'tecnicoAsignado': o.tecnicoAsignado,
             'tiempoEstimado': o.tiempoEstimado
         })
-    
-    return jsonify(result)
+    return result
 
+@app.route('/api/ordenes')
+def apiOrdenes():
+    """Listado de OTs filtrado en servidor.
+
+    Sin 'limite' devuelve el array completo (compatibilidad). Con 'limite'
+    devuelve una página {items, siguiente}; 'siguiente' es el cursor a pasar
+    en 'cursor' para la página siguiente (None al llegar al final).
+    Filtros: estado, tipo, prioridad, equipoTipo/equipoId, nivel/nivelId,
+    desde/hasta (fecha de creación), tecnico, q (número, título, problema),
+    id (una OT concreta, solo si cumple los demás filtros).
+    """
+    query = _consultaOrdenes(request.args)
+
+    if 'limite' not in request.args:
+        ordenes, _ = _paginarOrdenes(query, 'prioridad')
+        return jsonify(_serializarOrdenesLista(ordenes))
+
+    limite = min(max(request.args.get('limite', LIMITE_ORDENES, type=int), 1), 500)
+    orden = request.args.get('orden', 'prioridad')
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = _decodificarCursor(request.args['cursor'])
+        if not isinstance(cursor, list) or len(cursor) != (2 if orden == 'reciente' else 3):
+            return jsonify({'error': 'Cursor no válido'}), 400
+
+    ordenes, siguiente = _paginarOrdenes(query, orden, cursor, limite)
+    return jsonify({'items': _serializarOrdenesLista(ordenes), 'siguiente': siguiente})
+
+@app.route('/api/ordenes/conteo')
+def apiOrdenesConteo():
+    """Totales del listado de OTs con los mismos filtros, desglosados por estado"""
+    query = _consultaOrdenes(request.args)
+    porEstado = dict(
+        query.with_entities(OrdenTrabajo.estado, func.count(OrdenTrabajo.id))
+        .group_by(OrdenTrabajo.estado).all()
+    )
+    return jsonify({'total': sum(porEstado.values()), 'porEstado': porEstado})
 
 
+@app.route('/api/ordenes/buscar')
+def apiOrdenesBuscar():
+    """
+    Búsqueda de texto completo en el histórico de OTs (título, problema,
+    solución y observaciones), por relevancia y con los términos resaltados.
+    Paginada como el listado: {items, siguiente} con cursor opaco.
+    """
+    texto = request.args.get('q', '').strip()
+    limite = min(max(request.args.get('limite', LIMITE_ORDENES, type=int), 1), 500)
+    desplazamiento = 0
+    if request.args.get('cursor'):
+        desplazamiento = _decodificarCursor(request.args['cursor'])
+        if not isinstance(desplazamiento, int) or desplazamiento < 0:
+            return jsonify({'error': 'Cursor no válido'}), 400
+
+    # Se pide una fila de más para saber si hay página siguiente
+    encontradas = buscarOrdenes(texto, limite + 1, desplazamiento,
+                                tipo=request.args.get('tipo') or None,
+                                estado=request.args.get('estado') or None)
+    pagina = encontradas[:limite]
+    items = _serializarOrdenesLista([o for o, _, _ in pagina])
+    for item, (_, tituloHtml, fragmentoHtml) in zip(items, pagina):
+        item['tituloResaltado'] = tituloHtml
+        item['fragmento'] = fragmentoHtml
+    siguiente = _codificarCursor(desplazamiento + limite) if len(encontradas) > limite else None
+    return jsonify({'items': items, 'siguiente': siguiente})
+
+
+@app.route('/api/ordenes/eventos')
+@jwt_required()
+def apiOrdenesEventos():
+    """
+    Flujo Server-Sent Events con los cambios de OTs (alta, estado, asignación,
+    inicio/pausa de trabajo, baja) para que los listados se actualicen sin
+    recargar. Al reconectar, el navegador envía Last-Event-ID y se reenvían los
+    eventos perdidos; sin él solo se envían los nuevos. Con MAX_FLUJOS
+    conexiones abiertas en el proceso responde 503 y el cliente reintenta
+    pasado Retry-After con ?desde=<último id>.
+    """
+    if not reservarFlujo():
+        respuesta = jsonify({'error': 'Demasiadas conexiones de eventos, reintente más tarde'})
+        respuesta.status_code = 503
+        respuesta.headers['Retry-After'] = str(RECONEXION_MS // 1000)
+        return respuesta
+    ultimo = request.headers.get('Last-Event-ID') or request.args.get('desde')
+    ultimo = int(ultimo) if ultimo and ultimo.isdigit() else None
+    respuesta = Response(stream_with_context(flujoEventos(ultimo)), mimetype='text/event-stream')
+    # Se libera al cerrar la respuesta, aunque el flujo no llegue a recorrerse
+    respuesta.call_on_close(liberarFlujo)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    respuesta.headers['X-Accel-Buffering'] = 'no'  # sin buffer en proxies (nginx, Render)
+    return respuesta
+
 @app.route('/api/orden/<int:id>')
 def obtenerOrden(id):
     o = OrdenTrabajo.query.get_or_404(id)
@@ -1320,9 +1521,7 @@ def obtenerOrden(id):
         'tiempoReal': o.tiempoReal,
         'tiempoParada': o.tiempoParada,
         'costeTallerExterno': o.costeTallerExterno,
-        'proveedorExterno': o.proveedorExterno,
-        'descripcionTallerExterno': o.descripcionTallerExterno,
-        'costesExternosJson': o.costesExternosJson,
+        'costesExternos': _serializarCostesExternos(o),
         # Campos preventivo autocontenido
         'gamaId': o.gamaId,
         'gamaNombre': o.gama.nombre if o.gama else None,
@@ -1493,15 +1692,25 @@ def actualizarOrden(id):
     db.session.commit()
     return jsonify({'mensaje': 'Orden actualizada correctamente'})
 
-@app.route('/api/orden/<int:id>/estado', methods=['PUT'])
-def cambiarEstadoOrden(id):
-    orden = OrdenTrabajo.query.get_or_404(id)
-    data = request.get_json()
-    nuevoEstado = data['estado']
-    nueva_ot_numero = None
-    nueva_ot_id = None
-    ots_correctivas = []
-    
+# Estados que cierran el trabajo de la OT (y sus registros de tiempo activos)
+ESTADOS_CIERRE = ('cerrado_parcial', 'cerrada')
+
+
+def _aplicarEstadoOrden(orden, nuevoEstado, cerradoPor, registrosActivos, maquinas, pendientes):
+    """
+    Aplica a una OT el cambio de estado con sus efectos: fechas, cierre de los
+    registros de tiempo activos (ya cargados), máquina de vuelta a operativo y
+    siguiente preventiva / correctivos de checklist. El cierre de registros y
+    las OTs generadas se anotan en `pendientes` (_nuevosPendientes) y
+    _completarCambiosEstado los aplica para todas las OTs a la vez. No hace commit.
+    Devuelve (error, respuesta); con error la OT no se modifica.
+    """
+    # Validar que haya técnico asignado si se pone como 'asignada'
+    if nuevoEstado == 'asignada' and not (orden.tecnicoAsignado and orden.tecnicoAsignado.strip()):
+        return 'No se puede marcar como asignada sin un técnico asignado', None
+
+    respuesta = {'mensaje': f'Estado cambiado a {nuevoEstado}'}
+
     # Registrar fechas según el cambio de estado
     if nuevoEstado == 'en_curso':
         if not orden.fechaInicio:
@@ -1510,95 +1719,194 @@ def cambiarEstadoOrden(id):
         if orden.fechaFin:
             orden.fechaFin = None
             orden.cerradoPor = None
-            
+
     elif nuevoEstado == 'cerrado_parcial':
         # El técnico ha finalizado su trabajo — registrar fecha de primer cierre
         if not orden.fechaInicio:
             orden.fechaInicio = datetime.now()
-            
+
         # Registrar el tiempo de fin del trabajo
         orden.fechaFin = datetime.now()
+        pendientes['cierres'].append((orden, registrosActivos, 'al finalizar'))
 
-        # ── SEGURIDAD: cerrar registros de tiempo activos que el técnico no paró ──
-        registros_activos = RegistroTiempo.query.filter_by(ordenId=id, enCurso=True).all()
-        # Usar la fechaFin de la orden como fin del registro: el tiempo cuenta
-        # desde que el técnico empezó hasta que cerró la orden, no hasta ahora.
-        fin_sesion = orden.fechaFin
-        for reg in registros_activos:
-            reg.fin = fin_sesion
-            reg.enCurso = False
-        if registros_activos:
-            # Recalcular tiempoReal con todos los registros ya cerrados
-            tiempoTotal = db.session.query(func.sum(
-                func.julianday(RegistroTiempo.fin) - func.julianday(RegistroTiempo.inicio)
-            )).filter(RegistroTiempo.ordenId == id, RegistroTiempo.fin.isnot(None)).scalar()
-            if tiempoTotal:
-                orden.tiempoReal = round(tiempoTotal * 24, 2)
-            print(f'[AVISO] OT {orden.numero}: {len(registros_activos)} registro(s) de tiempo cerrado(s) automáticamente al finalizar.')
-            
         # Si era correctivo, volver la máquina a operativo
         if orden.tipo == 'correctivo':
-            maquina = Maquina.query.get(orden.maquinaId)
+            maquina = maquinas.get(orden.maquinaId)
             if maquina:
                 maquina.estado = 'operativo'
-        
+
         # Auto-generación de la siguiente OT preventiva (al cerrado_parcial)
+        # y de OTs correctivas por items de checklist NOK; el número y la
+        # respuesta se completan en _completarCambiosEstado
         if orden.tipo == 'preventivo':
-            nueva_ot_numero, nueva_ot_id = _generarSiguienteOTPreventivo(orden)
-            # Generar OTs correctivas por items de checklist NOK
-            ots_correctivas = _generarCorrectivosChecklist(orden)
-            
+            siguiente = _siguienteOTPreventivo(orden, pendientes['preventivas'])
+            correctivos = _correctivosChecklist(orden)
+            if siguiente or correctivos:
+                pendientes['generadas'].append((respuesta, siguiente, correctivos))
+
     elif nuevoEstado == 'cerrada':
         # Solo poner fechaFin si no pasó por cerrado_parcial o no tenía
         if not orden.fechaFin:
             orden.fechaFin = datetime.now()
-        orden.cerradoPor = data.get('cerradoPor', 'Sistema')
-
-        # ── SEGURIDAD: cerrar registros de tiempo activos que el técnico no paró ──
-        registros_activos = RegistroTiempo.query.filter_by(ordenId=id, enCurso=True).all()
-        # Usar la fechaFin de la orden como fin del registro: el tiempo cuenta
-        # desde que el técnico empezó hasta que cerró la orden, no hasta ahora.
-        fin_sesion = orden.fechaFin
-        for reg in registros_activos:
-            reg.fin = fin_sesion
-            reg.enCurso = False
-        if registros_activos:
-            # Recalcular tiempoReal con todos los registros ya cerrados
-            tiempoTotal = db.session.query(func.sum(
-                func.julianday(RegistroTiempo.fin) - func.julianday(RegistroTiempo.inicio)
-            )).filter(RegistroTiempo.ordenId == id, RegistroTiempo.fin.isnot(None)).scalar()
-            if tiempoTotal:
-                orden.tiempoReal = round(tiempoTotal * 24, 2)
-            print(f'[AVISO] OT {orden.numero}: {len(registros_activos)} registro(s) de tiempo cerrado(s) automáticamente al cerrar definitivamente.')
-    
-    # Validar que haya técnico asignado si se pone como 'asignada'
-    if nuevoEstado == 'asignada' and not (orden.tecnicoAsignado and orden.tecnicoAsignado.strip()):
-        return jsonify({'error': 'No se puede marcar como asignada sin un técnico asignado'}), 400
+        orden.cerradoPor = cerradoPor
+        pendientes['cierres'].append((orden, registrosActivos, 'al cerrar definitivamente'))
 
     orden.estado = nuevoEstado
-    db.session.commit()
+    return None, respuesta
 
-    
-    respuesta = {'mensaje': f'Estado cambiado a {nuevoEstado}'}
-    if nueva_ot_numero:
-        respuesta['nuevaOT'] = nueva_ot_numero
-        respuesta['nuevaOTId'] = nueva_ot_id
-        respuesta['mensajeOT'] = f'Nueva OT preventiva generada: {nueva_ot_numero}'
-    if ots_correctivas:
-        respuesta['otsCorrectivas'] = ots_correctivas
-        respuesta['mensajeCorrectivos'] = f'Se han generado {len(ots_correctivas)} OT(s) correctiva(s): {", ".join(ots_correctivas)}'
+
+def _nuevosPendientes():
+    """Efectos de _aplicarEstadoOrden que se aplican en bloque al final"""
+    # preventivas: (gama, equipo) con siguiente OT ya generada en este lote
+    return {'cierres': [], 'generadas': [], 'preventivas': set()}
+
+
+def _completarCambiosEstado(pendientes):
+    """
+    Cierra de una vez los registros de tiempo de todas las OTs y crea las OTs
+    generadas con un único bloque de números (OrdenTrabajo.reservarNumeros).
+    Completa la respuesta de cada OT con los números e ids de las generadas.
+    """
+    _cerrarRegistrosActivos(pendientes['cierres'])
+
+    generadas = pendientes['generadas']
+    nuevas = [ot for _, siguiente, correctivos in generadas for ot in ([siguiente] if siguiente else []) + correctivos]
+    if not nuevas:
+        return
+    for nueva, numero in zip(nuevas, OrdenTrabajo.reservarNumeros(len(nuevas))):
+        nueva.numero = numero
+    db.session.add_all(nuevas)
+    db.session.flush()
+
+    for respuesta, siguiente, correctivos in generadas:
+        if siguiente:
+            respuesta['nuevaOT'] = siguiente.numero
+            respuesta['nuevaOTId'] = siguiente.id
+            respuesta['mensajeOT'] = f'Nueva OT preventiva generada: {siguiente.numero}'
+        if correctivos:
+            ots_correctivas = [c.numero for c in correctivos]
+            respuesta['otsCorrectivas'] = ots_correctivas
+            respuesta['mensajeCorrectivos'] = f'Se han generado {len(ots_correctivas)} OT(s) correctiva(s): {", ".join(ots_correctivas)}'
+
+
+def _cerrarRegistrosActivos(cierres):
+    """SEGURIDAD: cierra los registros de tiempo activos que el técnico no paró"""
+    # Usar la fechaFin de la orden como fin del registro: el tiempo cuenta
+    # desde que el técnico empezó hasta que cerró la orden, no hasta ahora.
+    # Los que otra petición cerró mientras tanto no se cuentan
+    cerrados = OrdenTrabajo.cerrarSesiones([(orden, registros, orden.fechaFin)
+                                            for orden, registros, _ in cierres])
+    porOrden = {}
+    for reg in cerrados:
+        porOrden[reg.ordenId] = porOrden.get(reg.ordenId, 0) + 1
+    for orden, _, motivo in cierres:
+        if porOrden.get(orden.id):
+            print(f'[AVISO] OT {orden.numero}: {porOrden[orden.id]} registro(s) de tiempo cerrado(s) automáticamente {motivo}.')
+
+
+def _registrosActivosPorOrden(ordenes):
+    """{ordenId: [RegistroTiempo en curso]} para varias OTs en una consulta"""
+    # Siempre por enCurso (consulta indexada): sesionesAbiertas es solo
+    # orientativo y no decide qué registros se cierran
+    ids = [o.id for o in ordenes]
+    registros = {}
+    if not ids:
+        return registros
+    for reg in RegistroTiempo.query.filter(RegistroTiempo.ordenId.in_(ids), RegistroTiempo.enCurso == True):
+        registros.setdefault(reg.ordenId, []).append(reg)
+    return registros
+
+
+def _maquinasDeOrdenes(ordenes):
+    """{id: Maquina} de las máquinas de las OTs correctivas, en una consulta"""
+    ids = {o.maquinaId for o in ordenes if o.tipo == 'correctivo' and o.maquinaId}
+    return {m.id: m for m in Maquina.query.filter(Maquina.id.in_(ids))} if ids else {}
+
+
+@app.route('/api/orden/<int:id>/estado', methods=['PUT'])
+def cambiarEstadoOrden(id):
+    orden = OrdenTrabajo.query.get_or_404(id)
+    data = request.get_json()
+    nuevoEstado = data['estado']
+
+    registrosActivos = []
+    if nuevoEstado in ESTADOS_CIERRE:
+        registrosActivos = _registrosActivosPorOrden([orden]).get(id, [])
+    pendientes = _nuevosPendientes()
+    error, respuesta = _aplicarEstadoOrden(orden, nuevoEstado, data.get('cerradoPor', 'Sistema'),
+                                           registrosActivos, _maquinasDeOrdenes([orden]), pendientes)
+    if error:
+        return jsonify({'error': error}), 400
+    _completarCambiosEstado(pendientes)
+    db.session.commit()
     return jsonify(respuesta)
 
 
-def _generarSiguienteOTPreventivo(orden):
-    """Genera la siguiente OT preventiva al cerrar una orden de tipo preventivo.
+@app.route('/api/ordenes/estado', methods=['POST'])
+def cambiarEstadoOrdenes():
+    """
+    Cambio de estado en bloque (p. ej. cerrar las OTs de un turno) con los
+    mismos efectos que PUT /api/orden/<id>/estado. OTs, registros de tiempo y
+    máquinas se cargan con una consulta cada uno, los registros activos de
+    todas las OTs se cierran con un UPDATE, las OTs generadas reservan sus
+    números en un solo bloque y se hace un único commit.
+    Body: {ids: [...], estado, cerradoPor?}. Devuelve un resultado por id;
+    las OTs que no existen o no admiten el cambio no impiden el resto.
+    """
+    data = request.get_json() or {}
+    ids = data.get('ids')
+    nuevoEstado = data.get('estado')
+    if not nuevoEstado or not isinstance(ids, list) or not ids:
+        return jsonify({'error': 'Debe indicar ids (lista) y estado'}), 400
+    try:
+        ids = list(dict.fromkeys(int(i) for i in ids))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids debe ser una lista de enteros'}), 400
+    if len(ids) > 500:
+        return jsonify({'error': 'Máximo 500 órdenes por petición'}), 400
+
+    ordenes = {o.id: o for o in OrdenTrabajo.query.filter(OrdenTrabajo.id.in_(ids))}
+    registros = _registrosActivosPorOrden(ordenes.values()) if nuevoEstado in ESTADOS_CIERRE else {}
+    maquinas = _maquinasDeOrdenes(ordenes.values())
+    cerradoPor = data.get('cerradoPor', 'Sistema')
+    pendientes = _nuevosPendientes()
+
+    resultados = []
+    for id in ids:
+        orden = ordenes.get(id)
+        if not orden:
+            resultados.append({'id': id, 'ok': False, 'error': 'Orden no encontrada'})
+            continue
+        error, respuesta = _aplicarEstadoOrden(orden, nuevoEstado, cerradoPor,
+                                               registros.get(id, []), maquinas, pendientes)
+        if error:
+            resultados.append({'id': id, 'numero': orden.numero, 'ok': False, 'error': error})
+            continue
+        # El mismo dict: _completarCambiosEstado le añade las OTs generadas
+        respuesta.update(id=id, numero=orden.numero, ok=True)
+        resultados.append(respuesta)
+
+    _completarCambiosEstado(pendientes)
+    db.session.commit()
+    return jsonify({
+        'actualizadas': sum(1 for r in resultados if r['ok']),
+        'resultados': resultados,
+    })
+
+
+def _siguienteOTPreventivo(orden, generadas):
+    """Prepara la siguiente OT preventiva al cerrar una orden de tipo preventivo.
     Utiliza la frecuencia y gama almacenadas en la propia OT.
-    Devuelve el número de la nueva OT o None si no se pudo generar."""
+    Devuelve la nueva OT, aún sin número ni añadir a la sesión, o None si no
+    se genera. `generadas` son los (gama, equipo) ya generados en el lote."""
     try:
         if not orden.frecuenciaTipo or not orden.frecuenciaValor:
             return None  # Sin frecuencia definida, no se auto-genera
 
         # Evitar duplicidad: comprobar si ya se generó una OT preventiva para este equipo y gama posterior a esta
+        clave = (orden.gamaId, orden.equipoTipo, orden.equipoId)
+        if clave in generadas:
+            return None
         existente = OrdenTrabajo.query.filter_by(
             tipo='preventivo',
             gamaId=orden.gamaId,
@@ -1632,7 +1940,6 @@ def _generarSiguienteOTPreventivo(orden):
             fecha_siguiente = fecha_cierre + timedelta(days=orden.frecuenciaValor)
 
         nueva = OrdenTrabajo(
-            numero=OrdenTrabajo.generarNumero(),
             tipo='preventivo',
             prioridad=orden.prioridad or 'media',
             estado='pendiente',
@@ -1648,19 +1955,18 @@ def _generarSiguienteOTPreventivo(orden):
             fechaProgramada=datetime.combine(fecha_siguiente, datetime.min.time()),
             creadoPor='Sistema (auto)'
         )
-        db.session.add(nueva)
-        db.session.flush()
-        return nueva.numero, nueva.id
+        generadas.add(clave)
+        return nueva
     except Exception as e:
         print(f'Error al generar siguiente OT preventiva: {e}')
-    return None, None
+    return None
 
 
-def _generarCorrectivosChecklist(orden):
-    """Genera OTs correctivas para cada item de checklist respondido como NOK
+def _correctivosChecklist(orden):
+    """Prepara OTs correctivas para cada item de checklist respondido como NOK
     que tenga generaCorrectivo=True.
-    Devuelve la lista de números de OT creadas."""
-    numeros = []
+    Devuelve la lista de OTs, aún sin número ni añadir a la sesión."""
+    correctivos = []
     try:
         for resp in orden.respuestasChecklist:
             if resp.respuesta != 'nok':
@@ -1682,24 +1988,21 @@ def _generarCorrectivosChecklist(orden):
             
             if obs:
                 problema += f'. Observación: {obs}'
-            correctivo = OrdenTrabajo(
-                numero=OrdenTrabajo.generarNumero(),
+            correctivos.append(OrdenTrabajo(
                 tipo='correctivo',
                 prioridad='media',
                 estado='pendiente',
-                titulo=f'Correctivo: {item.descripcion}',
+                titulo=titulo_generado,
                 descripcionProblema=problema,
                 equipoTipo=orden.equipoTipo,
                 equipoId=orden.equipoId,
                 maquinaId=orden.maquinaId,
                 creadoPor=f'Sistema (checklist OT {orden.numero})'
-            )
-            db.session.add(correctivo)
-            db.session.flush()
-            numeros.append(correctivo.numero)
+            ))
     except Exception as e:
         print(f'Error al generar OTs correctivas desde checklist: {e}')
-    return numeros
+        return []
+    return correctivos
 
 # =============================================================================
 # CALENDARIO DE ÓRDENES (para el dashboard principal)
@@ -1707,16 +2010,49 @@ def _generarCorrectivosChecklist(orden):
 
 @app.route('/api/ordenes-calendario')
 def apiOrdenesCalendario():
-    """Devuelve todas las OTs con fecha programada, para mostrar en el calendario del dashboard."""
-    # Filtrar OTs que tengan fechaProgramada y no estén cerradas/canceladas
-    ordenes = OrdenTrabajo.query.filter(
+    """
+    OTs abiertas con fecha programada, para el calendario del dashboard.
+      - start / end (YYYY-MM-DD, inclusivos): solo la ventana visible (índice ix_ot_programada)
+      - agrupar=dia: en lugar de las OTs, {fecha: {tipo: número de OTs}} para vistas de mes/año
+    Sin ventana devuelve todas (compatibilidad).
+    """
+    inicio = request.args.get('start')
+    fin = request.args.get('end')
+    desde = _parseFechaFiltro(inicio)
+    hasta = _parseFechaFiltro(fin)
+    if (inicio and not desde) or (fin and not hasta):
+        return jsonify({'error': 'Fecha no válida (formato YYYY-MM-DD)'}), 400
+
+    filtros = [
         OrdenTrabajo.fechaProgramada.isnot(None),
         OrdenTrabajo.estado.notin_(['cerrada', 'cancelada'])
+    ]
+    # Se compara el texto guardado: hay fechas importadas sin hora ('YYYY-MM-DD')
+    fechaTexto = type_coerce(OrdenTrabajo.fechaProgramada, db.String)
+    if desde:
+        filtros.append(fechaTexto >= desde.strftime('%Y-%m-%d'))
+    if hasta:
+        filtros.append(fechaTexto < (hasta + timedelta(days=1)).strftime('%Y-%m-%d'))
+
+    if request.args.get('agrupar') == 'dia':
+        dia = func.date(OrdenTrabajo.fechaProgramada)
+        filas = db.session.query(dia, OrdenTrabajo.tipo, func.count(OrdenTrabajo.id)).filter(
+            *filtros
+        ).group_by(dia, OrdenTrabajo.tipo).all()
+        resultado = {}
+        for fecha, tipo, total in filas:
+            resultado.setdefault(fecha, {})[tipo] = total
+        return jsonify(resultado)
+
+    ordenes = OrdenTrabajo.query.filter(*filtros).options(
+        joinedload(OrdenTrabajo.maquina)
     ).order_by(OrdenTrabajo.fechaProgramada).all()
+    rutas = obtenerRutas((o.equipoTipo, o.equipoId) for o in ordenes)
     
     resultado = []
     for o in ordenes:
-        equipoNombre = getEquipoNombre(o.equipoTipo, o.equipoId) if o.equipoTipo and o.equipoId else (o.maquina.nombre if o.maquina else '')
+        ruta = rutas.get((o.equipoTipo, o.equipoId))
+        equipoNombre = ruta.nombre if ruta else (o.maquina.nombre if o.maquina else '')
         resultado.append({
             'id': o.id,
             'numero': o.numero,
@@ -1736,16 +2072,18 @@ def apiOrdenesPreventivo():
     ordenes = OrdenTrabajo.query.filter(
         OrdenTrabajo.tipo == 'preventivo',
         OrdenTrabajo.estado.notin_(['cerrada', 'cancelada'])
-    ).order_by(
+    ).options(joinedload(OrdenTrabajo.gama)).order_by(
         OrdenTrabajo.fechaProgramada.is_(None),  # Sin fecha al final
         OrdenTrabajo.fechaProgramada.asc()
     ).all()
+    rutas = obtenerRutas((o.equipoTipo, o.equipoId) for o in ordenes)
 
     hoy = date.today()
     resultado = []
     for o in ordenes:
-        equipoNombre = getEquipoNombre(o.equipoTipo, o.equipoId) if o.equipoTipo and o.equipoId else ''
-        equipoRuta = getEquipoRutaCompleta(o.equipoTipo, o.equipoId) if o.equipoTipo and o.equipoId else ''
+        ruta = rutas.get((o.equipoTipo, o.equipoId))
+        equipoNombre = getEquipoNombre(o.equipoTipo, o.equipoId, ruta) if ruta else ''
+        equipoRuta = getEquipoRutaCompleta(o.equipoTipo, o.equipoId, ruta) if ruta else ''
         fecha_prog = o.fechaProgramada.date() if o.fechaProgramada else None
         dias = (fecha_prog - hoy).days if fecha_prog else None
         vencida = dias is not None and dias < 0
@@ -1832,12 +2170,7 @@ def iniciarTrabajoOT(id):
         return jsonify({'error': f'{tecnico} ya tiene un registro de tiempo activo'}), 400
     
     # Crear nuevo registro de tiempo
-    registro = RegistroTiempo(
-        ordenId=id,
-        tecnico=tecnico,
-        inicio=datetime.now(),
-        enCurso=True
-    )
+    registro = orden.abrirSesion(tecnico)
     db.session.add(registro)
     
     # Si la OT estaba pendiente, pasarla a en_curso
@@ -1868,19 +2201,12 @@ def pausarTrabajoOT(id):
     if not registro:
         return jsonify({'error': f'No hay trabajo activo para {tecnico}'}), 400
     
-    # Cerrar el registro
-    registro.fin = datetime.now()
-    registro.enCurso = False
-    duracion = registro.duracionHoras
-    
-    # Actualizar tiempo real de la OT
-    tiempoTotal = db.session.query(func.sum(
-        func.julianday(RegistroTiempo.fin) - func.julianday(RegistroTiempo.inicio)
-    )).filter(RegistroTiempo.ordenId == id, RegistroTiempo.fin.isnot(None)).scalar()
-    
-    if tiempoTotal:
-        orden.tiempoReal = round(tiempoTotal * 24, 2)  # Convertir días a horas
-    
+    # Cerrar el registro y acumular su duración en el tiempo real de la OT
+    duracion = orden.cerrarSesion(registro)
+    if duracion is None:
+        # Otra petición lo cerró entre la consulta y el cierre (doble pulsación)
+        db.session.rollback()
+        return jsonify({'error': f'No hay trabajo activo para {tecnico}'}), 400
     db.session.commit()
     return jsonify({
         'mensaje': f'Trabajo pausado por {tecnico}',
@@ -1904,50 +2230,55 @@ def obtenerTiemposOT(id):
         } for r in registros]
     })
 
+def _serializarCostesExternos(orden):
+    return [{
+        'id': c.id,
+        'proveedor': c.proveedor or '',
+        'descripcion': c.descripcion or '',
+        'coste': c.coste,
+        'fecha': c.fecha.isoformat() if c.fecha else None,
+    } for c in orden.costesExternos]
+
+
+def _actualizarTotalExterno(orden):
+    """Recalcula costeTallerExterno (total mostrado en la OT) con la suma de sus líneas"""
+    total = db.session.query(func.sum(CosteExterno.coste)).filter(CosteExterno.ordenId == orden.id).scalar()
+    orden.costeTallerExterno = round(total or 0, 2)
+
+
 # Añadir coste de taller externo
 @app.route('/api/orden/<int:id>/coste-externo', methods=['POST'])
 def agregarCosteExterno(id):
-    import json as _json
     orden = OrdenTrabajo.query.get_or_404(id)
     data = request.get_json()
+    try:
+        coste = round(float(data.get('coste', 0)), 2)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Coste no válido'}), 400
 
-    # Cargar lista existente
-    costes = _json.loads(orden.costesExternosJson) if orden.costesExternosJson else []
-
-    # Migración: si había un coste legacy y la lista está vacía, incorporarlo
-    if not costes and orden.costeTallerExterno:
-        costes.append({
-            'proveedor': orden.proveedorExterno or '',
-            'descripcion': orden.descripcionTallerExterno or '',
-            'coste': round(float(orden.costeTallerExterno), 2)
-        })
-
-    # Añadir el nuevo coste
-    costes.append({
-        'proveedor': data.get('proveedor', ''),
-        'descripcion': data.get('descripcion', ''),
-        'coste': round(float(data.get('coste', 0)), 2)
-    })
-
-    orden.costesExternosJson = _json.dumps(costes)
-    orden.costeTallerExterno = round(sum(c['coste'] for c in costes), 2)
-
+    db.session.add(CosteExterno(
+        ordenId=id,
+        proveedor=(data.get('proveedor') or '').strip(),
+        descripcion=data.get('descripcion', ''),
+        coste=coste,
+    ))
+    _actualizarTotalExterno(orden)
     db.session.commit()
-    return jsonify({'mensaje': 'Coste externo añadido', 'total': orden.costeTallerExterno, 'costes': costes})
+    return jsonify({'mensaje': 'Coste externo añadido', 'total': orden.costeTallerExterno,
+                    'costes': _serializarCostesExternos(orden)})
 
 
-@app.route('/api/orden/<int:id>/coste-externo/<int:idx>', methods=['DELETE'])
-def eliminarCosteExterno(id, idx):
-    import json as _json
+@app.route('/api/orden/<int:id>/coste-externo/<int:costeId>', methods=['DELETE'])
+def eliminarCosteExterno(id, costeId):
     orden = OrdenTrabajo.query.get_or_404(id)
-    costes = _json.loads(orden.costesExternosJson) if orden.costesExternosJson else []
-    if idx < 0 or idx >= len(costes):
-        return jsonify({'error': 'Índice no válido'}), 400
-    costes.pop(idx)
-    orden.costesExternosJson = _json.dumps(costes)
-    orden.costeTallerExterno = round(sum(c['coste'] for c in costes), 2)
+    linea = CosteExterno.query.filter_by(id=costeId, ordenId=id).first()
+    if not linea:
+        return jsonify({'error': 'Coste externo no encontrado'}), 404
+    db.session.delete(linea)
+    _actualizarTotalExterno(orden)
     db.session.commit()
-    return jsonify({'mensaje': 'Coste eliminado', 'total': orden.costeTallerExterno, 'costes': costes})
+    return jsonify({'mensaje': 'Coste eliminado', 'total': orden.costeTallerExterno,
+                    'costes': _serializarCostesExternos(orden)})
 
 
 # =============================================================================
@@ -2153,6 +2484,7 @@ ICONOS_DISPONIBLES = [
 ]
 
 @app.route('/api/tipos-intervencion')
+@condicional(VERSION_TIPOS_INTERVENCION)
 def apiTiposIntervencion():
     """Listar todos los tipos de intervención activos"""
     soloActivos = request.args.get('activo', 'true') == 'true'
@@ -2256,6 +2588,7 @@ def apiIconosDisponibles():
 
 
 @app.route('/api/gamas')
+@condicional(VERSION_GAMAS)
 def apiGamas():
     activo = request.args.get('activo', '')
     buscar = request.args.get('buscar', '')
@@ -2319,6 +2652,7 @@ def crearGama():
 @app.route('/api/gama/<int:id>')
 def obtenerGama(id):
     g = GamaMantenimiento.query.get_or_404(id)
+    rutas = obtenerRutas((a.equipoTipo, a.equipoId) for a in g.asignaciones)
     
     return jsonify({
         'id': g.id,
@@ -2349,7 +2683,7 @@ def obtenerGama(id):
             'id': a.id,
             'equipoTipo': a.equipoTipo,
             'equipoId': a.equipoId,
-            'equipoNombre': getEquipoNombre(a.equipoTipo, a.equipoId),
+            'equipoNombre': getattr(rutas.get((a.equipoTipo, a.equipoId)), 'nombre', ''),
             'frecuenciaTipo': a.frecuenciaTipo,
             'frecuenciaValor': a.frecuenciaValor,
             'proximaEjecucion': a.proximaEjecucion.isoformat() if a.proximaEjecucion else None,
@@ -2541,7 +2875,8 @@ def apiAsignaciones():
     if activo == 'true':
         query = query.filter_by(activo=True)
     
-    asignaciones = query.order_by(AsignacionGama.proximaEjecucion).all()
+    asignaciones = query.options(joinedload(AsignacionGama.gama)).order_by(AsignacionGama.proximaEjecucion).all()
+    rutas = obtenerRutas((a.equipoTipo, a.equipoId) for a in asignaciones)
     
     return jsonify([{
         'id': a.id,
@@ -2550,7 +2885,7 @@ def apiAsignaciones():
         'gamaNombre': a.gama.nombre,
         'equipoTipo': a.equipoTipo,
         'equipoId': a.equipoId,
-        'equipoNombre': getEquipoNombre(a.equipoTipo, a.equipoId),
+        'equipoNombre': getattr(rutas.get((a.equipoTipo, a.equipoId)), 'nombre', ''),
         'frecuenciaTipo': a.frecuenciaTipo,
         'frecuenciaValor': a.frecuenciaValor,
         'ultimaEjecucion': a.ultimaEjecucion.isoformat() if a.ultimaEjecucion else None,
@@ -2851,6 +3186,7 @@ def testAlta():
 # =============================================================================
 
 @app.route('/api/tecnicos')
+@condicional(VERSION_TECNICOS)
 def apiTecnicos():
     # Mostrar todos o filtrar por activos
     soloActivos = request.args.get('activo') == 'true'
@@ -2996,6 +3332,44 @@ def putConfigGeneral():
     return jsonify({'mensaje': 'Configuración guardada correctamente'})
 
 
+# --- FESTIVOS (calendario de horas operativas de los KPIs) ---
+@app.route('/api/festivos', methods=['GET'])
+def getFestivos():
+    q = Festivo.query
+    if request.args.get('plantaId'):
+        q = q.filter(or_(Festivo.plantaId == None, Festivo.plantaId == int(request.args['plantaId'])))
+    return jsonify([{
+        'id': f.id,
+        'fecha': f.fecha.isoformat(),
+        'plantaId': f.plantaId,
+        'descripcion': f.descripcion or '',
+    } for f in q.order_by(Festivo.fecha).all()])
+
+
+@app.route('/api/festivos', methods=['POST'])
+def crearFestivo():
+    data = request.get_json() or {}
+    try:
+        fecha = date.fromisoformat(data.get('fecha') or '')
+    except ValueError:
+        return jsonify({'error': 'Fecha no válida'}), 400
+    plantaId = data.get('plantaId') or None
+    if plantaId and not db.session.get(Planta, plantaId):
+        return jsonify({'error': 'Planta no encontrada'}), 404
+    festivo = Festivo(fecha=fecha, plantaId=plantaId, descripcion=data.get('descripcion', ''))
+    db.session.add(festivo)
+    db.session.commit()
+    return jsonify({'id': festivo.id, 'mensaje': 'Festivo creado correctamente'}), 201
+
+
+@app.route('/api/festivo/<int:id>', methods=['DELETE'])
+def eliminarFestivo(id):
+    festivo = Festivo.query.get_or_404(id)
+    db.session.delete(festivo)
+    db.session.commit()
+    return jsonify({'mensaje': 'Festivo eliminado correctamente'})
+
+
 # =============================================================================
 # GESTIÓN DE USUARIOS
 # =============================================================================
@@ -9,7 +9,7 @@ from datetime import date, datetime
 from models import (
     db, Empresa, Planta, Zona, Linea, Maquina, Elemento,
     Recambio, Tecnico, Usuario, GamaMantenimiento, TareaGama,
-    ChecklistItem, RecambioGama, OrdenTrabajo,
+    ChecklistItem, RecambioGama, OrdenTrabajo, SecuenciaOT,
 )
 
 log = logging.getLogger('importacion')
@@ -546,6 +546,11 @@ def import_historico(validated):
     ots_cache = {ot.numero: ot for ot in OrdenTrabajo.query.all()}
 
     try:
+        # Filas sin número: un único bloque de la secuencia anual para todas
+        sin_numero = [row for row in rows if not str(row.get('numero') or '').strip()]
+        for row, numero in zip(sin_numero, OrdenTrabajo.reservarNumeros(len(sin_numero))):
+            row['numero'] = numero
+
         for row in rows:
             try:
                 numero = str(row.get('numero') or '').strip()
@@ -603,6 +608,8 @@ def import_historico(validated):
                 log.warning(f"Error en fila {row.get('_fila')} de ORDENES: {e}")
                 stats['errores'] += 1
 
+        # Los números importados con formato AAXXXXX no se volverán a emitir
+        SecuenciaOT.sincronizar(row.get('numero') for row in rows)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
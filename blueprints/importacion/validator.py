@@ -8,10 +8,10 @@ Las filas válidas incluyen _fila y _update (True si el código ya existe en la
 from datetime import datetime, date
 
 from models import (
-    db, Empresa, Planta, Zona, Linea, Maquina, Elemento,
-    Recambio, Tecnico, Usuario, GamaMantenimiento,
+    db, Recambio, Tecnico, Usuario, GamaMantenimiento,
     OrdenTrabajo,
 )
+from jerarquia import obtenerSnapshot
 
 
 # =============================================================================
@@ -131,9 +131,10 @@ def validate_activos(data):
     # --- PLANTAS ---
     sheet_name = 'PLANTAS'
     res = _sheet_result()
-    # Pre-cargar empresas disponibles
-    empresas_by_codigo = {e.codigo: e for e in Empresa.query.all()}
-    plantas_existentes = {p.codigo: p for p in Planta.query.all()}
+    # Jerarquía existente desde el snapshot compartido
+    jer = obtenerSnapshot()
+    empresas_by_codigo = jer.porCodigo('empresa')
+    plantas_existentes = jer.porCodigo('planta')
     valid_planta_codigos = set(plantas_existentes.keys())  # empezar con existentes
 
     for row in data.get(sheet_name, []):
@@ -173,7 +174,7 @@ def validate_activos(data):
     # --- ZONAS ---
     sheet_name = 'ZONAS'
     res = _sheet_result()
-    zonas_existentes = {z.codigo: z for z in Zona.query.all()}
+    zonas_existentes = jer.porCodigo('zona')
     valid_zona_codigos = set(zonas_existentes.keys())
 
     for row in data.get(sheet_name, []):
@@ -209,7 +210,7 @@ def validate_activos(data):
     # --- LINEAS ---
     sheet_name = 'LINEAS'
     res = _sheet_result()
-    lineas_existentes = {l.codigo: l for l in Linea.query.all()}
+    lineas_existentes = jer.porCodigo('linea')
     valid_linea_codigos = set(lineas_existentes.keys())
 
     for row in data.get(sheet_name, []):
@@ -245,7 +246,7 @@ def validate_activos(data):
     # --- MAQUINAS ---
     sheet_name = 'MAQUINAS'
     res = _sheet_result()
-    maquinas_existentes = {m.codigo: m for m in Maquina.query.all()}
+    maquinas_existentes = jer.porCodigo('maquina')
     valid_maquina_codigos = set(maquinas_existentes.keys())
 
     for row in data.get(sheet_name, []):
@@ -324,7 +325,7 @@ def validate_activos(data):
     # --- ELEMENTOS ---
     sheet_name = 'ELEMENTOS'
     res = _sheet_result()
-    elementos_existentes = {e.codigo: e for e in Elemento.query.all()}
+    elementos_existentes = jer.porCodigo('elemento')
 
     for row in data.get(sheet_name, []):
         fila = row.get('_fila', '?')
@@ -621,7 +622,8 @@ def validate_historico(data):
 
         numero = str(row.get('numero') or '').strip()
         if not numero:
-            row_errors.append(_make_error(fila, 'numero', numero, 'El número de OT es obligatorio'))
+            row_warnings.append(_make_warning(fila, 'numero', numero,
+                                              'Sin número de OT — se asignará uno automáticamente'))
 
         titulo = str(row.get('titulo') or '').strip()
         if not titulo:
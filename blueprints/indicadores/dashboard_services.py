@@ -9,21 +9,31 @@ Adaptado al modelo real del proyecto:
   - Jerarquía polimorfa       → equipoTipo + equipoId (sin FK directa a Equipo)
   - TipoIntervencion          → catálogo configurable de tipos (con color y nombre)
 
+Los conteos y horas de paro por mes/equipo/tipo/prioridad se leen del agregado
+mensual hecho_mensual_orden (hechos.consultaHechos), no de orden_trabajo.
+
 Nota: usa func.strftime('%Y-%m', ...) → SQLite. Para PostgreSQL sustituir por
       func.to_char(col, 'YYYY-MM').
 """
 import calendar as _cal
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date as _date
 from collections import defaultdict
 
-from sqlalchemy import func, case, desc, or_, and_
+from flask import current_app
+from sqlalchemy import func
 
 from models import (
     db,
-    OrdenTrabajo, RegistroTiempo, TipoIntervencion,
-    Maquina, Elemento, Linea, Zona, Planta, Empresa,
+    OrdenTrabajo, RegistroTiempo, TipoIntervencion, CosteExterno,
 )
-from blueprints.indicadores.services import _get_pares_bajo_nodo
+from jerarquia import obtenerSnapshot, filtroOrdenesSubarbol
+from hechos import consultaHechos
+from calendario import Calendario, horasOperativas
+from cache_kpis import cacheado
+
+log = logging.getLogger(__name__)
 
 
 # =============================================================================
@@ -66,43 +76,28 @@ def _fi_ff_dt(fi, ff):
     )
 
 
-def _precargar_jerarquia():
-    """
-    Carga toda la jerarquía de activos en dicts para evitar N+1 queries.
-    Devuelve dict con claves: maquinas, elementos, lineas, zonas, plantas, empresas.
-    """
-    return {
-        'maquinas':  {m.id: m for m in Maquina.query.all()},
-        'elementos': {e.id: e for e in Elemento.query.all()},
-        'lineas':    {l.id: l for l in Linea.query.all()},
-        'zonas':     {z.id: z for z in Zona.query.all()},
-        'plantas':   {p.id: p for p in Planta.query.all()},
-        'empresas':  {e.id: e for e in Empresa.query.all()},
-    }
-
-
 def _linea_nombre(equipo_tipo, equipo_id, jer):
     """Sube la jerarquía para obtener el nombre de Línea del activo."""
     if equipo_tipo == 'linea':
-        l = jer['lineas'].get(equipo_id)
+        l = jer.lineas.get(equipo_id)
         return l.nombre if l else 'Sin línea'
     if equipo_tipo == 'maquina':
-        m = jer['maquinas'].get(equipo_id)
+        m = jer.maquinas.get(equipo_id)
         if m:
-            l = jer['lineas'].get(m.lineaId)
+            l = jer.lineas.get(m.lineaId)
             return l.nombre if l else 'Sin línea'
     if equipo_tipo == 'elemento':
-        e = jer['elementos'].get(equipo_id)
+        e = jer.elementos.get(equipo_id)
         if e:
-            m = jer['maquinas'].get(e.maquinaId)
+            m = jer.maquinas.get(e.maquinaId)
             if m:
-                l = jer['lineas'].get(m.lineaId)
+                l = jer.lineas.get(m.lineaId)
                 return l.nombre if l else 'Sin línea'
     if equipo_tipo == 'zona':
-        z = jer['zonas'].get(equipo_id)
+        z = jer.zonas.get(equipo_id)
         return f"Zona {z.nombre}" if z else 'Sin zona'
     if equipo_tipo == 'planta':
-        p = jer['plantas'].get(equipo_id)
+        p = jer.plantas.get(equipo_id)
         return f"Planta {p.nombre}" if p else 'Sin planta'
     return 'Sin clasificar'
 
@@ -117,7 +112,7 @@ def _equipo_label(equipo_tipo, equipo_id, jer):
     key = key_map.get(equipo_tipo)
     if not key:
         return f'{equipo_tipo}:{equipo_id}'
-    obj = jer[key].get(equipo_id)
+    obj = getattr(jer, key).get(equipo_id)
     if not obj:
         return f'{equipo_tipo}:{equipo_id}'
     codigo = getattr(obj, 'codigo', '')
@@ -160,47 +155,33 @@ def _tipo_nombre(tipo, tipos_info):
 
 def _scope_filter(nivel, nivel_id):
     """
-    Devuelve condición OR para filtrar OTs por jerarquía, o None si no hay alcance.
-    Usa _get_pares_bajo_nodo para obtener todos los (equipoTipo, equipoId) del nodo.
+    Devuelve condición para filtrar OTs por jerarquía, o None si no hay alcance.
+    Es un único predicado indexado (ver jerarquia.filtroOrdenesSubarbol).
     """
     if not nivel or not nivel_id:
         return None
-    pares = _get_pares_bajo_nodo(nivel, nivel_id)
-    by_tipo = {}
-    for t, i in pares:
-        by_tipo.setdefault(t, []).append(i)
-    conditions = [
-        and_(OrdenTrabajo.equipoTipo == t, OrdenTrabajo.equipoId.in_(ids))
-        for t, ids in by_tipo.items()
-    ]
-    return or_(*conditions) if conditions else None
+    return filtroOrdenesSubarbol(nivel, nivel_id)
 
 
 # =============================================================================
 # SERVICIO 1 – Intervenciones por Tipo / Mes  (Dashboard 3.1 + 3.2)
 # =============================================================================
 
+@cacheado('dashboard.tipos_mensuales')
 def get_tipos_mensuales(fi, ff, nivel=None, nivel_id=None):
     """
     Barras apiladas por mes y tipo de intervención.
     También devuelve donut de distribución total y ratio correctivo mensual.
     """
-    fi_dt, ff_dt = _fi_ff_dt(fi, ff)
     tipos_info = _get_tipos_info()
     meses = _mes_range(fi, ff)
 
-    q = db.session.query(
-        func.strftime('%Y-%m', OrdenTrabajo.fechaCreacion).label('mes'),
-        OrdenTrabajo.tipo,
-        func.count(OrdenTrabajo.id).label('n'),
-    ).filter(
-        OrdenTrabajo.fechaCreacion >= fi_dt,
-        OrdenTrabajo.fechaCreacion <= ff_dt,
-    )
-    sf = _scope_filter(nivel, nivel_id)
-    if sf is not None:
-        q = q.filter(sf)
-    rows = q.group_by('mes', OrdenTrabajo.tipo).all()
+    h = consultaHechos(fi, ff, nivel, nivel_id)
+    rows = db.session.query(
+        h.c.mes,
+        h.c.tipo,
+        func.sum(h.c.ordenes).label('n'),
+    ).group_by(h.c.mes, h.c.tipo).all()
 
     tipos = sorted(set(r.tipo for r in rows))
     matrix = defaultdict(lambda: defaultdict(int))
@@ -249,29 +230,27 @@ def get_tipos_mensuales(fi, ff, nivel=None, nivel_id=None):
 # SERVICIO 2 – OT por Prioridad  (Dashboard 3.3)
 # =============================================================================
 
+@cacheado('dashboard.prioridades')
 def get_prioridades(fi, ff, nivel=None, nivel_id=None):
     """Donut + barras mensuales por prioridad."""
-    fi_dt, ff_dt = _fi_ff_dt(fi, ff)
     meses = _mes_range(fi, ff)
-    sf = _scope_filter(nivel, nivel_id)
 
-    q_tot = db.session.query(
-        OrdenTrabajo.prioridad,
-        func.count(OrdenTrabajo.id).label('n'),
-    ).filter(
-        OrdenTrabajo.fechaCreacion >= fi_dt,
-        OrdenTrabajo.fechaCreacion <= ff_dt,
-    )
-    if sf is not None:
-        q_tot = q_tot.filter(sf)
-    rows_tot = q_tot.group_by(OrdenTrabajo.prioridad).all()
+    h = consultaHechos(fi, ff, nivel, nivel_id)
+    rows_mes = db.session.query(
+        h.c.mes,
+        h.c.prioridad,
+        func.sum(h.c.ordenes).label('n'),
+    ).group_by(h.c.mes, h.c.prioridad).all()
+
+    totales = defaultdict(int)
+    for r in rows_mes:
+        totales[r.prioridad] += r.n
 
     # Ordenar según prioridad (mayor a menor)
-    presentes = set(r.prioridad for r in rows_tot)
+    presentes = set(totales)
     prioridades = [p for p in _PRIORIDAD_ORDER if p in presentes]
     prioridades += sorted(presentes - set(_PRIORIDAD_ORDER))  # tipos no estándar al final
 
-    totales = {r.prioridad: r.n for r in rows_tot}
     donut = {
         'labels': [p.capitalize() for p in prioridades],
         'data':   [totales.get(p, 0) for p in prioridades],
@@ -279,18 +258,6 @@ def get_prioridades(fi, ff, nivel=None, nivel_id=None):
         'total':  sum(totales.values()),
     }
 
-    q_mes = db.session.query(
-        func.strftime('%Y-%m', OrdenTrabajo.fechaCreacion).label('mes'),
-        OrdenTrabajo.prioridad,
-        func.count(OrdenTrabajo.id).label('n'),
-    ).filter(
-        OrdenTrabajo.fechaCreacion >= fi_dt,
-        OrdenTrabajo.fechaCreacion <= ff_dt,
-    )
-    if sf is not None:
-        q_mes = q_mes.filter(sf)
-    rows_mes = q_mes.group_by('mes', OrdenTrabajo.prioridad).all()
-
     matrix = defaultdict(lambda: defaultdict(int))
     for r in rows_mes:
         matrix[r.mes][r.prioridad] = r.n
@@ -314,32 +281,28 @@ def get_prioridades(fi, ff, nivel=None, nivel_id=None):
 # SERVICIO 3 – TOP Equipos  (Dashboard 3.8)
 # =============================================================================
 
+@cacheado('dashboard.top_equipos')
 def get_top_equipos(fi, ff, limit=10, solo_correctivas=False, nivel=None, nivel_id=None):
     """
     TOP equipos por nº de intervenciones y horas de paro.
     Devuelve datos para Chart.js barras horizontales + tabla.
     """
-    fi_dt, ff_dt = _fi_ff_dt(fi, ff)
-    jer = _precargar_jerarquia()
+    jer = obtenerSnapshot()
 
+    h = consultaHechos(fi, ff, nivel, nivel_id)
+    num_ot = func.sum(h.c.ordenes)
     q = db.session.query(
-        OrdenTrabajo.equipoTipo,
-        OrdenTrabajo.equipoId,
-        func.count(OrdenTrabajo.id).label('num_ot'),
-        func.sum(OrdenTrabajo.tiempoParada).label('horas_paro'),
-    ).filter(
-        OrdenTrabajo.fechaCreacion >= fi_dt,
-        OrdenTrabajo.fechaCreacion <= ff_dt,
+        h.c.equipoTipo,
+        h.c.equipoId,
+        num_ot.label('num_ot'),
+        func.sum(h.c.horasParo).label('horas_paro'),
     )
     if solo_correctivas:
-        q = q.filter(OrdenTrabajo.tipo == 'correctivo')
-    sf = _scope_filter(nivel, nivel_id)
-    if sf is not None:
-        q = q.filter(sf)
+        q = q.filter(h.c.tipo == 'correctivo')
 
     rows = q.group_by(
-        OrdenTrabajo.equipoTipo, OrdenTrabajo.equipoId
-    ).order_by(func.count(OrdenTrabajo.id).desc()).limit(limit).all()
+        h.c.equipoTipo, h.c.equipoId
+    ).order_by(num_ot.desc()).limit(limit).all()
 
     tabla = [{
         'label':      _equipo_label(r.equipoTipo, r.equipoId, jer),
@@ -365,6 +328,7 @@ def get_top_equipos(fi, ff, limit=10, solo_correctivas=False, nivel=None, nivel_
 # SERVICIO 4 – Pareto de Averías  (Dashboard 3.7)
 # =============================================================================
 
+@cacheado('dashboard.pareto_averias')
 def get_pareto_averias(fi, ff, limit=10, nivel=None, nivel_id=None):
     """
     Pareto: equipos con más OTs correctivas.
@@ -395,6 +359,7 @@ def get_pareto_averias(fi, ff, limit=10, nivel=None, nivel_id=None):
 # SERVICIO 5 – Tiempos por Técnico  (Dashboard 3.5)
 # =============================================================================
 
+@cacheado('dashboard.tiempos_tecnicos')
 def get_tiempos_tecnicos(fi, ff, nivel=None, nivel_id=None):
     """
     Horas imputadas por técnico, desglosadas por tipo de OT.
@@ -461,13 +426,14 @@ def get_tiempos_tecnicos(fi, ff, nivel=None, nivel_id=None):
 # SERVICIO 6 – Tiempos de Mantenimiento por Línea  (Dashboard 3.6)
 # =============================================================================
 
+@cacheado('dashboard.tiempos_linea')
 def get_tiempos_linea(fi, ff, nivel=None, nivel_id=None):
     """
     Tiempos promedio (reacción, reparación) y total de paro por línea.
     Solo OTs con fechaInicio y fechaFin no nulos.
     """
     fi_dt, ff_dt = _fi_ff_dt(fi, ff)
-    jer = _precargar_jerarquia()
+    jer = obtenerSnapshot()
     sf = _scope_filter(nivel, nivel_id)
 
     q_ord = OrdenTrabajo.query.filter(
@@ -538,96 +504,74 @@ def get_tiempos_linea(fi, ff, nivel=None, nivel_id=None):
 # SERVICIO 7 – Heatmap Equipos × Meses  (Dashboard 3.8.3)
 # =============================================================================
 
-def get_heatmap_equipos(fi, ff, limit=15, nivel=None, nivel_id=None):
-    """
-    Series para ApexCharts heatmap: TOP {limit} equipos × meses.
-    Cada serie es un equipo; cada punto es {x: 'mes', y: nº OTs}.
+# Métricas del heatmap: nombre → (valor sobre el agregado mensual, decimales)
+METRICAS_HEATMAP = {
+    'ordenes':    (lambda h: h.c.ordenes, None),
+    'horas_paro': (lambda h: h.c.horasParo, 1),
+    'coste':      (lambda h: h.c.costeManoObra + h.c.costeRecambios + h.c.costeExterno, 2),
+}
+
+
+def _pivot_series(h, valor, meses, limit, jer, decimales=None):
     """
-    fi_dt, ff_dt = _fi_ff_dt(fi, ff)
-    jer = _precargar_jerarquia()
-    meses = _mes_range(fi, ff)
-    sf = _scope_filter(nivel, nivel_id)
+    Series {name, data: [{x: mes, y: valor}]} de los TOP {limit} equipos por la
+    suma de `valor` en el rango, una por equipo y ordenadas por total.
 
-    q_top = db.session.query(
-        OrdenTrabajo.equipoTipo,
-        OrdenTrabajo.equipoId,
-        func.count(OrdenTrabajo.id).label('total'),
-    ).filter(
-        OrdenTrabajo.fechaCreacion >= fi_dt,
-        OrdenTrabajo.fechaCreacion <= ff_dt,
+    Una sola consulta devuelve (equipo, mes, valor) solo para los equipos del
+    TOP: el total por equipo y su posición se calculan con funciones de ventana
+    sobre la agrupación por (equipo, mes). El pivotado a series se hace en memoria.
+    """
+    por_mes = db.session.query(
+        h.c.equipoTipo,
+        h.c.equipoId,
+        h.c.mes,
+        func.sum(valor).label('valor'),
+    ).group_by(h.c.equipoTipo, h.c.equipoId, h.c.mes).subquery()
+
+    total = func.sum(por_mes.c.valor).over(partition_by=(por_mes.c.equipoTipo, por_mes.c.equipoId))
+    con_total = db.session.query(por_mes, total.label('total')).subquery()
+
+    # Empates en el total: por tipo e id de equipo
+    posicion = func.dense_rank().over(
+        order_by=(con_total.c.total.desc(), con_total.c.equipoTipo, con_total.c.equipoId)
     )
-    if sf is not None:
-        q_top = q_top.filter(sf)
-    top_rows = q_top.group_by(
-        OrdenTrabajo.equipoTipo, OrdenTrabajo.equipoId
-    ).order_by(desc('total')).limit(limit).all()
+    ranking = db.session.query(con_total, posicion.label('posicion')).subquery()
 
-    if not top_rows:
-        return []
+    rows = db.session.query(ranking).filter(
+        ranking.c.posicion <= limit
+    ).order_by(ranking.c.posicion).all()
 
-    series = []
-    for r in top_rows:
-        label = _equipo_label(r.equipoTipo, r.equipoId, jer)
+    pivot = {}
+    for r in rows:
+        pivot.setdefault((r.equipoTipo, r.equipoId), {})[r.mes] = r.valor
+
+    def _y(v):
+        v = v or 0
+        return round(v, decimales) if decimales is not None else v
 
-        monthly = db.session.query(
-            func.strftime('%Y-%m', OrdenTrabajo.fechaCreacion).label('mes'),
-            func.count(OrdenTrabajo.id).label('cnt'),
-        ).filter(
-            OrdenTrabajo.equipoTipo == r.equipoTipo,
-            OrdenTrabajo.equipoId   == r.equipoId,
-            OrdenTrabajo.fechaCreacion >= fi_dt,
-            OrdenTrabajo.fechaCreacion <= ff_dt,
-        ).group_by('mes').all()
+    return [{
+        'name': _equipo_label(equipo_tipo, equipo_id, jer),
+        'data': [{'x': _label_mes(m), 'y': _y(por_mes_equipo.get(m))} for m in meses],
+    } for (equipo_tipo, equipo_id), por_mes_equipo in pivot.items()]
 
-        month_map = {m.mes: m.cnt for m in monthly}
-        series.append({
-            'name': label,
-            'data': [{'x': _label_mes(m), 'y': month_map.get(m, 0)} for m in meses],
-        })
 
-    return series
+@cacheado('dashboard.heatmap_equipos')
+def get_heatmap_equipos(fi, ff, limit=15, nivel=None, nivel_id=None, metrica='ordenes'):
+    """
+    Series para ApexCharts heatmap: TOP {limit} equipos × meses.
+    Cada serie es un equipo; cada punto es {x: 'mes', y: valor} con la métrica
+    de METRICAS_HEATMAP (nº OTs, horas de paro o coste).
+    """
+    valor, decimales = METRICAS_HEATMAP[metrica]
+    h = consultaHechos(fi, ff, nivel, nivel_id)
+    return _pivot_series(h, valor(h), _mes_range(fi, ff), limit, obtenerSnapshot(), decimales)
 
 
 # =============================================================================
 # SERVICIO 8 – Evolución mensual de KPIs: MTBF, MTTR, Disponibilidad
 # =============================================================================
 
-# Mapa de turnos: 'horas/días' → (horas_dia, dias_semana)
-_TURNOS = {
-    '8/5':  (8,  5),
-    '8/6':  (8,  6),
-    '10/5': (10, 5),
-    '12/5': (12, 5),
-    '16/5': (16, 5),
-    '16/6': (16, 6),
-    '12/7': (12, 7),
-    '24/5': (24, 5),
-    '24/6': (24, 6),
-    '24/7': (24, 7),
-}
-
-
-def _horas_operativas(fecha_ini, fecha_fin, turno_key):
-    """
-    Calcula las horas operativas reales entre dos fechas según el turno configurado.
-    Si dias_semana < 7, solo cuenta los días laborables (lunes-viernes para /5, +sábado para /6).
-    """
-    from datetime import timedelta
-    horas_dia, dias_semana = _TURNOS.get(turno_key, (24, 7))
-    total = 0.0
-    current = fecha_ini
-    while current <= fecha_fin:
-        dow = current.weekday()  # 0=lun, 6=dom
-        if dias_semana == 7:
-            total += horas_dia
-        elif dias_semana == 6 and dow < 6:   # lun-sáb
-            total += horas_dia
-        elif dias_semana == 5 and dow < 5:   # lun-vie
-            total += horas_dia
-        current += timedelta(days=1)
-    return total
-
-
+@cacheado('dashboard.kpis_evolucion')
 def get_kpis_evolucion(fi, ff, nivel=None, nivel_id=None):
     """
     Evolución mensual de MTBF, MTTR y Disponibilidad operacional (EN 13306).
@@ -645,27 +589,20 @@ def get_kpis_evolucion(fi, ff, nivel=None, nivel_id=None):
       MTTR          = horas_paro  / n_fallos  (h)
       Disponibilidad = tiempo_func / horas_periodo × 100  (%)
     """
-    from models import ConfiguracionGeneral
-    turno_key = ConfiguracionGeneral.obtener('turno_planta', '24/7')
+    # Turno de la planta o de la línea del alcance, y festivos (calendario.py)
+    turno_key, festivos = Calendario(obtenerSnapshot()).regimen(nivel, nivel_id)
 
-    fi_dt, ff_dt = _fi_ff_dt(fi, ff)
     meses = _mes_range(fi, ff)
-    sf = _scope_filter(nivel, nivel_id)
 
     # Una sola query: correctivas con tiempoParada > 0, agrupadas por mes
-    q = db.session.query(
-        func.strftime('%Y-%m', OrdenTrabajo.fechaCreacion).label('mes'),
-        func.count(OrdenTrabajo.id).label('n_fallos'),
-        func.sum(OrdenTrabajo.tiempoParada).label('horas_paro'),
+    h = consultaHechos(fi, ff, nivel, nivel_id)
+    rows = db.session.query(
+        h.c.mes,
+        func.sum(h.c.fallos).label('n_fallos'),
+        func.sum(h.c.horasFallo).label('horas_paro'),
     ).filter(
-        OrdenTrabajo.fechaCreacion >= fi_dt,
-        OrdenTrabajo.fechaCreacion <= ff_dt,
-        OrdenTrabajo.tipo == 'correctivo',
-        OrdenTrabajo.tiempoParada > 0,
-    )
-    if sf is not None:
-        q = q.filter(sf)
-    rows = q.group_by('mes').all()
+        h.c.tipo == 'correctivo',
+    ).group_by(h.c.mes).all()
 
     fallos_mes = {r.mes: r.n_fallos       for r in rows}
     paro_mes   = {r.mes: r.horas_paro or 0.0 for r in rows}
@@ -680,7 +617,7 @@ def get_kpis_evolucion(fi, ff, nivel=None, nivel_id=None):
         # Período efectivo dentro del rango de fechas solicitado
         periodo_ini = max(fi, mes_start)
         periodo_fin = min(ff, mes_end)
-        horas_periodo = _horas_operativas(periodo_ini, periodo_fin, turno_key)
+        horas_periodo = horasOperativas(periodo_ini, periodo_fin, turno_key, festivos)
 
         n_fallos   = fallos_mes.get(ym, 0)
         horas_paro = paro_mes.get(ym, 0.0)
@@ -699,3 +636,104 @@ def get_kpis_evolucion(fi, ff, nivel=None, nivel_id=None):
         'turno':          turno_key,
     }
 
+
+# =============================================================================
+# SERVICIO 9 – Gasto en talleres externos por proveedor
+# =============================================================================
+
+@cacheado('dashboard.gasto_proveedores')
+def get_gasto_proveedores(fi, ff, limit=15, nivel=None, nivel_id=None):
+    """
+    Gasto en talleres externos agrupado por proveedor (líneas de CosteExterno
+    con fecha en el periodo). Agregado en SQL sobre ix_coste_externo_proveedor_fecha.
+    """
+    fi_dt, ff_dt = _fi_ff_dt(fi, ff)
+
+    total = func.sum(CosteExterno.coste)
+    q = db.session.query(
+        CosteExterno.proveedor,
+        total.label('total'),
+        func.count(CosteExterno.id).label('lineas'),
+        func.count(func.distinct(CosteExterno.ordenId)).label('ordenes'),
+    ).filter(
+        CosteExterno.fecha >= fi_dt,
+        CosteExterno.fecha <= ff_dt,
+    )
+    sf = _scope_filter(nivel, nivel_id)
+    if sf is not None:
+        q = q.join(OrdenTrabajo, OrdenTrabajo.id == CosteExterno.ordenId).filter(sf)
+
+    rows = q.group_by(CosteExterno.proveedor).order_by(total.desc()).limit(limit).all()
+
+    tabla = [{
+        'proveedor': r.proveedor or 'Sin proveedor',
+        'total':     round(r.total or 0, 2),
+        'lineas':    r.lineas,
+        'ordenes':   r.ordenes,
+    } for r in rows]
+
+    return {
+        'tabla': tabla,
+        'chart': {
+            'labels': [r['proveedor'] for r in tabla],
+            'data':   [r['total'] for r in tabla],
+        },
+    }
+
+
+# =============================================================================
+# SERVICIO 10 – Todos los dashboards de la página en una respuesta
+# =============================================================================
+
+# Hilos del pool compartido por las peticiones del worker
+MAX_HILOS = 4
+_pool = ThreadPoolExecutor(max_workers=MAX_HILOS, thread_name_prefix='dashboard')
+
+
+def _servicios_dashboard(fi, ff, nivel, nivel_id):
+    """Clave del payload → (servicio, argumentos), con los límites de la página."""
+    return {
+        'tipos_mensuales':  (get_tipos_mensuales,  (fi, ff, nivel, nivel_id)),
+        'prioridades':      (get_prioridades,      (fi, ff, nivel, nivel_id)),
+        'pareto_averias':   (get_pareto_averias,   (fi, ff, 10, nivel, nivel_id)),
+        'top_equipos':      (get_top_equipos,      (fi, ff, 10, False, nivel, nivel_id)),
+        'heatmap_equipos':  (get_heatmap_equipos,  (fi, ff, 15, nivel, nivel_id)),
+        'tiempos_tecnicos': (get_tiempos_tecnicos, (fi, ff, nivel, nivel_id)),
+        'tiempos_linea':    (get_tiempos_linea,    (fi, ff, nivel, nivel_id)),
+        'kpis_evolucion':   (get_kpis_evolucion,   (fi, ff, nivel, nivel_id)),
+    }
+
+
+def get_dashboard_completo(fi, ff, nivel=None, nivel_id=None):
+    """
+    Datos de todos los gráficos de la página de dashboards en un único dict
+    (una clave por servicio, con el mismo contenido que su endpoint).
+
+    Solo el snapshot de la jerarquía se carga una vez antes de repartir el
+    trabajo; los servicios se ejecutan en paralelo en el pool, cada uno en su
+    propio app context y, por tanto, con su propia sesión de BD. Cada servicio
+    sigue leyendo sus tipos de intervención y construyendo su filtro de alcance,
+    igual que en su endpoint: sus argumentos forman la clave de @cacheado y
+    todos son consultas pequeñas. Si un servicio falla, su mensaje queda en
+    'errores' y se devuelve el resto.
+    """
+    obtenerSnapshot()   # los hilos encuentran la jerarquía ya cargada
+    app = current_app._get_current_object()
+
+    def _ejecutar(servicio, args):
+        with app.app_context():
+            return servicio(*args)
+
+    futuros = {
+        clave: _pool.submit(_ejecutar, servicio, args)
+        for clave, (servicio, args) in _servicios_dashboard(fi, ff, nivel, nivel_id).items()
+    }
+    resultado, errores = {}, {}
+    for clave, futuro in futuros.items():
+        try:
+            resultado[clave] = futuro.result()
+        except Exception as e:
+            log.exception('Error en el dashboard %s', clave)
+            errores[clave] = str(e)
+    resultado['errores'] = errores
+    return resultado
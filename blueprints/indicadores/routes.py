@@ -289,6 +289,16 @@ def _dash_nivel():
     return nivel, nivel_id
 
 
+# --- Todos los gráficos de la página en una petición
+
+@bp.route('/api/dashboard/all')
+@responsable_required
+def api_dash_all():
+    fi, ff = _dash_fechas()
+    nivel, nivel_id = _dash_nivel()
+    return jsonify(ds.get_dashboard_completo(fi, ff, nivel, nivel_id))
+
+
 # --- 3.1 + 3.2  Intervenciones por tipo / mes + ratio correctivo
 
 @bp.route('/api/dashboard/tipos-mensuales')
@@ -359,7 +369,10 @@ def api_dash_heatmap():
     fi, ff = _dash_fechas()
     nivel, nivel_id = _dash_nivel()
     limit = request.args.get('limit', 15, type=int)
-    return jsonify(ds.get_heatmap_equipos(fi, ff, limit, nivel, nivel_id))
+    metrica = request.args.get('metrica', 'ordenes')
+    if metrica not in ds.METRICAS_HEATMAP:
+        return jsonify({'error': f'Métrica no válida: {metrica}'}), 400
+    return jsonify(ds.get_heatmap_equipos(fi, ff, limit, nivel, nivel_id, metrica))
 
 
 # --- KPI Evolución mensual (MTBF, MTTR, Disponibilidad)
@@ -370,3 +383,14 @@ def api_dash_kpis_evolucion():
     fi, ff = _dash_fechas()
     nivel, nivel_id = _dash_nivel()
     return jsonify(ds.get_kpis_evolucion(fi, ff, nivel, nivel_id))
+
+
+# --- Gasto en talleres externos por proveedor
+
+@bp.route('/api/dashboard/gasto-proveedores')
+@responsable_required
+def api_dash_gasto_proveedores():
+    fi, ff = _dash_fechas()
+    nivel, nivel_id = _dash_nivel()
+    limit = request.args.get('limit', 15, type=int)
+    return jsonify(ds.get_gasto_proveedores(fi, ff, limit, nivel, nivel_id))
@@ -3,37 +3,47 @@ Lógica de negocio para el módulo de Indicadores y Reportes del GMAO.
 Adaptado al modelo de datos real del proyecto (models.py).
 """
 from datetime import datetime, date, timedelta
-from sqlalchemy import func, or_, and_
+from sqlalchemy import func, case, and_
 
 from models import (
     db, OrdenTrabajo, ConsumoRecambio, RegistroTiempo,
     MovimientoStock, Recambio, Tecnico,
     GamaMantenimiento, AsignacionGama, TareaGama, RecambioGama,
     Maquina, Elemento, Linea, Zona, Planta, Empresa,
-    ConfiguracionGeneral
+    CosteOrden, HechoMensualOrden
 )
+from jerarquia import (MODELOS, obtenerRuta, obtenerRutas, obtenerSnapshot,
+                       filtroOrdenesSubarbol, idsSubarbol)
+from calendario import Calendario, horasOperativas
+from hechos import entreFechas, filtroHechos, mesesCompletos
+from cache_kpis import cacheado
 
 
 # =============================================================================
 # HELPERS INTERNOS
 # =============================================================================
 
-def _get_equipo_info(equipo_tipo, equipo_id):
-    """Devuelve (codigo, nombre) para cualquier nivel jerárquico de activo."""
-    modelos = {
-        'empresa': Empresa, 'planta': Planta, 'zona': Zona,
-        'linea': Linea, 'maquina': Maquina, 'elemento': Elemento
-    }
-    modelo = modelos.get(equipo_tipo)
-    if not modelo or not equipo_id:
+def _ruta_de(equipo_tipo, equipo_id, rutas):
+    """RutaActivo del equipo: del lote precargado si se pasa, o de la BD."""
+    if rutas is not None:
+        return rutas.get((equipo_tipo, equipo_id))
+    return obtenerRuta(equipo_tipo, equipo_id)
+
+
+def _get_equipo_info(equipo_tipo, equipo_id, rutas=None):
+    """
+    Devuelve (codigo, nombre) para cualquier nivel jerárquico de activo.
+    Si se pasa `rutas` (resultado de obtenerRutas) no se consulta la BD.
+    """
+    if equipo_tipo not in MODELOS or not equipo_id:
         return '', 'Sin asignar'
-    obj = modelo.query.get(equipo_id)
-    if not obj:
+    ruta = _ruta_de(equipo_tipo, equipo_id, rutas)
+    if not ruta:
         return '', 'Desconocido'
-    return getattr(obj, 'codigo', ''), getattr(obj, 'nombre', '')
+    return ruta.codigo or '', ruta.nombre or ''
 
 
-def _get_ruta_jerarquica(equipo_tipo, equipo_id):
+def _get_ruta_jerarquica(equipo_tipo, equipo_id, rutas=None):
     """
     Devuelve un dict con los nombres de cada nivel de la jerarquía:
       { 'planta': '', 'zona': '', 'linea': '', 'maquina': '', 'elemento': '' }
@@ -44,122 +54,26 @@ def _get_ruta_jerarquica(equipo_tipo, equipo_id):
     if not equipo_tipo or not equipo_id:
         return ruta
 
-    try:
-        if equipo_tipo == 'elemento':
-            elem = Elemento.query.get(equipo_id)
-            if not elem:
-                return ruta
-            ruta['elemento'] = elem.nombre
-            maq = Maquina.query.get(elem.maquinaId)
-            if maq:
-                ruta['maquina'] = maq.nombre
-                linea = Linea.query.get(maq.lineaId)
-                if linea:
-                    ruta['linea'] = linea.nombre
-                    zona = Zona.query.get(linea.zonaId)
-                    if zona:
-                        ruta['zona'] = zona.nombre
-                        planta = Planta.query.get(zona.plantaId)
-                        if planta:
-                            ruta['planta'] = planta.nombre
-
-        elif equipo_tipo == 'maquina':
-            maq = Maquina.query.get(equipo_id)
-            if not maq:
-                return ruta
-            ruta['maquina'] = maq.nombre
-            linea = Linea.query.get(maq.lineaId)
-            if linea:
-                ruta['linea'] = linea.nombre
-                zona = Zona.query.get(linea.zonaId)
-                if zona:
-                    ruta['zona'] = zona.nombre
-                    planta = Planta.query.get(zona.plantaId)
-                    if planta:
-                        ruta['planta'] = planta.nombre
-
-        elif equipo_tipo == 'linea':
-            linea = Linea.query.get(equipo_id)
-            if not linea:
-                return ruta
-            ruta['linea'] = linea.nombre
-            zona = Zona.query.get(linea.zonaId)
-            if zona:
-                ruta['zona'] = zona.nombre
-                planta = Planta.query.get(zona.plantaId)
-                if planta:
-                    ruta['planta'] = planta.nombre
-
-        elif equipo_tipo == 'zona':
-            zona = Zona.query.get(equipo_id)
-            if not zona:
-                return ruta
-            ruta['zona'] = zona.nombre
-            planta = Planta.query.get(zona.plantaId)
-            if planta:
-                ruta['planta'] = planta.nombre
-
-        elif equipo_tipo == 'planta':
-            planta = Planta.query.get(equipo_id)
-            if planta:
-                ruta['planta'] = planta.nombre
-
-    except Exception:
-        pass
-
+    r = _ruta_de(equipo_tipo, equipo_id, rutas)
+    if r:
+        for nivel in r.rutaNombresLista:
+            ruta[nivel['tipo']] = nivel['nombre']
     return ruta
 
 
-def _build_tecnicos_dict():
+def _costes_orden(coste):
     """
-    Construye un dict {nombre_completo: coste_hora} para lookup rápido.
-    Incluye claves con nombre completo y solo nombre.
+    (horas, coste_mo, coste_recambios, coste_externo) de una OT a partir de su
+    fila de CosteOrden (mantenida al escribir, ver costes.py). Sin fila, ceros.
     """
-    result = {}
-    for t in Tecnico.query.filter_by(activo=True).all():
-        full = f"{t.nombre} {t.apellidos}".strip() if t.apellidos else t.nombre
-        ch = t.costeHora or 0.0
-        result[full] = ch
-        result[t.nombre] = ch
-    return result
-
-
-def _coste_hora_defecto():
-    """Coste/hora por defecto desde ConfiguracionGeneral o 0."""
-    val = ConfiguracionGeneral.obtener('coste_hora_defecto', '0')
-    try:
-        return float(val)
-    except (ValueError, TypeError):
-        return 0.0
-
-
-def _horas_y_coste_mo(orden, tecnicos_dict, coste_defecto):
-    """
-    Calcula horas de intervención y coste de mano de obra de una OT.
-    Usa RegistroTiempo (entradas cerradas). Si no hay registros, usa tiempoReal.
-    """
-    horas = 0.0
-    coste = 0.0
-    registros_cerrados = [rt for rt in orden.registrosTiempo if rt.fin is not None]
-
-    if registros_cerrados:
-        for rt in registros_cerrados:
-            h = (rt.fin - rt.inicio).total_seconds() / 3600
-            horas += h
-            nombre = (rt.tecnico or '').strip()
-            ch = tecnicos_dict.get(nombre, coste_defecto)
-            coste += h * ch
-    else:
-        # Fallback: usar tiempoReal y coste_defecto
-        horas = orden.tiempoReal or 0.0
-        coste = horas * coste_defecto
-
-    return horas, coste
+    if coste is None:
+        return 0.0, 0.0, 0.0, 0.0
+    return coste.horas, coste.costeManoObra, coste.costeRecambios, coste.costeExterno
 
 
-def _coste_recambios_orden(orden):
-    """Suma coste de todos los recambios consumidos en una OT."""
-    return sum((c.cantidad or 0) * (c.precioUnitario or 0) for c in orden.consumos)
+def _con_costes(q):
+    """Añade a una consulta de OTs su resumen de costes: filas (OrdenTrabajo, CosteOrden)"""
+    return q.outerjoin(CosteOrden, CosteOrden.ordenId == OrdenTrabajo.id).add_entity(CosteOrden)
 
 
 def _parse_fecha(s):
@@ -227,39 +141,6 @@ def get_hijos_jerarquia(nivel, parent_id=None):
     return [{'id': i.id, 'codigo': getattr(i, 'codigo', ''), 'nombre': i.nombre} for i in items]
 
 
-def _get_pares_bajo_nodo(nivel, nivel_id):
-    """
-    Devuelve lista de (equipoTipo, equipoId) para el nodo dado y todos sus descendientes.
-    Recorre la jerarquía de forma recursiva: empresa→planta→zona→linea→maquina→elemento.
-    """
-    nivel_id = int(nivel_id)
-    result = [(nivel, nivel_id)]
-
-    if nivel == 'elemento':
-        return result
-    if nivel == 'maquina':
-        for e in Elemento.query.filter_by(maquinaId=nivel_id).all():
-            result.append(('elemento', e.id))
-        return result
-    if nivel == 'linea':
-        for m in Maquina.query.filter_by(lineaId=nivel_id).all():
-            result.extend(_get_pares_bajo_nodo('maquina', m.id))
-        return result
-    if nivel == 'zona':
-        for l in Linea.query.filter_by(zonaId=nivel_id).all():
-            result.extend(_get_pares_bajo_nodo('linea', l.id))
-        return result
-    if nivel == 'planta':
-        for z in Zona.query.filter_by(plantaId=nivel_id).all():
-            result.extend(_get_pares_bajo_nodo('zona', z.id))
-        return result
-    if nivel == 'empresa':
-        for p in Planta.query.filter_by(empresaId=nivel_id).all():
-            result.extend(_get_pares_bajo_nodo('planta', p.id))
-        return result
-    return result
-
-
 # =============================================================================
 # INFORME DE ÓRDENES DE TRABAJO
 # =============================================================================
@@ -270,9 +151,6 @@ def get_informe_ordenes(fecha_inicio, fecha_fin, tipo=None, estado=None, equipo_
     rows: lista de dicts con todos los campos del informe.
     totales: dict con sumas de horas y costes.
     """
-    tecnicos_dict = _build_tecnicos_dict()
-    coste_defecto = _coste_hora_defecto()
-
     q = OrdenTrabajo.query
 
     if fecha_inicio:
@@ -288,7 +166,8 @@ def get_informe_ordenes(fecha_inicio, fecha_fin, tipo=None, estado=None, equipo_
     if equipo_id:
         q = q.filter(OrdenTrabajo.equipoId == int(equipo_id))
 
-    ordenes = q.order_by(OrdenTrabajo.fechaCreacion.desc()).all()
+    filas = _con_costes(q).order_by(OrdenTrabajo.fechaCreacion.desc()).all()
+    rutas = obtenerRutas((o.equipoTipo, o.equipoId) for o, _ in filas)
 
     rows = []
     totales = {
@@ -299,11 +178,9 @@ def get_informe_ordenes(fecha_inicio, fecha_fin, tipo=None, estado=None, equipo_
         'coste_total': 0.0,
     }
 
-    for o in ordenes:
-        eq_codigo, eq_nombre = _get_equipo_info(o.equipoTipo, o.equipoId)
-        horas, coste_mo = _horas_y_coste_mo(o, tecnicos_dict, coste_defecto)
-        coste_rec = _coste_recambios_orden(o)
-        coste_ext = o.costeTallerExterno or 0.0
+    for o, coste in filas:
+        eq_codigo, eq_nombre = _get_equipo_info(o.equipoTipo, o.equipoId, rutas)
+        horas, coste_mo, coste_rec, coste_ext = _costes_orden(coste)
         coste_total = coste_mo + coste_rec + coste_ext
         horas_paro = o.tiempoParada or 0.0
 
@@ -313,7 +190,7 @@ def get_informe_ordenes(fecha_inicio, fecha_fin, tipo=None, estado=None, equipo_
         totales['coste_talleres'] += coste_ext
         totales['coste_total'] += coste_total
 
-        ruta = _get_ruta_jerarquica(o.equipoTipo, o.equipoId)
+        ruta = _get_ruta_jerarquica(o.equipoTipo, o.equipoId, rutas)
         rows.append({
             'numero': o.numero,
             'titulo': o.titulo or '',
@@ -429,13 +306,14 @@ def get_informe_preventivos(fecha_desde, fecha_hasta, equipo_id=None):
         asig_q = asig_q.filter(AsignacionGama.equipoId == int(equipo_id))
 
     asignaciones = asig_q.all()
+    rutas = obtenerRutas((a.equipoTipo, a.equipoId) for a in asignaciones)
 
     for asig in asignaciones:
         gama = asig.gama
         if not gama or not gama.activo:
             continue
 
-        eq_codigo, eq_nombre = _get_equipo_info(asig.equipoTipo, asig.equipoId)
+        eq_codigo, eq_nombre = _get_equipo_info(asig.equipoTipo, asig.equipoId, rutas)
 
         # Tareas resumidas (primeras 3)
         tareas_str = '; '.join(t.descripcion[:40] for t in gama.tareas[:3])
@@ -588,9 +466,6 @@ def get_informe_gamas_especiales(fecha_inicio, fecha_fin, tipos_gama=None, estad
     if not tipos_gama:
         tipos_gama = ['calibracion', 'tecnico_legal']
 
-    tecnicos_dict = _build_tecnicos_dict()
-    coste_defecto = _coste_hora_defecto()
-
     gama_ids = [
         g.id for g in GamaMantenimiento.query.filter(
             GamaMantenimiento.tipo.in_(tipos_gama),
@@ -611,17 +486,16 @@ def get_informe_gamas_especiales(fecha_inicio, fecha_fin, tipos_gama=None, estad
     if equipo_id:
         q = q.filter(OrdenTrabajo.equipoId == int(equipo_id))
 
-    ordenes = q.order_by(OrdenTrabajo.fechaCreacion.desc()).all()
+    filas = _con_costes(q).order_by(OrdenTrabajo.fechaCreacion.desc()).all()
+    rutas = obtenerRutas((o.equipoTipo, o.equipoId) for o, _ in filas)
 
     rows = []
     totales = {'total': 0, 'cerradas': 0, 'pendientes': 0,
                'horas_intervencion': 0.0, 'coste_total': 0.0}
 
-    for o in ordenes:
-        eq_codigo, eq_nombre = _get_equipo_info(o.equipoTipo, o.equipoId)
-        horas, coste_mo = _horas_y_coste_mo(o, tecnicos_dict, coste_defecto)
-        coste_rec = _coste_recambios_orden(o)
-        coste_ext = o.costeTallerExterno or 0.0
+    for o, coste in filas:
+        eq_codigo, eq_nombre = _get_equipo_info(o.equipoTipo, o.equipoId, rutas)
+        horas, coste_mo, coste_rec, coste_ext = _costes_orden(coste)
         coste_total_ot = coste_mo + coste_rec + coste_ext
 
         gama = o.gama
@@ -871,90 +745,159 @@ def exportar_movimientos_excel(rows, totales):
 # INDICADORES KPI (EN 15341)
 # =============================================================================
 
+_CAMPOS_AGREGADOS = (
+    'ordenes', 'horas', 'coste', 'coste_recambios', 'coste_externo', 'fallos', 'horas_paro',
+    'programadas', 'programadas_cerradas', 'programadas_en_plazo', 'completas',
+)
+
+
+_CAMPOS_PROGRAMADAS = ('programadas', 'programadas_cerradas', 'programadas_en_plazo')
+
+
+def _sumas_ordenes(programada, *condiciones):
+    """
+    {tipo: {campo: valor}} agrupando orden_trabajo + coste_orden con las
+    condiciones dadas. `programada` es la condición de fecha programada dentro
+    del rango del informe (campos programadas*).
+    """
+    def _contar(condicion):
+        return func.sum(case((condicion, 1), else_=0))
+
+    ot = OrdenTrabajo
+    programada = and_(ot.fechaProgramada.isnot(None), programada)
+    cerrada = ot.estado == 'cerrada'
+    con_paro = ot.tiempoParada > 0
+    # Mismo criterio que str.strip(): descripción con algún carácter visible
+    solucion = func.trim(func.coalesce(ot.descripcionSolucion, ''), ' \t\r\n') != ''
+
+    q = db.session.query(
+        ot.tipo,
+        func.count(ot.id),
+        func.sum(func.coalesce(CosteOrden.horas, 0)),
+        func.sum(func.coalesce(CosteOrden.costeManoObra, 0) + func.coalesce(CosteOrden.costeRecambios, 0)
+                 + func.coalesce(CosteOrden.costeExterno, 0)),
+        func.sum(func.coalesce(CosteOrden.costeRecambios, 0)),
+        func.sum(func.coalesce(CosteOrden.costeExterno, 0)),
+        _contar(con_paro),
+        func.sum(case((con_paro, ot.tiempoParada), else_=0)),
+        _contar(programada),
+        _contar(and_(programada, cerrada)),
+        _contar(and_(programada, cerrada, ot.fechaFin.isnot(None), ot.fechaFin <= ot.fechaProgramada)),
+        _contar(and_(ot.fechaInicio.isnot(None), ot.fechaFin.isnot(None), ot.tiempoReal > 0,
+                     solucion, CosteOrden.registros > 0)),
+    ).outerjoin(CosteOrden, CosteOrden.ordenId == ot.id).filter(*condiciones)
+
+    return {
+        fila[0]: {campo: valor or 0 for campo, valor in zip(_CAMPOS_AGREGADOS, fila[1:])}
+        for fila in q.group_by(ot.tipo).all()
+    }
+
+
+def _sumas_hechos(inicio, fin, nivel=None, nivel_id=None):
+    """
+    Como _sumas_ordenes para las OTs creadas en los meses completos [inicio, fin],
+    leyendo el agregado mensual. Las programadas* solo cuentan las de fecha
+    programada dentro de esos mismos meses.
+    """
+    h = HechoMensualOrden
+    mes_ini, mes_fin = inicio.strftime('%Y-%m'), fin.strftime('%Y-%m')
+    en_meses = h.mesProgramada.between(mes_ini, mes_fin)
+
+    def _programadas(columna):
+        return func.sum(case((en_meses, columna), else_=0))
+
+    q = db.session.query(
+        h.tipo,
+        func.sum(h.ordenes),
+        func.sum(h.horas),
+        func.sum(h.costeManoObra + h.costeRecambios + h.costeExterno),
+        func.sum(h.costeRecambios),
+        func.sum(h.costeExterno),
+        func.sum(h.fallos),
+        func.sum(h.horasFallo),
+        _programadas(h.programadas),
+        _programadas(h.programadasCerradas),
+        _programadas(h.programadasEnPlazo),
+        func.sum(h.completas),
+    ).filter(h.mes.between(mes_ini, mes_fin))
+    if nivel and nivel_id:
+        q = q.filter(filtroHechos(nivel, nivel_id))
+
+    return {
+        fila[0]: {campo: valor or 0 for campo, valor in zip(_CAMPOS_AGREGADOS, fila[1:])}
+        for fila in q.group_by(h.tipo).all()
+    }
+
+
+def _acumular(agregados, parciales, campos=_CAMPOS_AGREGADOS):
+    for tipo, valores in parciales.items():
+        acumulado = agregados.setdefault(tipo, dict.fromkeys(_CAMPOS_AGREGADOS, 0))
+        for campo in campos:
+            acumulado[campo] += valores[campo]
+
+
+def _agregar_ordenes(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
+    """
+    Agregados por tipo de las OTs creadas entre las fechas (y alcance jerárquico):
+    {tipo: {campo: valor}} con los campos de _CAMPOS_AGREGADOS. Las programadas*
+    son las de fecha programada dentro del mismo rango.
+
+    Como consultaHechos, los meses completos del rango se leen del agregado
+    mensual (hecho_mensual_orden) y solo los días sueltos de los extremos se
+    agrupan sobre orden_trabajo. Las OTs de los meses completos programadas en
+    esos días sueltos se cuentan aparte por fechaProgramada (indexada).
+    """
+    ot = OrdenTrabajo
+    alcance = [filtroOrdenesSubarbol(nivel, nivel_id)] if nivel and nivel_id else []
+    programada = entreFechas(ot.fechaProgramada, fecha_inicio, fecha_fin)
+
+    completos = mesesCompletos(fecha_inicio, fecha_fin)
+    if completos is None:
+        return _sumas_ordenes(programada, entreFechas(ot.fechaCreacion, fecha_inicio, fecha_fin), *alcance)
+
+    inicio, fin = completos
+    agregados = _sumas_hechos(inicio, fin, nivel, nivel_id)
+    # Mes de creación como en el agregado; al ser una función no se usa el
+    # índice de fechaCreacion y SQLite busca por fechaProgramada
+    en_meses = func.strftime('%Y-%m', ot.fechaCreacion).between(inicio.strftime('%Y-%m'), fin.strftime('%Y-%m'))
+    sueltos = ((fecha_inicio, inicio - timedelta(days=1)), (fin + timedelta(days=1), fecha_fin))
+    for desde, hasta in sueltos:
+        if desde > hasta:
+            continue
+        _acumular(agregados, _sumas_ordenes(programada, entreFechas(ot.fechaCreacion, desde, hasta), *alcance))
+        en_sueltos = entreFechas(ot.fechaProgramada, desde, hasta)
+        _acumular(agregados, _sumas_ordenes(en_sueltos, en_sueltos, en_meses, *alcance), _CAMPOS_PROGRAMADAS)
+    return agregados
+
+
+@cacheado('indicadores')
 def calcular_indicadores(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
     """
     Calcula todos los KPI para el período y alcance jerárquico dados.
     nivel puede ser: empresa, planta, zona, linea, maquina, elemento (o None = toda la instalación).
     Devuelve dict agrupado: economicos, tecnicos, organizativos, resumen.
     """
-    tecnicos_dict = _build_tecnicos_dict()
-    coste_defecto = _coste_hora_defecto()
+    con_alcance = bool(nivel and nivel_id)
+    agregados = _agregar_ordenes(fecha_inicio, fecha_fin, nivel, nivel_id)
+    vacio = dict.fromkeys(_CAMPOS_AGREGADOS, 0)
+    corr = agregados.get('correctivo', vacio)
+    prev = agregados.get('preventivo', vacio)
 
-    fi = datetime.combine(fecha_inicio, datetime.min.time())
-    ff = datetime.combine(fecha_fin, datetime.max.time())
+    def _total(campo):
+        return sum(a[campo] for a in agregados.values())
 
-    q = OrdenTrabajo.query.filter(
-        OrdenTrabajo.fechaCreacion >= fi,
-        OrdenTrabajo.fechaCreacion <= ff,
-    )
-    pares = None
-    if nivel and nivel_id:
-        pares = _get_pares_bajo_nodo(nivel, nivel_id)
-        # Agrupar por tipo para construir OR eficiente
-        by_tipo = {}
-        for t, i in pares:
-            by_tipo.setdefault(t, []).append(i)
-        conditions = [
-            and_(OrdenTrabajo.equipoTipo == t, OrdenTrabajo.equipoId.in_(ids))
-            for t, ids in by_tipo.items()
-        ]
-        if conditions:
-            q = q.filter(or_(*conditions))
-
-    ordenes = q.all()
-
-    # ── Clasificar OTs ────────────────────────────────────────────────────────
-    correctivas = [o for o in ordenes if o.tipo == 'correctivo']
-    preventivas = [o for o in ordenes if o.tipo == 'preventivo']
-
-    # ── Acumular horas y costes ───────────────────────────────────────────────
-    coste_total = 0.0
-    coste_correctivo = 0.0
-    coste_preventivo = 0.0
-    coste_recambios_total = 0.0
-    horas_total = 0.0
-    horas_correctivo = 0.0
-    horas_preventivo = 0.0
-
-    for o in ordenes:
-        horas, coste_mo = _horas_y_coste_mo(o, tecnicos_dict, coste_defecto)
-        coste_rec = _coste_recambios_orden(o)
-        coste_ext = o.costeTallerExterno or 0.0
-        coste_ot = coste_mo + coste_rec + coste_ext
-
-        coste_total += coste_ot
-        coste_recambios_total += coste_rec
-        horas_total += horas
-
-        if o.tipo == 'correctivo':
-            coste_correctivo += coste_ot
-            horas_correctivo += horas
-        elif o.tipo == 'preventivo':
-            coste_preventivo += coste_ot
-            horas_preventivo += horas
+    total_ordenes = _total('ordenes')
+    coste_total = _total('coste')
+    coste_recambios_total = _total('coste_recambios')
+    coste_talleres_total = _total('coste_externo')
+    horas_total = _total('horas')
 
     # ── Parámetros temporales ─────────────────────────────────────────────────
     delta_dias = (fecha_fin - fecha_inicio).days + 1
 
-    # Horas operativas según el turno configurado en Configuración General
-    _TURNOS = {
-        '8/5': (8, 5), '8/6': (8, 6), '10/5': (10, 5), '12/5': (12, 5),
-        '16/5': (16, 5), '16/6': (16, 6), '12/7': (12, 7),
-        '24/5': (24, 5), '24/6': (24, 6), '24/7': (24, 7),
-    }
-    turno_key = ConfiguracionGeneral.obtener('turno_planta', '24/7')
-    horas_dia_t, dias_semana_t = _TURNOS.get(turno_key, (24, 7))
-    horas_periodo = 0.0
-    _cur = fecha_inicio
-    while _cur <= fecha_fin:
-        _dow = _cur.weekday()
-        if dias_semana_t == 7:
-            horas_periodo += horas_dia_t
-        elif dias_semana_t == 6 and _dow < 6:
-            horas_periodo += horas_dia_t
-        elif dias_semana_t == 5 and _dow < 5:
-            horas_periodo += horas_dia_t
-        _cur += timedelta(days=1)
+    # Horas operativas según el turno (de la planta o de la línea del alcance) y festivos
+    turno_key, festivos = Calendario(obtenerSnapshot()).regimen(nivel, nivel_id)
+    horas_periodo = horasOperativas(fecha_inicio, fecha_fin, turno_key, festivos)
 
     # ── Valor de stock de recambios ───────────────────────────────────────────
     valor_stock = db.session.query(
@@ -971,9 +914,8 @@ def calcular_indicadores(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
     # MTTR = horas_paro_corr / n_fallos
     # Disp = tiempo_func / horas_periodo  ← idéntico a MTBF/(MTBF+MTTR)
 
-    correctivas_con_paro = [o for o in correctivas if (o.tiempoParada or 0) > 0]
-    n_fallos          = len(correctivas_con_paro)
-    horas_paro_corr   = sum(o.tiempoParada for o in correctivas_con_paro)
+    n_fallos          = corr['fallos']
+    horas_paro_corr   = corr['horas_paro']
 
     # T1 - Disponibilidad operacional
     tiempo_func = max(horas_periodo - horas_paro_corr, 0.0)
@@ -986,32 +928,27 @@ def calcular_indicadores(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
     t4 = round(horas_paro_corr / n_fallos, 2) if n_fallos > 0 else None
 
     # T8 - % horas preventivo
-    t8 = (horas_preventivo / horas_total * 100) if horas_total > 0 else None
+    t8 = (prev['horas'] / horas_total * 100) if horas_total > 0 else None
 
     # T9 - % horas correctivo
-    t9 = (horas_correctivo / horas_total * 100) if horas_total > 0 else None
+    t9 = (corr['horas'] / horas_total * 100) if horas_total > 0 else None
 
     # T12 - Cumplimiento plan preventivo
-    prev_planificadas = [
-        o for o in preventivas
-        if o.fechaProgramada and fi <= o.fechaProgramada <= ff
-    ]
-    prev_completadas = [o for o in prev_planificadas if o.estado == 'cerrada']
     t12 = (
-        len(prev_completadas) / len(prev_planificadas) * 100
-        if prev_planificadas else None
+        prev['programadas_cerradas'] / prev['programadas'] * 100
+        if prev['programadas'] else None
     )
 
     # ── Indicadores Económicos ────────────────────────────────────────────────
 
     # RAV total (suma de rav de máquinas y elementos en scope)
-    if pares is not None:
-        maq_ids = [i for t, i in pares if t == 'maquina']
-        ele_ids = [i for t, i in pares if t == 'elemento']
+    if con_alcance:
         rav_maq = (db.session.query(func.sum(Maquina.rav))
-                   .filter(Maquina.id.in_(maq_ids)).scalar() or 0.0) if maq_ids else 0.0
+                   .filter(Maquina.id.in_(idsSubarbol(nivel, nivel_id, 'maquina')))
+                   .scalar() or 0.0)
         rav_ele = (db.session.query(func.sum(Elemento.rav))
-                   .filter(Elemento.id.in_(ele_ids)).scalar() or 0.0) if ele_ids else 0.0
+                   .filter(Elemento.id.in_(idsSubarbol(nivel, nivel_id, 'elemento')))
+                   .scalar() or 0.0)
         rav_total = rav_maq + rav_ele
     else:
         rav_total = (
@@ -1026,10 +963,10 @@ def calcular_indicadores(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
     e14 = (valor_stock / rav_total * 100) if rav_total > 0 else None
 
     # E6 - % coste correctivo
-    e6 = (coste_correctivo / coste_total * 100) if coste_total > 0 else None
+    e6 = (corr['coste'] / coste_total * 100) if coste_total > 0 else None
 
     # E7 - % coste preventivo
-    e7 = (coste_preventivo / coste_total * 100) if coste_total > 0 else None
+    e7 = (prev['coste'] / coste_total * 100) if coste_total > 0 else None
 
     # E13 - % materiales (recambios) sobre coste total
     e13 = (coste_recambios_total / coste_total * 100) if coste_total > 0 else None
@@ -1037,16 +974,12 @@ def calcular_indicadores(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
     # ── Indicadores Organizativos ─────────────────────────────────────────────
 
     # O10 - % OTs planificadas (preventivo) vs total
-    o10 = (len(preventivas) / len(ordenes) * 100) if ordenes else None
+    o10 = (prev['ordenes'] / total_ordenes * 100) if total_ordenes else None
 
     # O12 - Cumplimiento de programa (cerradas antes de su fecha programada)
-    con_prog = [o for o in ordenes if o.fechaProgramada and fi <= o.fechaProgramada <= ff]
-    completadas_en_tiempo = [
-        o for o in con_prog
-        if o.estado == 'cerrada' and o.fechaFin and o.fechaFin <= o.fechaProgramada
-    ]
+    con_prog = _total('programadas')
     o12 = (
-        len(completadas_en_tiempo) / len(con_prog) * 100
+        _total('programadas_en_plazo') / con_prog * 100
         if con_prog else None
     )
 
@@ -1059,17 +992,7 @@ def calcular_indicadores(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
         o15 = None
 
     # O18 - Calidad de datos en GMAO
-    def _ot_completa(o):
-        return (
-            o.fechaInicio is not None and
-            o.fechaFin is not None and
-            (o.tiempoReal or 0) > 0 and
-            bool(o.descripcionSolucion and o.descripcionSolucion.strip()) and
-            len(o.registrosTiempo) > 0
-        )
-
-    ots_completas = sum(1 for o in ordenes if _ot_completa(o))
-    o18 = (ots_completas / len(ordenes) * 100) if ordenes else None
+    o18 = (_total('completas') / total_ordenes * 100) if total_ordenes else None
 
     # ── Construir respuesta ───────────────────────────────────────────────────
     return {
@@ -1147,16 +1070,16 @@ def calcular_indicadores(fecha_inicio, fecha_fin, nivel=None, nivel_id=None):
             },
         },
         'resumen': {
-            'total_ordenes': len(ordenes),
-            'total_correctivas': len(correctivas),
-            'total_preventivas': len(preventivas),
+            'total_ordenes': total_ordenes,
+            'total_correctivas': corr['ordenes'],
+            'total_preventivas': prev['ordenes'],
             'horas_total': round(horas_total, 1),
             'horas_paro': round(horas_paro_corr, 1),
             'horas_periodo': horas_periodo,
             'turno_planta': turno_key,
             'coste_total': round(coste_total, 2),
             'coste_recambios': round(coste_recambios_total, 2),
-            'coste_talleres': round(sum(o.costeTallerExterno or 0 for o in ordenes), 2),
+            'coste_talleres': round(coste_talleres_total, 2),
             'valor_stock': round(valor_stock, 2),
             'delta_dias': delta_dias,
         }
@@ -8,34 +8,19 @@ El conteo es a nivel de OT (1 OT = 1 paro).
 import logging
 import math
 from calendar import monthrange
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 
-from sqlalchemy import and_, or_
+import pandas as pd
+from sqlalchemy import and_, or_, select
 
-from models import db, OrdenTrabajo, Maquina, Elemento, Linea, Zona, Planta, ConfiguracionGeneral
+from models import db, OrdenTrabajo, Maquina, Linea, Zona, Planta
+from jerarquia import obtenerSnapshot
+from calendario import Calendario
+from cache_kpis import cacheado
 
 log = logging.getLogger(__name__)
 
 
-# =============================================================================
-# MAPA DE TURNOS (igual que en dashboard_services para consistencia)
-# clave: 'horas/días' → (horas_dia, dias_semana)
-# =============================================================================
-
-_TURNOS = {
-    '8/5':  (8,  5),
-    '8/6':  (8,  6),
-    '10/5': (10, 5),
-    '12/5': (12, 5),
-    '16/5': (16, 5),
-    '16/6': (16, 6),
-    '12/7': (12, 7),
-    '24/5': (24, 5),
-    '24/6': (24, 6),
-    '24/7': (24, 7),
-}
-
-
 # =============================================================================
 # CONSTANTES — REFERENCIAS CLASE MUNDIAL (no hardcodeadas en el template)
 # =============================================================================
@@ -78,39 +63,6 @@ def _parse_fecha(s):
         return None
 
 
-def _fecha_referencia(ot):
-    """Fecha efectiva de la OT: fechaFin si existe, si no fechaCreacion."""
-    d = ot.fechaFin or ot.fechaCreacion
-    if isinstance(d, datetime):
-        return d.date()
-    if isinstance(d, date):
-        return d
-    return date.today()
-
-
-def _horas_operativas(fecha_ini: date, fecha_fin: date, turno_key: str) -> float:
-    """
-    Horas operativas reales entre dos fechas según el turno configurado en
-    ConfiguracionGeneral (clave 'turno_planta').
-
-    Si dias_semana < 7 solo cuenta los días laborables:
-      /5 → lun-vie, /6 → lun-sáb, /7 → todos los días.
-    """
-    horas_dia, dias_semana = _TURNOS.get(turno_key, (24, 7))
-    total = 0.0
-    current = fecha_ini
-    while current <= fecha_fin:
-        dow = current.weekday()  # 0=lun … 6=dom
-        if dias_semana == 7:
-            total += horas_dia
-        elif dias_semana == 6 and dow < 6:   # lun-sáb
-            total += horas_dia
-        elif dias_semana == 5 and dow < 5:   # lun-vie
-            total += horas_dia
-        current += timedelta(days=1)
-    return total
-
-
 def _dias_periodo(fecha_ini: date, fecha_fin: date) -> int:
     return (fecha_fin - fecha_ini).days + 1
 
@@ -299,59 +251,20 @@ def _calcular_benchmarking(kpis: dict) -> dict:
     return {'rows': rows, 'kpis_globales': kpis}
 
 
-# =============================================================================
-# RESOLUCIÓN DE JERARQUÍA
-# =============================================================================
-
-def _precargar_jerarquia():
-    """Carga en memoria los modelos de jerarquía para evitar N+1 queries."""
-    maquinas = {m.id: m for m in Maquina.query.all()}
-    elementos = {e.id: e for e in Elemento.query.all()}
-    lineas   = {l.id: l for l in Linea.query.all()}
-    return maquinas, elementos, lineas
-
-
-def _resolver_linea_maquina(ot, maquinas: dict, elementos: dict):
-    """
-    Devuelve (linea_id, maquina_id, maquina_nombre) para una OT.
-    Sube la jerarquía desde el equipoTipo/equipoId.
-    """
-    et  = ot.equipoTipo
-    eid = ot.equipoId
-
-    if et == 'maquina':
-        maq = maquinas.get(eid)
-        if maq:
-            return maq.lineaId, maq.id, maq.nombre
-
-    elif et == 'elemento':
-        elem = elementos.get(eid)
-        if elem:
-            maq = maquinas.get(elem.maquinaId)
-            if maq:
-                return maq.lineaId, maq.id, maq.nombre
-
-    elif et == 'linea':
-        return eid, None, ''
-
-    # Fallback al campo legacy maquinaId
-    if ot.maquinaId:
-        maq = maquinas.get(ot.maquinaId)
-        if maq:
-            return maq.lineaId, maq.id, maq.nombre
-
-    return None, None, ''
-
-
 # =============================================================================
 # CONSULTA PRINCIPAL
 # =============================================================================
 
-def _query_paros(fecha_ini: date, fecha_fin: date):
+def _query_paros(fecha_ini: date, fecha_fin: date, plantas_ids=None, zonas_ids=None,
+                 lineas_ids=None, maquinas_ids=None):
     """
-    Devuelve todas las OTs que son paros de producción en el rango de fechas dado.
+    DataFrame (fecha, linea, maquina, horas) con las OTs que son paros de
+    producción en el rango de fechas dado, ordenadas por id.
     Filtro fijo: tipo='correctivo' AND tiempoParada > 0.
     Fecha de referencia: fechaFin si existe, si no fechaCreacion.
+    Los filtros de jerarquía usan las columnas desnormalizadas de la OT; como
+    los paros se agrupan por línea, con filtro de planta o zona solo cuentan
+    las OTs resueltas a una línea.
     """
     fi_dt = datetime.combine(fecha_ini, datetime.min.time())
     ff_dt = datetime.combine(fecha_fin, datetime.max.time())
@@ -369,17 +282,51 @@ def _query_paros(fecha_ini: date, fecha_fin: date):
         ),
     )
 
-    return OrdenTrabajo.query.filter(
+    q = select(
+        OrdenTrabajo.fechaFin, OrdenTrabajo.fechaCreacion,
+        OrdenTrabajo.lineaId, OrdenTrabajo.maquinaRefId, OrdenTrabajo.tiempoParada,
+    ).where(
         OrdenTrabajo.tipo == 'correctivo',
         OrdenTrabajo.tiempoParada > 0,
         date_filter,
-    ).all()
+    )
+    if plantas_ids or zonas_ids:
+        q = q.where(OrdenTrabajo.lineaId.isnot(None))
+    if plantas_ids:
+        q = q.where(OrdenTrabajo.plantaId.in_(plantas_ids))
+    if zonas_ids:
+        q = q.where(OrdenTrabajo.zonaId.in_(zonas_ids))
+    if lineas_ids:
+        q = q.where(OrdenTrabajo.lineaId.in_(lineas_ids))
+    if maquinas_ids:
+        q = q.where(OrdenTrabajo.maquinaRefId.in_(maquinas_ids))
+    # Orden estable: los empates del top 10 se resuelven por antigüedad de la OT
+    filas = db.session.execute(q.order_by(OrdenTrabajo.id)).all()
+
+    df = pd.DataFrame(filas, columns=['fechaFin', 'fechaCreacion', 'linea', 'maquina', 'horas'])
+    fecha = pd.to_datetime(df['fechaFin']).fillna(pd.to_datetime(df['fechaCreacion']))
+    return pd.DataFrame({
+        'fecha':   fecha,
+        'linea':   df['linea'].astype('Int64'),
+        'maquina': df['maquina'].astype('Int64'),
+        'horas':   df['horas'].astype(float).fillna(0.0),
+    })
+
+
+def _acumular(df: pd.DataFrame, claves: list) -> dict:
+    """{clave(s): {'n_paros', 'h_paros'}} agrupando los paros por las columnas dadas."""
+    g = df.groupby(claves, sort=False)['horas'].agg(['size', 'sum'])
+    return {
+        k: {'n_paros': int(n), 'h_paros': float(h)}
+        for k, n, h in zip(g.index.tolist(), g['size'].tolist(), g['sum'].tolist())
+    }
 
 
 # =============================================================================
 # PUNTO DE ENTRADA PRINCIPAL
 # =============================================================================
 
+@cacheado('paros')
 def calcular_paros(
     fecha_ini: date,
     fecha_fin: date,
@@ -392,8 +339,9 @@ def calcular_paros(
     """
     Calcula todos los KPIs de paros de producción.
 
-    El régimen de turnos (horas calendario) se lee automáticamente de
-    ConfiguracionGeneral (clave 'turno_planta').
+    El régimen de turnos (horas calendario) es el de la planta
+    (ConfiguracionGeneral 'turno_planta') o el propio de cada línea, descontando
+    los festivos de su planta (calendario.py).
 
     Parámetros
     ----------
@@ -408,16 +356,14 @@ def calcular_paros(
     -------
     dict con claves: periodos_labels, periodos_keys, global, por_grupo, top10, benchmarking
     """
-    turno_key = ConfiguracionGeneral.obtener('turno_planta', '24/7')
-    # 1. Cargar OTs base
-    ots_all = _query_paros(fecha_ini, fecha_fin)
-
-    # 2. Cargar jerarquía una vez
-    maquinas, elementos, lineas_dict = _precargar_jerarquia()
-    zonas_dict  = {z.id: z for z in Zona.query.all()}
-    plantas_dict = {p.id: p for p in Planta.query.all()}
-
-    # 3. Construir sets de filtro — resolver cadena Planta→Zona→Línea
+    # 1. Jerarquía desde el snapshot compartido (sin recargar tablas)
+    jer = obtenerSnapshot()
+    calendario = Calendario(jer)
+    turno_key = calendario.turno
+    maquinas, lineas_dict = jer.maquinas, jer.lineas
+    zonas_dict  = jer.zonas
+
+    # 2. Construir sets de filtro — resolver cadena Planta→Zona→Línea
     # Si se filtra por planta/zona, expandimos a lineas_ids automáticamente
     lineas_set   = set(lineas_ids)   if lineas_ids   else None
     maquinas_set = set(maquinas_ids) if maquinas_ids else None
@@ -425,6 +371,7 @@ def calcular_paros(
     zonas_set    = set(zonas_ids)    if zonas_ids    else None
 
     # Si hay filtro de Planta o Zona, calculamos el conjunto de lineas válidas
+    # (determina la agrupación por máquina y se informa en filtros_aplicados)
     if plantas_set or zonas_set:
         lineas_validas = set()
         for lid, linea in lineas_dict.items():
@@ -439,14 +386,9 @@ def calcular_paros(
         # Intersectar con filtro de linea explícito si existe
         lineas_set = (lineas_set & lineas_validas) if lineas_set else lineas_validas
 
-    ots = []
-    for ot in ots_all:
-        lid, mid, _ = _resolver_linea_maquina(ot, maquinas, elementos)
-        if lineas_set   and lid not in lineas_set:
-            continue
-        if maquinas_set and mid not in maquinas_set:
-            continue
-        ots.append(ot)
+    # 3. Cargar OTs ya filtradas en SQL por las columnas de jerarquía de la OT
+    df = _query_paros(fecha_ini, fecha_fin, plantas_set, zonas_set,
+                      lineas_ids, maquinas_set)
 
     # 4. Generar periodos
     periodos = (
@@ -455,67 +397,49 @@ def calcular_paros(
         else _periodos_mensuales(fecha_ini, fecha_fin)
     )
 
-    # 5. Inicializar acumuladores
-    periodo_global  = {key: {'n_paros': 0, 'h_paros': 0.0} for key, *_ in periodos}
-    periodo_linea   = {key: {} for key, *_ in periodos}
-    periodo_maquina = {key: {} for key, *_ in periodos}
-    top_acum        = {}   # (lid, mid) → acumulado total del periodo completo
-
-    def _acum(d: dict, k, h: float):
-        if k not in d:
-            d[k] = {'n_paros': 0, 'h_paros': 0.0}
-        d[k]['n_paros'] += 1
-        d[k]['h_paros'] += h
-
-    # 6. Distribuir cada OT en su periodo
-    for ot in ots:
-        ref_date = _fecha_referencia(ot)
-        p_key = None
-        for key, _label, p_ini, p_fin in periodos:
-            if p_ini <= ref_date <= p_fin:
-                p_key = key
-                break
-        if p_key is None:
-            continue
-
-        h   = float(ot.tiempoParada or 0.0)
-        lid, mid, maq_nombre = _resolver_linea_maquina(ot, maquinas, elementos)
-
-        # Global
-        pg = periodo_global[p_key]
-        pg['n_paros'] += 1
-        pg['h_paros'] += h
-
-        # Por línea
-        if lid:
-            _acum(periodo_linea[p_key], lid, h)
-
-        # Por máquina
-        if mid:
-            _acum(periodo_maquina[p_key], mid, h)
-
-        # Top acumulado (nivel de OT, periodo completo)
-        tk = (lid, mid)
-        if tk not in top_acum:
-            linea_nom = lineas_dict[lid].nombre if lid and lid in lineas_dict else 'Sin línea'
-            top_acum[tk] = {
-                'linea_id':   lid,
-                'maquina_id': mid,
-                'linea':      linea_nom,
-                'maquina':    maq_nombre,
-                'n_paros':    0,
-                'h_paros':    0.0,
-            }
-        top_acum[tk]['n_paros'] += 1
-        top_acum[tk]['h_paros'] += h
+    # 5. Asignar cada paro a su periodo (mes o año de la fecha de referencia)
+    claves = [key for key, *_ in periodos]
+    df['periodo'] = df['fecha'].dt.to_period('Y' if agrupacion == 'anual' else 'M').astype(str)
+    df = df[df['periodo'].isin(claves)]
+
+    # 6. Acumular por periodo, por (periodo, línea), por (periodo, máquina) y
+    #    por (línea, máquina) para el top, con un groupby cada uno
+    periodo_global  = {key: {'n_paros': 0, 'h_paros': 0.0} for key in claves}
+    periodo_global.update(_acumular(df, ['periodo']))
+    periodo_linea   = {key: {} for key in claves}
+    for (key, lid), acc in _acumular(df.dropna(subset=['linea']), ['periodo', 'linea']).items():
+        periodo_linea[key][lid] = acc
+    periodo_maquina = {key: {} for key in claves}
+    for (key, mid), acc in _acumular(df.dropna(subset=['maquina']), ['periodo', 'maquina']).items():
+        periodo_maquina[key][mid] = acc
+
+    # Top acumulado (nivel de OT, periodo completo), en orden de primera aparición
+    top_acum = {}
+    top = df.fillna({'linea': 0, 'maquina': 0})
+    for (lid, mid), acc in _acumular(top, ['linea', 'maquina']).items():
+        lid, mid = lid or None, mid or None
+        top_acum[(lid, mid)] = {
+            'linea_id':   lid,
+            'maquina_id': mid,
+            'linea':      lineas_dict[lid].nombre if lid and lid in lineas_dict else 'Sin línea',
+            'maquina':    maquinas[mid].nombre if mid in maquinas else '',
+            **acc,
+        }
 
     # ─────────────────────────────────────────────────────────────────────────
     # SECCIÓN 1 — Indicadores globales por periodo
     # ─────────────────────────────────────────────────────────────────────────
+    # Calendario de la única línea o planta filtrada; si no, el de la planta
+    if lineas_ids and len(lineas_ids) == 1:
+        alcance_global = ('linea', lineas_ids[0])
+    elif plantas_set and len(plantas_set) == 1:
+        alcance_global = ('planta', next(iter(plantas_set)))
+    else:
+        alcance_global = (None, None)
     global_data = []
     for key, label, p_ini, p_fin in periodos:
         pg   = periodo_global[key]
-        h_cal = _horas_operativas(p_ini, p_fin, turno_key)
+        h_cal = calendario.horas(p_ini, p_fin, *alcance_global)
         dias  = _dias_periodo(p_ini, p_fin)
         kpis  = _calcular_kpis_periodo(pg['n_paros'], pg['h_paros'], h_cal, dias)
         kpis['key']   = key
@@ -551,7 +475,7 @@ def calcular_paros(
         periodos_grupo = []
         for key, label, p_ini, p_fin in periodos:
             pg    = acc_src[key].get(gid, {'n_paros': 0, 'h_paros': 0.0})
-            h_cal = _horas_operativas(p_ini, p_fin, turno_key)
+            h_cal = calendario.horas(p_ini, p_fin, agrupado_por, gid)
             dias  = _dias_periodo(p_ini, p_fin)
             kpis  = _calcular_kpis_periodo(pg['n_paros'], pg['h_paros'], h_cal, dias)
             kpis['key']   = key
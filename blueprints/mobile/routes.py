@@ -14,6 +14,7 @@ from models import (
     GamaMantenimiento, ChecklistItem, RespuestaChecklist,
     TareaRealizada, db
 )
+from jerarquia import obtenerRuta, obtenerRutas, filtroSubarbol, idsSubarbol
 
 
 # ---------------------------------------------------------------------------
@@ -34,78 +35,41 @@ def _nombre_tecnico(user):
 
 def _get_ruta_nombres(equipoTipo, equipoId):
     """
-    Retorna lista de dicts {nombre, tipo} desde Planta hasta el equipo,
+    Retorna lista de dicts {nombre, codigo, tipo} desde Planta hasta el equipo,
     excluyendo niveles Empresa (muy genérico para espacio en pantalla).
     """
-    if not equipoTipo or not equipoId:
-        return []
-
-    ruta = []
-
-    if equipoTipo == 'elemento':
-        elem = Elemento.query.get(equipoId)
-        if elem:
-            ruta.append({'nombre': elem.nombre, 'codigo': elem.codigo, 'tipo': 'elemento'})
-            maq = Maquina.query.get(elem.maquinaId)
-            if maq:
-                ruta.insert(0, {'nombre': maq.nombre, 'codigo': maq.codigo, 'tipo': 'maquina'})
-                _add_superior_maquina(maq, ruta)
-
-    elif equipoTipo == 'maquina':
-        maq = Maquina.query.get(equipoId)
-        if maq:
-            ruta.append({'nombre': maq.nombre, 'codigo': maq.codigo, 'tipo': 'maquina'})
-            _add_superior_maquina(maq, ruta)
-
-    elif equipoTipo == 'linea':
-        linea = Linea.query.get(equipoId)
-        if linea:
-            ruta.append({'nombre': linea.nombre, 'codigo': linea.codigo, 'tipo': 'linea'})
-            _add_superior_linea(linea, ruta)
-
-    elif equipoTipo == 'zona':
-        zona = Zona.query.get(equipoId)
-        if zona:
-            ruta.append({'nombre': zona.nombre, 'codigo': zona.codigo, 'tipo': 'zona'})
-            planta = Planta.query.get(zona.plantaId)
-            if planta:
-                ruta.insert(0, {'nombre': planta.nombre, 'codigo': planta.codigo, 'tipo': 'planta'})
-
-    elif equipoTipo == 'planta':
-        planta = Planta.query.get(equipoId)
-        if planta:
-            ruta.append({'nombre': planta.nombre, 'codigo': planta.codigo, 'tipo': 'planta'})
-
-    return ruta
-
-
-def _add_superior_maquina(maq, ruta):
-    linea = Linea.query.get(maq.lineaId)
-    if linea:
-        ruta.insert(0, {'nombre': linea.nombre, 'codigo': linea.codigo, 'tipo': 'linea'})
-        _add_superior_linea(linea, ruta)
-
-
-def _add_superior_linea(linea, ruta):
-    zona = Zona.query.get(linea.zonaId)
-    if zona:
-        ruta.insert(0, {'nombre': zona.nombre, 'codigo': zona.codigo, 'tipo': 'zona'})
-        planta = Planta.query.get(zona.plantaId)
-        if planta:
-            ruta.insert(0, {'nombre': planta.nombre, 'codigo': planta.codigo, 'tipo': 'planta'})
-
-
-def _enrich_ot(ot):
-    """Añade equipoRutaNombres y nombre corto del equipo a un OT."""
-    equipoTipo = ot.equipoTipo or ('maquina' if ot.maquinaId else None)
-    equipoId = ot.equipoId or ot.maquinaId
-    ruta = _get_ruta_nombres(equipoTipo, equipoId)
+    ruta = obtenerRuta(equipoTipo, equipoId)
+    return ruta.rutaNombresLista if ruta else []
+
+
+def _equipo_efectivo(ot):
+    """(tipo, id) del equipo de la OT, con fallback al campo legacy maquinaId."""
+    return ot.equipoTipo or ('maquina' if ot.maquinaId else None), ot.equipoId or ot.maquinaId
+
+
+def _enrich_ot(ot, rutas=None):
+    """
+    Añade equipoRutaNombres y nombre corto del equipo a un OT.
+    `rutas` es el lote precargado con obtenerRutas (listados).
+    """
+    equipoTipo, equipoId = _equipo_efectivo(ot)
+    if rutas is not None:
+        r = rutas.get((equipoTipo, equipoId))
+        ruta = r.rutaNombresLista if r else []
+    else:
+        ruta = _get_ruta_nombres(equipoTipo, equipoId)
     ot._ruta = ruta
     ot._equipoTipoEfectivo = equipoTipo
     ot._equipoIdEfectivo = equipoId
     return ot
 
 
+def _enrich_ots(ots):
+    """Enriquece una lista de OTs resolviendo todas las rutas en una consulta."""
+    rutas = obtenerRutas(_equipo_efectivo(o) for o in ots)
+    return [_enrich_ot(o, rutas) for o in ots]
+
+
 # ---------------------------------------------------------------------------
 # Decorator
 # ---------------------------------------------------------------------------
@@ -163,7 +127,7 @@ def _queries_ot(nombre_tecnico, tipo):
         OrdenTrabajo.estado.in_(['pendiente', 'asignada', 'en_curso'])
     ).order_by(estado_order, prio_order, OrdenTrabajo.fechaCreacion.desc()).all()
 
-    return [_enrich_ot(o) for o in mis], [_enrich_ot(o) for o in pendientes]
+    return _enrich_ots(mis), _enrich_ots(pendientes)
 
 
 @bp.route('/')
@@ -330,75 +294,23 @@ def qr_result(equipo_tipo, equipo_id):
 
     ruta = _get_ruta_nombres(equipo_tipo, equipo_id)
 
-    # Recoger todos los pares (tipo, id) del activo y sus hijos
-    targets = _get_descendant_targets(equipo_tipo, equipo_id)
-
-    # Construir condiciones de filtro
-    condiciones = []
-    for t_tipo, t_id in targets:
-        condiciones.append(
-            and_(OrdenTrabajo.equipoTipo == t_tipo, OrdenTrabajo.equipoId == t_id)
-        )
-        # Campo legacy maquinaId
-        if t_tipo == 'maquina':
-            condiciones.append(OrdenTrabajo.maquinaId == t_id)
-
-    ots = []
-    if condiciones:
-        ots = OrdenTrabajo.query.filter(
-            OrdenTrabajo.estado.in_(['pendiente', 'asignada', 'en_curso']),
-            or_(*condiciones),
-        ).order_by(OrdenTrabajo.fechaCreacion.desc()).all()
-        for ot in ots:
-            _enrich_ot(ot)
+    # OTs abiertas del activo y de todo lo que cuelga de él (incluido el campo
+    # legacy maquinaId), con un único predicado sobre el índice de rutas
+    ots = OrdenTrabajo.query.filter(
+        OrdenTrabajo.estado.in_(['pendiente', 'asignada', 'en_curso']),
+        or_(
+            filtroSubarbol(equipo_tipo, equipo_id,
+                           OrdenTrabajo.equipoTipo, OrdenTrabajo.equipoId),
+            OrdenTrabajo.maquinaId.in_(idsSubarbol(equipo_tipo, equipo_id, 'maquina')),
+        ),
+    ).order_by(OrdenTrabajo.fechaCreacion.desc()).all()
+    _enrich_ots(ots)
 
     return render_template('mobile/qr_result.html',
                            activo_nombre=activo.nombre, equipo_tipo=equipo_tipo,
                            equipo_id=equipo_id, ruta=ruta, ots=ots)
 
 
-def _get_descendant_targets(equipo_tipo, equipo_id):
-    """Retorna lista de tuplas (tipo, id) del activo y todos sus descendientes."""
-    targets = [(equipo_tipo, equipo_id)]
-
-    if equipo_tipo == 'elemento':
-        return targets
-
-    if equipo_tipo == 'maquina':
-        for e in Elemento.query.filter_by(maquinaId=equipo_id):
-            targets.append(('elemento', e.id))
-        return targets
-
-    if equipo_tipo == 'linea':
-        for m in Maquina.query.filter_by(lineaId=equipo_id):
-            targets.append(('maquina', m.id))
-            for e in Elemento.query.filter_by(maquinaId=m.id):
-                targets.append(('elemento', e.id))
-        return targets
-
-    if equipo_tipo == 'zona':
-        for l in Linea.query.filter_by(zonaId=equipo_id):
-            targets.append(('linea', l.id))
-            for m in Maquina.query.filter_by(lineaId=l.id):
-                targets.append(('maquina', m.id))
-                for e in Elemento.query.filter_by(maquinaId=m.id):
-                    targets.append(('elemento', e.id))
-        return targets
-
-    if equipo_tipo == 'planta':
-        for z in Zona.query.filter_by(plantaId=equipo_id):
-            targets.append(('zona', z.id))
-            for l in Linea.query.filter_by(zonaId=z.id):
-                targets.append(('linea', l.id))
-                for m in Maquina.query.filter_by(lineaId=l.id):
-                    targets.append(('maquina', m.id))
-                    for e in Elemento.query.filter_by(maquinaId=m.id):
-                        targets.append(('elemento', e.id))
-        return targets
-
-    return targets
-
-
 # ---------------------------------------------------------------------------
 # Mini API para la vista móvil
 # ---------------------------------------------------------------------------
@@ -412,69 +324,18 @@ def api_qr_jerarquia():
     if not tipo or not eid:
         return jsonify({'error': 'Parámetros requeridos'}), 400
 
-    result = {'planta': None, 'zona': None, 'linea': None, 'maquina': None, 'elemento': None}
-
-    if tipo == 'elemento':
-        elem = Elemento.query.get(eid)
-        if not elem:
-            return jsonify({'error': 'No encontrado'}), 404
-        result['elemento'] = {'id': elem.id, 'nombre': elem.nombre}
-        maq = Maquina.query.get(elem.maquinaId)
-        if maq:
-            result['maquina'] = {'id': maq.id, 'nombre': maq.nombre}
-            _fill_jerarquia_up(maq, result)
-
-    elif tipo == 'maquina':
-        maq = Maquina.query.get(eid)
-        if not maq:
-            return jsonify({'error': 'No encontrado'}), 404
-        result['maquina'] = {'id': maq.id, 'nombre': maq.nombre}
-        _fill_jerarquia_up(maq, result)
-
-    elif tipo == 'linea':
-        lin = Linea.query.get(eid)
-        if not lin:
-            return jsonify({'error': 'No encontrado'}), 404
-        result['linea'] = {'id': lin.id, 'nombre': lin.nombre}
-        zona = Zona.query.get(lin.zonaId)
-        if zona:
-            result['zona'] = {'id': zona.id, 'nombre': zona.nombre}
-            planta = Planta.query.get(zona.plantaId)
-            if planta:
-                result['planta'] = {'id': planta.id, 'nombre': planta.nombre}
-
-    elif tipo == 'zona':
-        z = Zona.query.get(eid)
-        if not z:
-            return jsonify({'error': 'No encontrado'}), 404
-        result['zona'] = {'id': z.id, 'nombre': z.nombre}
-        planta = Planta.query.get(z.plantaId)
-        if planta:
-            result['planta'] = {'id': planta.id, 'nombre': planta.nombre}
-
-    elif tipo == 'planta':
-        p = Planta.query.get(eid)
-        if not p:
-            return jsonify({'error': 'No encontrado'}), 404
-        result['planta'] = {'id': p.id, 'nombre': p.nombre}
-
-    else:
+    if tipo not in ('planta', 'zona', 'linea', 'maquina', 'elemento'):
         return jsonify({'error': 'Tipo no válido'}), 400
 
-    return jsonify(result)
+    ruta = obtenerRuta(tipo, eid)
+    if not ruta:
+        return jsonify({'error': 'No encontrado'}), 404
 
+    result = {'planta': None, 'zona': None, 'linea': None, 'maquina': None, 'elemento': None}
+    for nivel in ruta.rutaNombresLista:
+        result[nivel['tipo']] = {'id': nivel['id'], 'nombre': nivel['nombre']}
 
-def _fill_jerarquia_up(maq, result):
-    """Rellena la jerarquía hacia arriba desde una máquina."""
-    lin = Linea.query.get(maq.lineaId)
-    if lin:
-        result['linea'] = {'id': lin.id, 'nombre': lin.nombre}
-        zona = Zona.query.get(lin.zonaId)
-        if zona:
-            result['zona'] = {'id': zona.id, 'nombre': zona.nombre}
-            planta = Planta.query.get(zona.plantaId)
-            if planta:
-                result['planta'] = {'id': planta.id, 'nombre': planta.nombre}
+    return jsonify(result)
 
 
 @bp.route('/api/recambios')
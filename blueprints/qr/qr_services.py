@@ -8,7 +8,8 @@ from reportlab.lib.units import mm
 from reportlab.lib import colors
 from reportlab.pdfgen import canvas as pdf_canvas
 
-from models import Planta, Zona, Linea, Maquina, Elemento
+from models import Planta, Zona, Linea, Maquina
+from jerarquia import rutasSubarbol
 
 
 # ─── Generación QR ───────────────────────────────────────────────────────────
@@ -34,69 +35,27 @@ def get_activos_filtrados(planta_id=None, zona_id=None, linea_id=None, maquina_i
     Devuelve lista de dicts {equipoTipo, equipoId, codigo, nombre}
     para todos los activos bajo la selección (desciende la jerarquía completa).
     """
-    activos = []
-
-    if maquina_id:
-        maq = Maquina.query.get(maquina_id)
-        if maq:
-            activos.append(_activo_dict('maquina', maq))
-            for e in Elemento.query.filter_by(maquinaId=maq.id).order_by(Elemento.nombre):
-                activos.append(_activo_dict('elemento', e))
-        return activos
-
-    if linea_id:
-        lin = Linea.query.get(linea_id)
-        if lin:
-            activos.append(_activo_dict('linea', lin))
-            _add_maquinas_linea(lin.id, activos)
-        return activos
-
-    if zona_id:
-        z = Zona.query.get(zona_id)
-        if z:
-            activos.append(_activo_dict('zona', z))
-            for lin in Linea.query.filter_by(zonaId=z.id).order_by(Linea.nombre):
-                activos.append(_activo_dict('linea', lin))
-                _add_maquinas_linea(lin.id, activos)
-        return activos
-
-    if planta_id:
-        p = Planta.query.get(planta_id)
-        if p:
-            activos.append(_activo_dict('planta', p))
-            for z in Zona.query.filter_by(plantaId=p.id).order_by(Zona.nombre):
-                activos.append(_activo_dict('zona', z))
-                for lin in Linea.query.filter_by(zonaId=z.id).order_by(Linea.nombre):
-                    activos.append(_activo_dict('linea', lin))
-                    _add_maquinas_linea(lin.id, activos)
-        return activos
-
-    # Sin filtro: todas las plantas y descendientes
-    for p in Planta.query.order_by(Planta.nombre):
-        activos.append(_activo_dict('planta', p))
-        for z in Zona.query.filter_by(plantaId=p.id).order_by(Zona.nombre):
-            activos.append(_activo_dict('zona', z))
-            for lin in Linea.query.filter_by(zonaId=z.id).order_by(Linea.nombre):
-                activos.append(_activo_dict('linea', lin))
-                _add_maquinas_linea(lin.id, activos)
-
-    return activos
-
-
-def _add_maquinas_linea(linea_id, activos):
-    for maq in Maquina.query.filter_by(lineaId=linea_id).order_by(Maquina.nombre):
-        activos.append(_activo_dict('maquina', maq))
-        for e in Elemento.query.filter_by(maquinaId=maq.id).order_by(Elemento.nombre):
-            activos.append(_activo_dict('elemento', e))
-
-
-def _activo_dict(tipo, obj):
-    return {
-        'equipoTipo': tipo,
-        'equipoId': obj.id,
-        'codigo': obj.codigo,
-        'nombre': obj.nombre,
-    }
+    for tipo, equipo_id in (('maquina', maquina_id), ('linea', linea_id),
+                            ('zona', zona_id), ('planta', planta_id)):
+        if equipo_id:
+            rutas = rutasSubarbol(tipo, equipo_id)
+            break
+    else:
+        # Sin filtro: todas las plantas y descendientes
+        rutas = rutasSubarbol()
+
+    rutas.sort(key=_orden_arbol)
+    return [{
+        'equipoTipo': r.tipo,
+        'equipoId': r.equipoId,
+        'codigo': r.codigo,
+        'nombre': r.nombre,
+    } for r in rutas]
+
+
+def _orden_arbol(ruta):
+    """Recorrido en profundidad con hermanos por nombre (el padre es prefijo del hijo)."""
+    return [(n['nombre'], n['id']) for n in ruta.rutaNombresLista]
 
 
 # ─── Helpers para filtros cascada ────────────────────────────────────────────
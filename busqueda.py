@@ -0,0 +1,137 @@
+"""
+Búsqueda de texto completo sobre las órdenes de trabajo (FTS5).
+
+La tabla virtual orden_trabajo_fts indexa título, descripción del problema,
+solución y observaciones de cada OT. Es de contenido externo (el texto se lee
+de orden_trabajo), así que solo guarda el índice invertido. La mantienen
+triggers de SQLite en la misma transacción que escribe la OT: altas (también
+las del importador histórico, que el propio FTS5 acumula en memoria y vuelca
+de una vez al confirmar), bajas y cambios de esos cuatro campos. El coste de
+una búsqueda depende de cuántas OTs contienen los términos, no del tamaño del
+histórico.
+
+Si la versión de SQLite no incluye FTS5 se busca con LIKE (sin resaltado).
+"""
+import html
+import re
+
+from sqlalchemy import or_, text
+
+from models import db, OrdenTrabajo
+
+
+_CAMPOS_FTS = ('titulo', 'descripcionProblema', 'descripcionSolucion', 'observaciones')
+_COLUMNAS = ', '.join(_CAMPOS_FTS)
+_NUEVOS = ', '.join(f'new.{c}' for c in _CAMPOS_FTS)
+_ANTIGUOS = ', '.join(f'old.{c}' for c in _CAMPOS_FTS)
+
+_SQL_INDICE_ORDENES = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS orden_trabajo_fts USING fts5({_COLUMNAS}, "
+    "content = 'orden_trabajo', content_rowid = 'id', "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    "CREATE TRIGGER IF NOT EXISTS orden_trabajo_fts_ai AFTER INSERT ON orden_trabajo BEGIN "
+    f"INSERT INTO orden_trabajo_fts(rowid, {_COLUMNAS}) VALUES (new.id, {_NUEVOS}); END",
+    "CREATE TRIGGER IF NOT EXISTS orden_trabajo_fts_ad AFTER DELETE ON orden_trabajo BEGIN "
+    f"INSERT INTO orden_trabajo_fts(orden_trabajo_fts, rowid, {_COLUMNAS}) "
+    f"VALUES ('delete', old.id, {_ANTIGUOS}); END",
+    # Solo al cambiar el texto: los cambios de estado, fechas... no tocan el índice
+    f"CREATE TRIGGER IF NOT EXISTS orden_trabajo_fts_au AFTER UPDATE OF {_COLUMNAS} "
+    "ON orden_trabajo BEGIN "
+    f"INSERT INTO orden_trabajo_fts(orden_trabajo_fts, rowid, {_COLUMNAS}) "
+    f"VALUES ('delete', old.id, {_ANTIGUOS}); "
+    f"INSERT INTO orden_trabajo_fts(rowid, {_COLUMNAS}) VALUES (new.id, {_NUEVOS}); END",
+]
+
+# Delimitadores de resaltado que no aparecen en texto normal; se sustituyen por
+# <mark> después de escapar el HTML del contenido
+_INI, _FIN = '\x02', '\x03'
+
+# None = sin comprobar; False si no existe el índice (BD sin FTS5)
+_indiceOrdenes = None
+
+
+def crearIndiceOrdenes(conexion):
+    """
+    Crea el índice FTS5 y sus triggers y lo carga con todo el histórico en una
+    sola pasada ('rebuild'). Devuelve False si SQLite no incluye FTS5.
+    """
+    global _indiceOrdenes
+    if conexion.dialect.name != 'sqlite':
+        return False
+    try:
+        for sql in _SQL_INDICE_ORDENES:
+            conexion.exec_driver_sql(sql)
+    except Exception as e:
+        print(f"Índice FTS5 de órdenes no disponible, se usará LIKE: {e}")
+        return False
+    conexion.exec_driver_sql("INSERT INTO orden_trabajo_fts(orden_trabajo_fts) VALUES ('rebuild')")
+    _indiceOrdenes = True
+    return True
+
+
+def _hayIndiceOrdenes():
+    global _indiceOrdenes
+    if _indiceOrdenes is None:
+        _indiceOrdenes = db.session.execute(text(
+            "SELECT count(*) FROM sqlite_master WHERE name = 'orden_trabajo_fts'"
+        )).scalar() > 0 if db.engine.dialect.name == 'sqlite' else False
+    return _indiceOrdenes
+
+
+def _resaltado(fragmento):
+    """Escapa el HTML del fragmento y convierte los delimitadores en <mark>"""
+    return html.escape(fragmento or '').replace(_INI, '<mark>').replace(_FIN, '</mark>')
+
+
+def buscarOrdenes(texto, limite=20, desplazamiento=0, tipo=None, estado=None):
+    """
+    OTs que contienen todos los términos (como prefijo de palabra) en título,
+    problema, solución u observaciones, por relevancia BM25 (el título pesa más).
+    Devuelve [(OrdenTrabajo, tituloHtml, fragmentoHtml)] con los términos
+    marcados con <mark>; pide `limite` filas a partir de `desplazamiento`.
+    """
+    terminos = re.findall(r'\w+', texto or '')
+    if not terminos:
+        return []
+
+    if _hayIndiceOrdenes():
+        filtros = ''
+        parametros = {
+            'consulta': ' '.join(f'"{t}"*' for t in terminos),
+            'limite': limite, 'desplazamiento': desplazamiento,
+            'ini': _INI, 'fin': _FIN,
+        }
+        if tipo:
+            filtros += ' AND orden_trabajo.tipo = :tipo'
+            parametros['tipo'] = tipo
+        if estado:
+            filtros += ' AND orden_trabajo.estado = :estado'
+            parametros['estado'] = estado
+        filas = db.session.execute(text(
+            'SELECT orden_trabajo_fts.rowid, '
+            'highlight(orden_trabajo_fts, 0, :ini, :fin), '
+            "snippet(orden_trabajo_fts, -1, :ini, :fin, '…', 16) "
+            'FROM orden_trabajo_fts '
+            'JOIN orden_trabajo ON orden_trabajo.id = orden_trabajo_fts.rowid '
+            f'WHERE orden_trabajo_fts MATCH :consulta{filtros} '
+            'ORDER BY bm25(orden_trabajo_fts, 10.0, 4.0, 4.0, 1.0), orden_trabajo_fts.rowid DESC '
+            'LIMIT :limite OFFSET :desplazamiento'
+        ), parametros).all()
+        ordenes = {o.id: o for o in OrdenTrabajo.query.filter(
+            OrdenTrabajo.id.in_([f[0] for f in filas]))}
+        return [(ordenes[id], _resaltado(titulo), _resaltado(fragmento))
+                for id, titulo, fragmento in filas if id in ordenes]
+
+    # Sin FTS5: subcadena en cualquiera de los campos, más recientes primero
+    query = OrdenTrabajo.query
+    for t in terminos:
+        patron = f'%{t}%'
+        query = query.filter(or_(*(getattr(OrdenTrabajo, c).ilike(patron) for c in _CAMPOS_FTS)))
+    if tipo:
+        query = query.filter(OrdenTrabajo.tipo == tipo)
+    if estado:
+        query = query.filter(OrdenTrabajo.estado == estado)
+    ordenes = query.order_by(OrdenTrabajo.fechaCreacion.desc(), OrdenTrabajo.id.desc()).offset(
+        desplazamiento).limit(limite).all()
+    return [(o, html.escape(o.titulo or ''), html.escape((o.descripcionProblema or '')[:160]))
+            for o in ordenes]
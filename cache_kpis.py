@@ -0,0 +1,262 @@
+"""
+Caché de resultados de los servicios de KPIs (tabla resultado_kpi).
+
+Los KPIs, el análisis de paros y los dashboards se consultan una y otra vez con
+los mismos rangos. Los servicios decorados con @cacheado guardan su resultado
+(JSON) por servicio, parámetros y turno de planta en una tabla de la propia base
+de datos, compartida por todos los workers de gunicorn:
+
+  - LRU acotado: al guardar se eliminan las entradas menos usadas por encima de
+    MAX_ENTRADAS o de MAX_BYTES. Los aciertos no escriben en la base: se anotan
+    en memoria y se vuelcan a ultimoAcceso al guardar el siguiente resultado.
+  - Invalidación por rango: listeners de la sesión borran, en la misma
+    transacción que el cambio, las entradas cuyo [fechaIni, fechaFin] contiene
+    alguna fecha de las OTs, registros de tiempo, consumos o costes externos
+    escritos (de la fila y de su OT). Los cambios de configuración, calendario,
+    técnicos o jerarquía que leen los servicios (nombres, RAV, turno, padres)
+    borran todas las entradas (_INVALIDAN_TODO); el estado de una máquina no.
+  - Cada invalidación incrementa la versión 'resultados_kpi' y un resultado
+    solo se guarda si la versión no ha cambiado mientras se calculaba, para no
+    dejar en la caché datos anteriores a un cambio concurrente.
+
+CACHE_KPIS=false en el entorno la desactiva.
+"""
+import hashlib
+import inspect as _inspect
+import json
+import threading
+from datetime import date, datetime
+from functools import wraps
+
+from flask import current_app
+from sqlalchemy import (event, inspect, select, insert, update, delete, func, literal, or_, and_,
+                        bindparam)
+
+from models import (db, ResultadoKpi, VersionRecurso, OrdenTrabajo, RegistroTiempo,
+                    ConsumoRecambio, CosteExterno, ConfiguracionGeneral, Festivo, Tecnico,
+                    TipoIntervencion, Recambio, Empresa, Planta, Zona, Linea, Maquina, Elemento)
+from calendario import turnoPlanta
+
+
+VERSION_RESULTADOS = 'resultados_kpi'
+
+MAX_ENTRADAS = 1000
+MAX_BYTES = 64 * 1024 * 1024
+# Con más fechas afectadas se invalida el intervalo entre la menor y la mayor
+MAX_FECHAS = 200
+# OTs por consulta al leer sus fechas (límite de parámetros de SQLite)
+LOTE = 500
+
+# Modelo -> (columnas que leen los servicios, servicios cuyos resultados
+# invalida su cambio). Altas y bajas invalidan siempre; None = cualquier
+# columna / todos los servicios.
+_INVALIDAN_TODO = {
+    ConfiguracionGeneral: (None, None),   # turno, coste/hora por defecto
+    Festivo: (None, None),
+    Tecnico: (('nombre', 'apellidos', 'costeHora', 'activo'), None),  # tarifas y nº de técnicos
+    TipoIntervencion: (None, None),       # nombres y colores de los dashboards
+    Empresa: (('codigo', 'nombre'), None),
+    Planta: (('codigo', 'nombre', 'empresaId'), None),
+    Zona: (('codigo', 'nombre', 'plantaId'), None),
+    Linea: (('codigo', 'nombre', 'zonaId', 'turno'), None),
+    Maquina: (('codigo', 'nombre', 'lineaId', 'rav'), None),
+    Elemento: (('codigo', 'nombre', 'maquinaId', 'rav'), None),
+    Recambio: (('stockActual', 'precioUnitario'), ('indicadores',)),  # valor del stock (E14)
+}
+
+_FECHAS_ORDEN = ('fechaCreacion', 'fechaProgramada', 'fechaInicio', 'fechaFin')
+# Filas hijas de una OT -> sus columnas de fecha
+_FECHAS_LINEAS = {
+    RegistroTiempo: ('inicio', 'fin'),
+    ConsumoRecambio: ('fecha',),
+    CosteExterno: ('fecha',),
+}
+
+
+# =============================================================================
+# LECTURA Y ESCRITURA
+# =============================================================================
+
+def _clave(servicio, parametros):
+    texto = json.dumps([servicio, parametros, turnoPlanta()], sort_keys=True, default=str)
+    return hashlib.sha256(texto.encode()).hexdigest()
+
+
+# Aciertos pendientes de volcar a ultimoAcceso {clave: fecha}, por proceso
+_accesos = {}
+_cerrojoAccesos = threading.Lock()
+
+
+def _leer(clave):
+    """Resultado cacheado (ya deserializado) o None"""
+    tabla = ResultadoKpi.__table__
+    resultado = db.session.execute(
+        select(tabla.c.resultado).where(tabla.c.clave == clave)
+    ).scalar()
+    if resultado is None:
+        return None
+    with _cerrojoAccesos:
+        _accesos[clave] = datetime.now()
+    return json.loads(resultado)
+
+
+def _guardar(clave, servicio, fechaIni, fechaFin, texto, version):
+    """Guarda el resultado si la versión sigue siendo `version` y aplica el LRU"""
+    tabla = ResultadoKpi.__table__
+    versiones = VersionRecurso.__table__
+    actual = select(func.coalesce(func.max(versiones.c.version), 0)).where(
+        versiones.c.clave == VERSION_RESULTADOS).scalar_subquery()
+    # Comprobación de versión e inserción en una sola sentencia
+    fila = select(
+        literal(clave), literal(servicio), literal(fechaIni, db.Date), literal(fechaFin, db.Date),
+        literal(texto), literal(len(texto)), literal(datetime.now(), db.DateTime),
+    ).where(actual == version)
+
+    orden = (tabla.c.ultimoAcceso.desc(), tabla.c.clave)
+    ranking = select(
+        tabla.c.clave,
+        func.row_number().over(order_by=orden).label('posicion'),
+        func.sum(tabla.c.tamano).over(order_by=orden).label('bytes'),
+    ).subquery()
+    with _cerrojoAccesos:
+        accesos = [{'_clave': c, '_fecha': f} for c, f in _accesos.items()]
+        _accesos.clear()
+    with db.engine.begin() as conexion:
+        conexion.execute(insert(tabla).prefix_with('OR REPLACE').from_select(
+            ('clave', 'servicio', 'fechaIni', 'fechaFin', 'resultado', 'tamano', 'ultimoAcceso'), fila))
+        # Aciertos desde el último guardado, antes de decidir qué entradas sobran
+        if accesos:
+            conexion.execute(update(tabla).where(tabla.c.clave == bindparam('_clave'))
+                             .values(ultimoAcceso=bindparam('_fecha')), accesos)
+        conexion.execute(delete(tabla).where(tabla.c.clave.in_(
+            select(ranking.c.clave).where(or_(ranking.c.posicion > MAX_ENTRADAS,
+                                              ranking.c.bytes > MAX_BYTES))
+        )))
+
+
+def vaciarResultados(conexion):
+    """Elimina todos los resultados cacheados (migraciones, reconstrucciones)"""
+    conexion.execute(delete(ResultadoKpi.__table__))
+    VersionRecurso.incrementar(conexion, VERSION_RESULTADOS)
+
+
+def cacheado(servicio):
+    """Decorador de servicios de KPIs con firma (fecha_ini, fecha_fin, ...).
+
+    El resultado se guarda serializado con el proveedor JSON de Flask, así que
+    la función devuelve siempre lo mismo que vería el cliente (fechas como
+    texto, claves de dict como str), tanto en un acierto como en un fallo.
+    """
+    def decorador(funcion):
+        firma = _inspect.signature(funcion)
+
+        @wraps(funcion)
+        def envoltura(*args, **kwargs):
+            if not current_app.config.get('CACHE_KPIS', True):
+                return funcion(*args, **kwargs)
+            parametros = firma.bind(*args, **kwargs)
+            parametros.apply_defaults()
+            fechaIni, fechaFin = list(parametros.arguments.values())[:2]
+            clave = _clave(servicio, parametros.arguments)
+
+            resultado = _leer(clave)
+            if resultado is not None:
+                return resultado
+            version = VersionRecurso.obtener(VERSION_RESULTADOS)
+            texto = current_app.json.dumps(funcion(*args, **kwargs))
+            _guardar(clave, servicio, fechaIni, fechaFin, texto, version)
+            return json.loads(texto)
+        return envoltura
+    return decorador
+
+
+# =============================================================================
+# INVALIDACIÓN EN LA SESIÓN
+# =============================================================================
+
+def _dia(valor):
+    return valor.date() if isinstance(valor, datetime) else valor
+
+
+def _cambia(obj, *campos):
+    estado = inspect(obj)
+    return any(estado.attrs[c].history.has_changes() for c in campos)
+
+
+def _fechas(obj, campos, nuevo):
+    """Fechas actuales y anteriores de los campos; en una fila nueva, también hoy
+    (las fechas con default=datetime.now aún no tienen valor antes del flush)"""
+    estado = inspect(obj)
+    fechas = {date.today()} if nuevo else set()
+    for campo in campos:
+        historia = estado.attrs[campo].history
+        for valor in (getattr(obj, campo),) + tuple(historia.deleted or ()):
+            if valor is not None:
+                fechas.add(_dia(valor))
+    return fechas
+
+
+@event.listens_for(db.session, 'before_flush')
+def _detectarCambiosResultados(session, contexto, instancias):
+    pendientes = session.info.setdefault('resultadosKpi', {'fechas': set(), 'ordenes': set(),
+                                                           'servicios': set(), 'todos': False})
+    nuevos = set(session.new)
+    modificados = [o for o in session.dirty if session.is_modified(o)]
+    for obj in list(nuevos) + modificados + list(session.deleted):
+        modelo = type(obj)
+        if modelo in _INVALIDAN_TODO:
+            campos, servicios = _INVALIDAN_TODO[modelo]
+            if campos and obj in modificados and not _cambia(obj, *campos):
+                continue
+            if servicios is None:
+                pendientes['todos'] = True
+            else:
+                pendientes['servicios'].update(servicios)
+        elif modelo is OrdenTrabajo:
+            pendientes['fechas'] |= _fechas(obj, _FECHAS_ORDEN, obj in nuevos)
+        elif modelo in _FECHAS_LINEAS:
+            pendientes['fechas'] |= _fechas(obj, _FECHAS_LINEAS[modelo], obj in nuevos)
+            pendientes['ordenes'].add(obj.ordenId)
+
+
+def _fechasOrdenes(conexion, ids):
+    """Fechas (creación, programada, inicio, fin) de las OTs indicadas"""
+    ot = OrdenTrabajo.__table__
+    ids = [i for i in ids if i is not None]
+    fechas = set()
+    for i in range(0, len(ids), LOTE):
+        for fila in conexion.execute(
+            select(*[ot.c[c] for c in _FECHAS_ORDEN]).where(ot.c.id.in_(ids[i:i + LOTE]))
+        ):
+            fechas.update(_dia(v) for v in fila if v is not None)
+    return fechas
+
+
+@event.listens_for(db.session, 'after_flush')
+def _invalidarResultadosTrasFlush(session, contexto):
+    pendientes = session.info.pop('resultadosKpi', None)
+    if not pendientes or not (pendientes['todos'] or pendientes['servicios']
+                              or pendientes['fechas'] or pendientes['ordenes']):
+        return
+    conexion = session.connection()
+    if pendientes['todos']:
+        vaciarResultados(conexion)
+        return
+
+    tabla = ResultadoKpi.__table__
+    fechas = pendientes['fechas'] | _fechasOrdenes(conexion, pendientes['ordenes'])
+    condiciones = []
+    if pendientes['servicios']:
+        condiciones.append(tabla.c.servicio.in_(pendientes['servicios']))
+    if len(fechas) > MAX_FECHAS:
+        condiciones.append(and_(tabla.c.fechaIni <= max(fechas), tabla.c.fechaFin >= min(fechas)))
+    else:
+        condiciones += [and_(tabla.c.fechaIni <= f, tabla.c.fechaFin >= f) for f in fechas]
+    if condiciones:
+        conexion.execute(delete(tabla).where(or_(*condiciones)))
+    VersionRecurso.incrementar(conexion, VERSION_RESULTADOS)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartarCambiosResultados(session):
+    session.info.pop('resultadosKpi', None)
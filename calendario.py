@@ -0,0 +1,106 @@
+"""
+Horas operativas según el régimen de turnos y el calendario de festivos.
+
+Los KPIs de disponibilidad, MTBF y paros dividen por las horas operativas del
+periodo. El régimen ('horas/día' × 'días/semana') es el de la planta
+(ConfiguracionGeneral 'turno_planta') salvo en las líneas con turno propio
+(Linea.turno). Los festivos (tabla Festivo) pueden ser comunes o de una planta y
+solo descuentan si caen en un día laborable del régimen.
+
+El cálculo es cerrado: numpy.busday_count cuenta los días laborables del rango
+con la máscara semanal del régimen, sin recorrerlo día a día, y el resultado se
+memoriza por (rango, régimen, festivos).
+"""
+from datetime import timedelta
+from functools import lru_cache
+
+import numpy as np
+
+from models import db, ConfiguracionGeneral, Festivo, Linea
+
+
+CLAVE_TURNO = 'turno_planta'
+TURNO_DEFECTO = '24/7'
+
+# 'horas/días' → (horas_dia, dias_semana)
+TURNOS = {
+    '8/5':  (8,  5),
+    '8/6':  (8,  6),
+    '10/5': (10, 5),
+    '12/5': (12, 5),
+    '16/5': (16, 5),
+    '16/6': (16, 6),
+    '12/7': (12, 7),
+    '24/5': (24, 5),
+    '24/6': (24, 6),
+    '24/7': (24, 7),
+}
+
+# Días laborables de la semana (lun … dom) según días/semana del régimen
+_MASCARAS = {5: '1111100', 6: '1111110', 7: '1111111'}
+
+
+# =============================================================================
+# CÁLCULO
+# =============================================================================
+
+@lru_cache(maxsize=4096)
+def _horasOperativas(fechaIni, fechaFin, turno, festivos):
+    horasDia, diasSemana = TURNOS.get(turno, TURNOS[TURNO_DEFECTO])
+    if fechaFin < fechaIni:
+        return 0.0
+    dias = np.busday_count(fechaIni, fechaFin + timedelta(days=1),
+                           weekmask=_MASCARAS[diasSemana], holidays=list(festivos))
+    return float(dias * horasDia)
+
+
+def horasOperativas(fechaIni, fechaFin, turno=TURNO_DEFECTO, festivos=()):
+    """
+    Horas operativas entre dos fechas (ambas incluidas) con el régimen `turno`
+    (clave de TURNOS; uno desconocido cuenta como 24/7) y las fechas `festivos`.
+    """
+    return _horasOperativas(fechaIni, fechaFin, turno, tuple(festivos))
+
+
+def turnoPlanta():
+    """Régimen de turnos configurado para la planta"""
+    return ConfiguracionGeneral.obtener(CLAVE_TURNO, TURNO_DEFECTO)
+
+
+# =============================================================================
+# CALENDARIO POR ALCANCE
+# =============================================================================
+
+class Calendario:
+    """
+    Régimen y festivos de planta y líneas, leídos una vez (dos consultas) para
+    calcular las horas operativas de muchos grupos en una misma petición.
+    """
+
+    def __init__(self, jerarquia):
+        self.jerarquia = jerarquia
+        self.turno = turnoPlanta()
+        self.turnosLinea = dict(db.session.query(Linea.id, Linea.turno).filter(Linea.turno.isnot(None)))
+        festivos = {}
+        for fecha, plantaId in db.session.query(Festivo.fecha, Festivo.plantaId).order_by(Festivo.fecha):
+            festivos.setdefault(plantaId, []).append(fecha)
+        self._comunes = tuple(festivos.pop(None, ()))
+        self._porPlanta = {p: tuple(sorted(self._comunes + tuple(f))) for p, f in festivos.items()}
+
+    def festivos(self, plantaId=None):
+        """Festivos comunes más los de la planta indicada"""
+        return self._porPlanta.get(plantaId, self._comunes)
+
+    def regimen(self, tipo=None, equipoId=None):
+        """(turno, festivos) del nodo (tipo, equipoId) o de la planta si no se indica"""
+        if not tipo or not equipoId:
+            return self.turno, self.festivos()
+        equipoId = int(equipoId)
+        lineaId = self.jerarquia.ancestro(tipo, equipoId, 'linea')
+        plantaId = self.jerarquia.ancestro(tipo, equipoId, 'planta')
+        return self.turnosLinea.get(lineaId, self.turno), self.festivos(plantaId)
+
+    def horas(self, fechaIni, fechaFin, tipo=None, equipoId=None):
+        """Horas operativas del periodo para el nodo (tipo, equipoId) o la planta"""
+        turno, festivos = self.regimen(tipo, equipoId)
+        return _horasOperativas(fechaIni, fechaFin, turno, festivos)
@@ -0,0 +1,272 @@
+"""
+Resumen de horas y costes por orden de trabajo (tabla coste_orden).
+
+Los informes y KPIs necesitan, por cada OT, horas de intervención y coste de
+mano de obra, recambios y talleres externos. En lugar de cargar los registros
+de tiempo y consumos de cada OT al generar el informe, listeners de la sesión
+recalculan la fila de resumen de las OTs afectadas en la misma transacción que
+cualquier cambio en:
+
+  - registros de tiempo (iniciar, pausar, cerrar la OT),
+  - consumos de recambios,
+  - líneas de coste de talleres externos (CosteExterno),
+  - tiempoReal de la OT (alta e importación incluidas).
+
+Política de tarifas: el coste de mano de obra se valora siempre con la tarifa
+vigente del técnico (costeHora) o, si no tiene, con el coste/hora por defecto de
+la configuración, igual que hacían los informes al calcularlo al vuelo. Por eso
+un cambio de tarifa se propaga de forma retroactiva: crear, borrar o modificar
+un técnico recalcula, en la misma transacción, las OTs con registros de tiempo
+cerrados a su nombre (anterior o nuevo). Cambiar 'coste_hora_defecto' afecta a
+todas las OTs: tras el commit se recalculan en segundo plano, por lotes de LOTE
+OTs en transacciones cortas, sin bloquear la petición.
+scripts/reconstruir_costes.py rehace la tabla completa.
+
+Cada recálculo refresca también el agregado mensual de esas OTs (hechos.py).
+"""
+import threading
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import event, inspect, select, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import (db, OrdenTrabajo, RegistroTiempo, ConsumoRecambio, CosteExterno,
+                    Tecnico, ConfiguracionGeneral, CosteOrden)
+from hechos import refrescarHechos
+
+
+CLAVE_COSTE_HORA_DEFECTO = 'coste_hora_defecto'
+# OTs por consulta al recalcular (límite de parámetros de SQLite)
+LOTE = 500
+
+# Filas hijas de una OT que intervienen en su coste
+_LINEAS_ORDEN = (RegistroTiempo, ConsumoRecambio, CosteExterno)
+
+
+# =============================================================================
+# CÁLCULO
+# =============================================================================
+
+def _tarifas(conexion):
+    """({nombre técnico: coste/hora}, coste/hora por defecto) vigentes"""
+    tecnicos = {}
+    tabla = Tecnico.__table__
+    for nombre, apellidos, costeHora in conexion.execute(
+        select(tabla.c.nombre, tabla.c.apellidos, tabla.c.costeHora).where(tabla.c.activo == True)
+    ):
+        # Se busca por nombre completo y por nombre solo
+        tecnicos[f'{nombre} {apellidos}'.strip() if apellidos else nombre] = costeHora or 0.0
+        tecnicos[nombre] = costeHora or 0.0
+
+    config = ConfiguracionGeneral.__table__
+    valor = conexion.execute(
+        select(config.c.valor).where(config.c.clave == CLAVE_COSTE_HORA_DEFECTO)
+    ).scalar()
+    try:
+        defecto = float(valor) if valor is not None else 0.0
+    except (ValueError, TypeError):
+        defecto = 0.0
+    return tecnicos, defecto
+
+
+def _calcularLote(conexion, ids, tecnicos, defecto):
+    """Filas de coste_orden para las OTs `ids` (cuatro consultas para todo el lote)"""
+    ot = OrdenTrabajo.__table__
+    rt = RegistroTiempo.__table__
+    cr = ConsumoRecambio.__table__
+    ce = CosteExterno.__table__
+
+    ordenes = conexion.execute(
+        select(ot.c.id, ot.c.tiempoReal).where(ot.c.id.in_(ids))
+    ).all()
+
+    registros = {}
+    for ordenId, tecnico, inicio, fin in conexion.execute(
+        select(rt.c.ordenId, rt.c.tecnico, rt.c.inicio, rt.c.fin).where(rt.c.ordenId.in_(ids))
+    ):
+        registros.setdefault(ordenId, []).append((tecnico, inicio, fin))
+
+    recambios = dict(conexion.execute(
+        select(cr.c.ordenId, func.sum(func.coalesce(cr.c.cantidad, 0) * func.coalesce(cr.c.precioUnitario, 0)))
+        .where(cr.c.ordenId.in_(ids)).group_by(cr.c.ordenId)
+    ).all())
+
+    externos = dict(conexion.execute(
+        select(ce.c.ordenId, func.sum(ce.c.coste)).where(ce.c.ordenId.in_(ids)).group_by(ce.c.ordenId)
+    ).all())
+
+    ahora = datetime.now()
+    filas = []
+    for id, tiempoReal in ordenes:
+        todos = registros.get(id, [])
+        cerrados = [(t, i, f) for t, i, f in todos if f is not None]
+        horas = coste = 0.0
+        if cerrados:
+            for tecnico, inicio, fin in cerrados:
+                h = (fin - inicio).total_seconds() / 3600
+                horas += h
+                coste += h * tecnicos.get((tecnico or '').strip(), defecto)
+        else:
+            # Sin registros cerrados: tiempoReal a coste/hora por defecto
+            horas = tiempoReal or 0.0
+            coste = horas * defecto
+        filas.append({
+            'ordenId': id, 'horas': horas, 'costeManoObra': coste,
+            'costeRecambios': recambios.get(id) or 0.0, 'costeExterno': externos.get(id) or 0.0,
+            'registros': len(todos), 'fechaCalculo': ahora,
+        })
+    return filas
+
+
+def recalcularCostes(conexion, ids):
+    """Recalcula (upsert) el resumen de costes de las OTs indicadas y su agregado mensual"""
+    ids = sorted(set(ids))
+    if not ids:
+        return 0
+    tecnicos, defecto = _tarifas(conexion)
+    tabla = CosteOrden.__table__
+    for i in range(0, len(ids), LOTE):
+        filas = _calcularLote(conexion, ids[i:i + LOTE], tecnicos, defecto)
+        if not filas:
+            continue
+        sentencia = sqlite_insert(tabla)
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=[tabla.c.ordenId],
+            set_={c: sentencia.excluded[c] for c in
+                  ('horas', 'costeManoObra', 'costeRecambios', 'costeExterno', 'registros', 'fechaCalculo')},
+        )
+        conexion.execute(sentencia, filas)
+    refrescarHechos(conexion, ids)
+    return len(ids)
+
+
+def reconstruirCostes(conexion):
+    """Rehace el resumen de todas las OTs y elimina el de las que ya no existen"""
+    ot = OrdenTrabajo.__table__
+    tabla = CosteOrden.__table__
+    conexion.execute(delete(tabla).where(tabla.c.ordenId.not_in(select(ot.c.id))))
+    return recalcularCostes(conexion, conexion.execute(select(ot.c.id)).scalars().all())
+
+
+def _idsConRegistrosDe(conexion, nombres):
+    """OTs con registros de tiempo cerrados de los técnicos indicados (nombre o nombre completo)"""
+    rt = RegistroTiempo.__table__
+    return conexion.execute(
+        select(rt.c.ordenId).where(rt.c.fin.isnot(None), func.trim(rt.c.tecnico).in_(nombres)).distinct()
+    ).scalars().all()
+
+
+def reconstruirCostesPorLotes(app):
+    """
+    Recalcula en un hilo el resumen de todas las OTs, LOTE OTs por transacción,
+    y vacía después la caché de KPIs (cambio del coste/hora por defecto).
+    """
+    from cache_kpis import vaciarResultados  # cache_kpis importa la jerarquía
+
+    def _tarea():
+        with app.app_context():
+            ot = OrdenTrabajo.__table__
+            with db.engine.connect() as conexion:
+                ids = conexion.execute(select(ot.c.id).order_by(ot.c.id)).scalars().all()
+            for i in range(0, len(ids), LOTE):
+                with db.engine.begin() as conexion:
+                    recalcularCostes(conexion, ids[i:i + LOTE])
+            with db.engine.begin() as conexion:
+                vaciarResultados(conexion)
+
+    hilo = threading.Thread(target=_tarea, name='reconstruir-costes', daemon=True)
+    hilo.start()
+    return hilo
+
+
+# =============================================================================
+# MANTENIMIENTO EN LA SESIÓN
+# =============================================================================
+
+def _cambia(obj, *campos):
+    estado = inspect(obj)
+    return any(estado.attrs[c].history.has_changes() for c in campos)
+
+
+def _nombresTecnico(obj):
+    """Nombres con los que _tarifas busca al técnico, con los valores actuales y anteriores"""
+    estado = inspect(obj)
+    nombres = set()
+    for nombre in estado.attrs['nombre'].history.sum() or [obj.nombre]:
+        if not nombre:
+            continue
+        nombres.add(nombre.strip())
+        for apellidos in estado.attrs['apellidos'].history.sum() or [obj.apellidos]:
+            if apellidos:
+                nombres.add(f'{nombre} {apellidos}'.strip())
+    return nombres
+
+
+@event.listens_for(db.session, 'before_flush')
+def _detectarCambiosCostes(session, contexto, instancias):
+    pendientes = session.info.setdefault('costesOrdenes', {'ordenes': [], 'ids': set(),
+                                                           'eliminadas': set(), 'tecnicos': set()})
+    for obj in session.new:
+        if isinstance(obj, OrdenTrabajo):
+            pendientes['ordenes'].append(obj)  # el id no existe hasta el flush
+        elif isinstance(obj, _LINEAS_ORDEN):
+            pendientes['ids'].add(obj.ordenId)
+        elif isinstance(obj, Tecnico):
+            pendientes['tecnicos'] |= _nombresTecnico(obj)
+        elif isinstance(obj, ConfiguracionGeneral) and obj.clave == CLAVE_COSTE_HORA_DEFECTO:
+            session.info['costesTodas'] = True
+
+    for obj in session.dirty:
+        if isinstance(obj, OrdenTrabajo):
+            if _cambia(obj, 'tiempoReal'):
+                pendientes['ids'].add(obj.id)
+        elif isinstance(obj, _LINEAS_ORDEN):
+            if session.is_modified(obj):
+                pendientes['ids'].add(obj.ordenId)
+        elif isinstance(obj, Tecnico):
+            if _cambia(obj, 'costeHora', 'nombre', 'apellidos', 'activo'):
+                pendientes['tecnicos'] |= _nombresTecnico(obj)
+        elif isinstance(obj, ConfiguracionGeneral) and obj.clave == CLAVE_COSTE_HORA_DEFECTO:
+            if _cambia(obj, 'valor'):
+                session.info['costesTodas'] = True
+
+    for obj in session.deleted:
+        if isinstance(obj, OrdenTrabajo):
+            pendientes['eliminadas'].add(obj.id)
+        elif isinstance(obj, _LINEAS_ORDEN):
+            pendientes['ids'].add(obj.ordenId)
+        elif isinstance(obj, Tecnico):
+            pendientes['tecnicos'] |= _nombresTecnico(obj)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _recalcularCostesTrasFlush(session, contexto):
+    pendientes = session.info.pop('costesOrdenes', None)
+    if not pendientes:
+        return
+    ids = pendientes['ids'] | {o.id for o in pendientes['ordenes']}
+    eliminadas = pendientes['eliminadas']
+    if not (ids or eliminadas or pendientes['tecnicos']):
+        return
+
+    conexion = session.connection()
+    if pendientes['tecnicos']:
+        ids |= set(_idsConRegistrosDe(conexion, pendientes['tecnicos']))
+    if eliminadas:
+        tabla = CosteOrden.__table__
+        conexion.execute(delete(tabla).where(tabla.c.ordenId.in_(eliminadas)))
+    recalcularCostes(conexion, ids - eliminadas)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _recalcularTodasTrasCommit(session):
+    # Con el nuevo coste/hora por defecto ya confirmado
+    if session.info.pop('costesTodas', False):
+        reconstruirCostesPorLotes(current_app._get_current_object())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartarCambiosCostes(session):
+    session.info.pop('costesOrdenes', None)
+    session.info.pop('costesTodas', None)
@@ -0,0 +1,179 @@
+"""
+Registro de cambios de las órdenes de trabajo y su difusión por Server-Sent Events.
+
+Listeners de la sesión anotan en la tabla evento_orden, en la misma transacción
+que el cambio, cada alta, cambio de estado, asignación de técnico, inicio o
+pausa de trabajo y baja de una OT. Como la tabla está en la propia base SQLite,
+todos los workers de gunicorn ven los mismos eventos en cuanto se confirman: el
+endpoint SSE de cada worker los lee por id creciente y los reenvía a sus
+clientes, sin broker externo. El id del evento viaja como id SSE, así que un
+cliente que se reconecta (Last-Event-ID) recibe lo que se perdió.
+
+Cada conexión abierta ocupa un hilo del worker (gthread), así que el flujo es
+corto: dura DURACION_FLUJO segundos y el navegador se reconecta a los
+RECONEXION_MS milisegundos. Un cliente ocupa un hilo como mucho la mitad del
+tiempo y los eventos le llegan con un retraso máximo de unos 5 s. Además, cada
+proceso admite como mucho MAX_FLUJOS conexiones a la vez; por encima el
+endpoint responde 503 con Retry-After y el cliente reintenta más tarde desde el
+último id, de modo que los flujos nunca dejan sin hilos al resto de peticiones.
+"""
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect, insert, select, delete, func
+
+from models import db, OrdenTrabajo, RegistroTiempo, EventoOrden
+
+
+EVENTO_CREADA = 'creada'
+EVENTO_ESTADO = 'estado'
+EVENTO_ASIGNADA = 'asignada'
+EVENTO_TRABAJO_INICIADO = 'trabajo_iniciado'
+EVENTO_TRABAJO_PAUSADO = 'trabajo_pausado'
+EVENTO_ELIMINADA = 'eliminada'
+
+# Antigüedad a partir de la cual se purgan eventos (nadie se reconecta tan tarde)
+RETENCION_EVENTOS = timedelta(days=1)
+# -inf: la primera comprobación de cada proceso purga
+_ultimaPurga = float('-inf')
+
+# Duración de cada conexión SSE (s) y espera del navegador antes de reconectar (ms)
+DURACION_FLUJO = 5
+RECONEXION_MS = 5000
+# Conexiones SSE simultáneas por proceso (la mitad de los hilos de gunicorn)
+MAX_FLUJOS = 4
+_flujosLibres = threading.BoundedSemaphore(MAX_FLUJOS)
+
+
+def _cambia(obj, campo):
+    return inspect(obj).attrs[campo].history.has_changes()
+
+
+def _datosOrden(orden):
+    return {
+        'numero': orden.numero,
+        'tipo': orden.tipo,
+        'estado': orden.estado,
+        'prioridad': orden.prioridad,
+        'titulo': orden.titulo,
+        'tecnicoAsignado': orden.tecnicoAsignado,
+    }
+
+
+# =============================================================================
+# ANOTACIÓN DE EVENTOS EN LA SESIÓN
+# =============================================================================
+
+@event.listens_for(db.session, 'before_flush')
+def _detectarEventosOrdenes(session, contexto, instancias):
+    # Se guardan los objetos: el id de las OTs nuevas no existe hasta el flush
+    pendientes = session.info.setdefault('eventosOrdenes', [])
+    for obj in session.new:
+        if isinstance(obj, OrdenTrabajo):
+            pendientes.append((EVENTO_CREADA, obj))
+        elif isinstance(obj, RegistroTiempo) and obj.enCurso is not False:
+            pendientes.append((EVENTO_TRABAJO_INICIADO, obj))
+    for obj in session.dirty:
+        if isinstance(obj, OrdenTrabajo):
+            if _cambia(obj, 'estado'):
+                pendientes.append((EVENTO_ESTADO, obj))
+            if _cambia(obj, 'tecnicoAsignado') and obj.tecnicoAsignado:
+                pendientes.append((EVENTO_ASIGNADA, obj))
+        elif isinstance(obj, RegistroTiempo) and _cambia(obj, 'enCurso') and not obj.enCurso:
+            pendientes.append((EVENTO_TRABAJO_PAUSADO, obj))
+    for obj in session.deleted:
+        if isinstance(obj, OrdenTrabajo):
+            pendientes.append((EVENTO_ELIMINADA, obj))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _registrarEventosTrasFlush(session, contexto):
+    pendientes = session.info.pop('eventosOrdenes', None)
+    if not pendientes:
+        return
+    ahora = datetime.now()
+    filas = []
+    for tipo, obj in pendientes:
+        if isinstance(obj, RegistroTiempo):
+            ordenId, datos = obj.ordenId, {'tecnico': obj.tecnico}
+        elif tipo == EVENTO_ELIMINADA:
+            ordenId, datos = obj.id, {'numero': obj.numero}
+        else:
+            ordenId, datos = obj.id, _datosOrden(obj)
+        filas.append({'ordenId': ordenId, 'tipo': tipo, 'fecha': ahora,
+                      'datos': json.dumps(datos, ensure_ascii=False)})
+    conexion = session.connection()
+    conexion.execute(insert(EventoOrden.__table__), filas)
+    _purgarEventosAntiguos(conexion)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartarEventosOrdenes(session):
+    session.info.pop('eventosOrdenes', None)
+
+
+def _purgarEventosAntiguos(conexion):
+    # Como mucho una vez por hora y proceso
+    global _ultimaPurga
+    if time.monotonic() - _ultimaPurga < 3600:
+        return
+    _ultimaPurga = time.monotonic()
+    tabla = EventoOrden.__table__
+    conexion.execute(delete(tabla).where(tabla.c.fecha < datetime.now() - RETENCION_EVENTOS))
+
+
+# =============================================================================
+# LECTURA Y FLUJO SSE
+# =============================================================================
+
+def ultimoEvento():
+    """Id del último evento registrado (0 si no hay)"""
+    tabla = EventoOrden.__table__
+    with db.engine.connect() as conexion:
+        return conexion.execute(select(func.max(tabla.c.id))).scalar() or 0
+
+
+def leerEventos(despuesDe, limite=200):
+    """Eventos con id mayor que `despuesDe`, en orden, como dicts listos para enviar"""
+    tabla = EventoOrden.__table__
+    with db.engine.connect() as conexion:
+        filas = conexion.execute(
+            select(tabla.c.id, tabla.c.ordenId, tabla.c.tipo, tabla.c.datos)
+            .where(tabla.c.id > despuesDe).order_by(tabla.c.id).limit(limite)
+        ).all()
+    return [{'id': f.id, 'ordenId': f.ordenId, 'evento': f.tipo, **json.loads(f.datos or '{}')}
+            for f in filas]
+
+
+def reservarFlujo():
+    """Ocupa un hueco de flujo SSE; False si ya hay MAX_FLUJOS abiertos"""
+    return _flujosLibres.acquire(blocking=False)
+
+
+def liberarFlujo():
+    _flujosLibres.release()
+
+
+def flujoEventos(despuesDe=None, duracion=DURACION_FLUJO, intervalo=1.0):
+    """
+    Generador de mensajes SSE con los eventos posteriores a `despuesDe` (por
+    defecto, solo los nuevos). Consulta la tabla cada `intervalo` segundos y
+    termina tras `duracion` segundos para liberar el hilo: el navegador se
+    reconecta tras `retry` y continúa desde el último id (Last-Event-ID).
+    """
+    if despuesDe is None:
+        despuesDe = ultimoEvento()
+    # El id inicial fija Last-Event-ID aunque la conexión termine sin eventos:
+    # al reconectar no se pierde lo ocurrido entre una conexión y la siguiente.
+    # El evento 'inicio' lo expone al cliente para reintentar tras un 503.
+    yield f'retry: {RECONEXION_MS}\nid: {despuesDe}\nevent: inicio\ndata: {despuesDe}\n\n'
+    fin = time.monotonic() + duracion
+    while time.monotonic() < fin:
+        eventos = leerEventos(despuesDe)
+        for e in eventos:
+            despuesDe = e['id']
+            yield f"id: {e['id']}\nevent: orden\ndata: {json.dumps(e, ensure_ascii=False)}\n\n"
+        if not eventos:
+            time.sleep(intervalo)
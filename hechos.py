@@ -0,0 +1,284 @@
+"""
+Agregado mensual de órdenes de trabajo (tabla hecho_mensual_orden).
+
+Los dashboards y los KPIs agrupan las OTs por mes de creación, equipo, tipo y
+prioridad. Agrupar orden_trabajo con strftime('%Y-%m', fechaCreacion) recorre
+todas las OTs del rango, así que se mantiene una fila por (mes, equipo, tipo,
+prioridad, mes programado) con nº de OTs, horas de paro, horas de intervención,
+costes (de coste_orden) y los recuentos de cumplimiento de programa y calidad
+de datos.
+
+Cada fila se recalcula desde cero para su grupo (mes, equipo) con un INSERT ...
+SELECT, nunca sumando deltas, en la misma transacción que el cambio:
+
+  - listeners de la sesión: OTs borradas o con cambios de fechas, equipo, tipo,
+    prioridad, estado, tiempos o solución (grupo anterior y nuevo),
+  - costes.py: OTs cuyo resumen de costes se ha recalculado (incluidas las nuevas),
+  - jerarquia.py: OTs cuyos ancestros cambian al mover activos.
+
+consultaHechos() combina los meses completos del rango (leídos de la tabla) con
+los días sueltos de los extremos (agrupados sobre orden_trabajo), de modo que el
+resultado es exacto para cualquier rango de fechas.
+scripts/reconstruir_hechos.py rehace la tabla completa.
+"""
+import calendar
+from datetime import timedelta
+
+from sqlalchemy import event, inspect, select, delete, insert, func, case, and_, union_all, type_coerce
+
+from models import db, OrdenTrabajo, CosteOrden, HechoMensualOrden
+from jerarquia import filtroOrdenesSubarbol, filtroSubarbol
+
+
+# Con más OTs o grupos afectados que esto se reconstruye la tabla entera
+MAX_ORDENES = 5000
+MAX_GRUPOS = 500
+# OTs por consulta al resolver sus grupos (límite de parámetros de SQLite)
+LOTE = 500
+
+_CAMPOS_GRUPO = ('fechaCreacion', 'equipoTipo', 'equipoId')
+_CAMPOS_HECHO = _CAMPOS_GRUPO + ('tipo', 'prioridad', 'tiempoParada', 'fechaProgramada',
+                                 'fechaInicio', 'fechaFin', 'estado', 'tiempoReal',
+                                 'descripcionSolucion')
+
+_DIMENSIONES = ('equipoTipo', 'equipoId', 'plantaId', 'zonaId', 'lineaId', 'maquinaRefId',
+                'tipo', 'prioridad')
+_MEDIDAS = ('ordenes', 'fallos', 'horasParo', 'horasFallo',
+            'horas', 'costeManoObra', 'costeRecambios', 'costeExterno',
+            'programadas', 'programadasCerradas', 'programadasEnPlazo', 'completas')
+
+# Nivel -> columna de ancestro del agregado (empresa y elemento van por RutaActivo)
+_COLUMNA_POR_NIVEL = {
+    'planta': HechoMensualOrden.plantaId,
+    'zona': HechoMensualOrden.zonaId,
+    'linea': HechoMensualOrden.lineaId,
+    'maquina': HechoMensualOrden.maquinaRefId,
+}
+
+
+# =============================================================================
+# CÁLCULO
+# =============================================================================
+
+def _mes(fecha):
+    return fecha.strftime('%Y-%m')
+
+
+def entreFechas(columna, desde, hasta):
+    """
+    columna entre las fechas desde y hasta, ambas incluidas. Se compara el texto
+    guardado, como strftime del agregado: hay fechas importadas sin hora
+    ('AAAA-MM-DD') que una comparación con datetime dejaría fuera el primer día.
+    """
+    texto = type_coerce(columna, db.String)
+    return and_(texto >= desde.strftime('%Y-%m-%d'),
+                texto < (hasta + timedelta(days=1)).strftime('%Y-%m-%d'))
+
+
+def _agregadoOrdenes(*condiciones):
+    """SELECT agrupado de orden_trabajo + coste_orden con las columnas de la tabla"""
+    ot = OrdenTrabajo.__table__
+    co = CosteOrden.__table__
+    mes = func.strftime('%Y-%m', ot.c.fechaCreacion)
+    mesProgramada = func.strftime('%Y-%m', ot.c.fechaProgramada)
+    conParo = ot.c.tiempoParada > 0
+    programada = ot.c.fechaProgramada.isnot(None)
+    cerrada = and_(programada, ot.c.estado == 'cerrada')
+    # Mismo criterio que str.strip(): descripción con algún carácter visible
+    solucion = func.trim(func.coalesce(ot.c.descripcionSolucion, ''), ' \t\r\n') != ''
+    completa = and_(ot.c.fechaInicio.isnot(None), ot.c.fechaFin.isnot(None), ot.c.tiempoReal > 0,
+                    solucion, co.c.registros > 0)
+    dimensiones = [ot.c[c] for c in _DIMENSIONES]
+
+    def _contar(condicion):
+        return func.sum(case((condicion, 1), else_=0))
+
+    return select(
+        mes.label('mes'),
+        *dimensiones,
+        mesProgramada.label('mesProgramada'),
+        func.count(ot.c.id).label('ordenes'),
+        _contar(conParo).label('fallos'),
+        func.total(ot.c.tiempoParada).label('horasParo'),
+        func.total(case((conParo, ot.c.tiempoParada), else_=0)).label('horasFallo'),
+        func.total(co.c.horas).label('horas'),
+        func.total(co.c.costeManoObra).label('costeManoObra'),
+        func.total(co.c.costeRecambios).label('costeRecambios'),
+        func.total(co.c.costeExterno).label('costeExterno'),
+        _contar(programada).label('programadas'),
+        _contar(cerrada).label('programadasCerradas'),
+        _contar(and_(cerrada, ot.c.fechaFin.isnot(None), ot.c.fechaFin <= ot.c.fechaProgramada))
+        .label('programadasEnPlazo'),
+        _contar(completa).label('completas'),
+    ).select_from(
+        ot.outerjoin(co, co.c.ordenId == ot.c.id)
+    ).where(*condiciones).group_by(mes, *dimensiones, mesProgramada)
+
+
+def _insertarAgregado(conexion, *condiciones):
+    tabla = HechoMensualOrden.__table__
+    conexion.execute(insert(tabla).from_select(
+        ('mes',) + _DIMENSIONES + ('mesProgramada',) + _MEDIDAS, _agregadoOrdenes(*condiciones)))
+
+
+def reconstruirHechos(conexion):
+    """Rehace el agregado mensual de todas las OTs"""
+    conexion.execute(delete(HechoMensualOrden.__table__))
+    _insertarAgregado(conexion, OrdenTrabajo.__table__.c.fechaCreacion.isnot(None))
+    return conexion.execute(select(func.count()).select_from(HechoMensualOrden.__table__)).scalar()
+
+
+def _refrescarGrupos(conexion, grupos):
+    """Recalcula las filas de los grupos {(mes, equipoTipo, equipoId)}"""
+    tabla = HechoMensualOrden.__table__
+    ot = OrdenTrabajo.__table__
+    for mes, equipoTipo, equipoId in grupos:
+        conexion.execute(delete(tabla).where(
+            tabla.c.mes == mes,
+            tabla.c.equipoTipo.is_not_distinct_from(equipoTipo),
+            tabla.c.equipoId.is_not_distinct_from(equipoId),
+        ))
+        _insertarAgregado(
+            conexion,
+            ot.c.equipoTipo.is_not_distinct_from(equipoTipo),
+            ot.c.equipoId.is_not_distinct_from(equipoId),
+            # Mismo mes que en reconstruirHechos, también para fechas sin hora
+            func.strftime('%Y-%m', ot.c.fechaCreacion) == mes,
+        )
+
+
+def _gruposDeOrdenes(conexion, ids):
+    """{(mes, equipoTipo, equipoId)} actuales de las OTs indicadas"""
+    ot = OrdenTrabajo.__table__
+    ids = list(ids)
+    grupos = set()
+    for i in range(0, len(ids), LOTE):
+        grupos.update(conexion.execute(
+            select(func.strftime('%Y-%m', ot.c.fechaCreacion), ot.c.equipoTipo, ot.c.equipoId)
+            .where(ot.c.id.in_(ids[i:i + LOTE]), ot.c.fechaCreacion.isnot(None)).distinct()
+        ).tuples())
+    return grupos
+
+
+def refrescarHechos(conexion, ids=(), grupos=()):
+    """
+    Recalcula el agregado de las OTs `ids` (en su grupo actual) y de los grupos
+    `grupos` indicados. Con demasiados grupos reconstruye la tabla.
+    """
+    if len(ids) > MAX_ORDENES:
+        reconstruirHechos(conexion)
+        return
+    grupos = set(grupos)
+    if ids:
+        grupos |= _gruposDeOrdenes(conexion, ids)
+    if len(grupos) > MAX_GRUPOS:
+        reconstruirHechos(conexion)
+    elif grupos:
+        _refrescarGrupos(conexion, grupos)
+
+
+# =============================================================================
+# MANTENIMIENTO EN LA SESIÓN
+# =============================================================================
+# Las OTs nuevas no se tratan aquí: costes.py recalcula su resumen en el mismo
+# flush y refresca entonces su grupo, ya con los costes (recalcularCostes).
+
+def _valorAnterior(estado, campo):
+    historia = estado.attrs[campo].history
+    if historia.deleted:
+        return historia.deleted[0]
+    return getattr(estado.object, campo)
+
+
+def _grupoAnterior(obj):
+    estado = inspect(obj)
+    fecha, equipoTipo, equipoId = (_valorAnterior(estado, c) for c in _CAMPOS_GRUPO)
+    return (_mes(fecha), equipoTipo, equipoId) if fecha else None
+
+
+@event.listens_for(db.session, 'before_flush')
+def _detectarCambiosHechos(session, contexto, instancias):
+    pendientes = session.info.setdefault('hechosOrdenes', {'ids': set(), 'grupos': set()})
+    for obj in session.dirty:
+        if isinstance(obj, OrdenTrabajo):
+            estado = inspect(obj)
+            if any(estado.attrs[c].history.has_changes() for c in _CAMPOS_HECHO):
+                pendientes['ids'].add(obj.id)
+                pendientes['grupos'].add(_grupoAnterior(obj))
+    for obj in session.deleted:
+        if isinstance(obj, OrdenTrabajo):
+            pendientes['grupos'].add(_grupoAnterior(obj))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _refrescarHechosTrasFlush(session, contexto):
+    # Registrado después de jerarquia.py (importado arriba): los ancestros de las
+    # OTs modificadas ya están propagados
+    pendientes = session.info.pop('hechosOrdenes', None)
+    if not pendientes:
+        return
+    grupos = pendientes['grupos'] - {None}
+    if pendientes['ids'] or grupos:
+        refrescarHechos(session.connection(), pendientes['ids'], grupos)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartarCambiosHechos(session):
+    session.info.pop('hechosOrdenes', None)
+
+
+# =============================================================================
+# CONSULTA
+# =============================================================================
+
+def filtroHechos(nivel, nivelId):
+    """Condición sobre HechoMensualOrden: filas del subárbol de (nivel, nivelId)"""
+    columna = _COLUMNA_POR_NIVEL.get(nivel)
+    if columna is not None:
+        return columna == int(nivelId)
+    return filtroSubarbol(nivel, nivelId, HechoMensualOrden.equipoTipo, HechoMensualOrden.equipoId)
+
+
+def mesesCompletos(fi, ff):
+    """(primer día, último día) de los meses enteros dentro de [fi, ff], o None"""
+    inicio = fi if fi.day == 1 else (fi.replace(day=28) + timedelta(days=4)).replace(day=1)
+    fin = ff if ff.day == calendar.monthrange(ff.year, ff.month)[1] else ff.replace(day=1) - timedelta(days=1)
+    return (inicio, fin) if inicio <= fin else None
+
+
+def consultaHechos(fi, ff, nivel=None, nivel_id=None):
+    """
+    Subconsulta con el agregado de las OTs creadas entre las fechas fi y ff
+    (incluidas): columnas mes, equipoTipo, equipoId, tipo, prioridad y las
+    medidas de HechoMensualOrden, varias filas por grupo. Se agrega sobre ella
+    con func.sum(...).
+    """
+    h = HechoMensualOrden
+    ot = OrdenTrabajo
+    alcance = bool(nivel and nivel_id)
+    columnas = ('mes', 'equipoTipo', 'equipoId', 'tipo', 'prioridad') + _MEDIDAS
+
+    def _fragmento(desde, hasta):
+        condiciones = [entreFechas(ot.fechaCreacion, desde, hasta)]
+        if alcance:
+            condiciones.append(filtroOrdenesSubarbol(nivel, nivel_id))
+        agregado = _agregadoOrdenes(*condiciones).subquery()
+        return select(*[agregado.c[c] for c in columnas])
+
+    partes = []
+    completos = mesesCompletos(fi, ff)
+    if completos is None:
+        partes.append(_fragmento(fi, ff))
+    else:
+        inicio, fin = completos
+        q = select(*[getattr(h, c) for c in columnas]).where(h.mes >= _mes(inicio), h.mes <= _mes(fin))
+        if alcance:
+            q = q.where(filtroHechos(nivel, nivel_id))
+        partes.append(q)
+        if fi < inicio:
+            partes.append(_fragmento(fi, inicio - timedelta(days=1)))
+        if fin < ff:
+            partes.append(_fragmento(fin + timedelta(days=1), ff))
+
+    consulta = partes[0] if len(partes) == 1 else union_all(*partes)
+    return consulta.subquery('hechos')
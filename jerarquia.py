@@ -0,0 +1,677 @@
+"""
+Índice materializado de rutas de la jerarquía de activos
+(Empresa → Planta → Zona → Línea → Máquina → Elemento).
+
+La tabla RutaActivo guarda, para cada nodo, los ids, códigos y nombres de todos
+sus ancestros. Un listener after_flush de la sesión la mantiene al día dentro de
+la misma transacción que modifica el árbol (endpoints CRUD, importación, ...),
+de forma que resolver la ruta de un equipo cuesta una consulta indexada y la de
+N equipos una sola consulta por respuesta.
+
+Sobre RutaActivo se mantiene un índice FTS5 (código, nombre y ruta) que
+sincronizan triggers de SQLite, para la búsqueda de equipos con autocompletado.
+
+Las órdenes de trabajo guardan desnormalizados los ancestros de su equipo
+(plantaId, zonaId, lineaId, maquinaRefId), que se rellenan en el mismo flush y
+se repropagan cuando un activo cambia de padre.
+
+Además mantiene un snapshot inmutable en memoria de toda la jerarquía, compartido
+por los blueprints y reconstruido solo cuando cambia la versión 'jerarquia' de
+VersionRecurso (que se incrementa en la misma transacción que el cambio).
+"""
+import json
+import re
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from sqlalchemy import (event, inspect, select, delete, insert, update, exists, false,
+                        or_, and_, func, text, bindparam)
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import (db, Empresa, Planta, Zona, Linea, Maquina, Elemento,
+                    RutaActivo, VersionRecurso, OrdenTrabajo)
+
+
+NIVELES = ('empresa', 'planta', 'zona', 'linea', 'maquina', 'elemento')
+
+MODELOS = {
+    'empresa': Empresa,
+    'planta': Planta,
+    'zona': Zona,
+    'linea': Linea,
+    'maquina': Maquina,
+    'elemento': Elemento,
+}
+
+_TIPO_POR_MODELO = {modelo: tipo for tipo, modelo in MODELOS.items()}
+
+# Columna FK y relación (backref) hacia el padre de cada nivel
+_PADRE = {
+    'planta': ('empresaId', 'empresa'),
+    'zona': ('plantaId', 'planta'),
+    'linea': ('zonaId', 'zona'),
+    'maquina': ('lineaId', 'linea'),
+    'elemento': ('maquinaId', 'maquina'),
+}
+
+# Hijos directos de cada nivel: tipo padre -> (tipo hijo, FK del hijo hacia el padre)
+HIJOS = {padre: (tipo, fk) for tipo, (fk, padre) in _PADRE.items()}
+
+# Campos propios que forman parte de la ruta
+_CAMPOS_RUTA = ('codigo', 'nombre')
+
+# Clave del contador de versión de la jerarquía en VersionRecurso
+VERSION_JERARQUIA = 'jerarquia'
+
+
+# =============================================================================
+# CONSTRUCCIÓN DE FILAS
+# =============================================================================
+
+def _consultaRutas(tipo, ancestroTipo=None, ancestroIds=None):
+    """
+    SELECT de los nodos de `tipo` unidos (outer join) a todos sus ancestros.
+    Si se indica ancestroTipo/ancestroIds se limita al subárbol de esos nodos.
+    """
+    niveles = NIVELES[:NIVELES.index(tipo) + 1]
+    tablas = {n: MODELOS[n].__table__ for n in niveles}
+
+    columnas = []
+    for n in niveles:
+        t = tablas[n]
+        columnas += [t.c.id.label(f'{n}_id'),
+                     t.c.codigo.label(f'{n}_codigo'),
+                     t.c.nombre.label(f'{n}_nombre')]
+
+    origen = tablas[tipo]
+    for hijo, padre in zip(niveles[:0:-1], niveles[-2::-1]):
+        fk = _PADRE[hijo][0]
+        origen = origen.outerjoin(tablas[padre], tablas[padre].c.id == tablas[hijo].c[fk])
+
+    q = select(*columnas).select_from(origen)
+    if ancestroTipo is not None:
+        q = q.where(tablas[ancestroTipo].c.id.in_(ancestroIds))
+    return q
+
+
+def _valoresRuta(tipo, fila):
+    """Convierte una fila de _consultaRutas en los valores de RutaActivo."""
+    niveles = NIVELES[:NIVELES.index(tipo) + 1]
+
+    # Cadena contigua de ancestros existentes, desde el nodo hacia arriba
+    cadena = []
+    for n in reversed(niveles):
+        if fila[f'{n}_id'] is None:
+            break
+        cadena.insert(0, n)
+
+    valores = {
+        'tipo': tipo,
+        'equipoId': fila[f'{tipo}_id'],
+        'codigo': fila[f'{tipo}_codigo'],
+        'nombre': fila[f'{tipo}_nombre'],
+        'rutaCodigos': ' > '.join(str(fila[f'{n}_codigo']) for n in cadena),
+        'rutaNombres': json.dumps([
+            {'id': fila[f'{n}_id'], 'nombre': fila[f'{n}_nombre'],
+             'codigo': fila[f'{n}_codigo'], 'tipo': n}
+            for n in cadena if n != 'empresa'
+        ], ensure_ascii=False),
+    }
+    for n in NIVELES:
+        valores[f'{n}Id'] = fila[f'{n}_id'] if n in cadena else None
+    return valores
+
+
+def _insertarNivel(conexion, tipo, ancestroTipo=None, ancestroIds=None):
+    tabla = RutaActivo.__table__
+    filas = [_valoresRuta(tipo, f._mapping)
+             for f in conexion.execute(_consultaRutas(tipo, ancestroTipo, ancestroIds))]
+    if not filas:
+        return 0
+    conexion.execute(delete(tabla).where(
+        tabla.c.tipo == tipo,
+        tabla.c.equipoId.in_([f['equipoId'] for f in filas])
+    ))
+    conexion.execute(insert(tabla), filas)
+    return len(filas)
+
+
+def _reconstruirSubarbol(conexion, tipo, ids):
+    """Recalcula las rutas de los nodos `ids` de `tipo` y de todos sus descendientes."""
+    tabla = RutaActivo.__table__
+    ids = list(ids)
+    conexion.execute(delete(tabla).where(tabla.c[f'{tipo}Id'].in_(ids)))
+    for nivel in NIVELES[NIVELES.index(tipo):]:
+        _insertarNivel(conexion, nivel, tipo, ids)
+
+
+def reconstruirRutas():
+    """Reconstruye por completo la tabla RutaActivo. Devuelve el nº de filas."""
+    conexion = db.session.connection()
+    conexion.execute(delete(RutaActivo.__table__))
+    total = sum(_insertarNivel(conexion, nivel) for nivel in NIVELES)
+    db.session.commit()
+    return total
+
+
+def asegurarRutas():
+    """Rellena la tabla de rutas si no está sincronizada con la jerarquía (arranque)."""
+    asegurarIndiceBusqueda()
+    nodos = sum(db.session.query(func.count(m.id)).scalar() for m in MODELOS.values())
+    if db.session.query(func.count(RutaActivo.id)).scalar() != nodos:
+        reconstruirRutas()
+
+
+# =============================================================================
+# SINCRONIZACIÓN EN LA MISMA TRANSACCIÓN
+# =============================================================================
+
+def _cambiaCampos(obj, campos):
+    estado = inspect(obj)
+    return any(estado.attrs[c].history.has_changes() for c in campos)
+
+
+def _cambiaRuta(tipo, obj):
+    """True si el objeto modificado altera su ruta (código, nombre o padre)."""
+    return _cambiaCampos(obj, _CAMPOS_RUTA + _PADRE.get(tipo, ()))
+
+
+@event.listens_for(db.session, 'before_flush')
+def _detectarCambiosJerarquia(session, contexto, instancias):
+    # El historial de atributos solo está disponible antes del flush: aquí se
+    # anotan los nodos afectados y en after_flush (ya con ids) se actualiza.
+    # Cada entrada: (tipo, obj, afectaRuta, cambiaAncestros).
+    pendientes = session.info.setdefault('jerarquiaPendiente', [])
+    for obj in session.new:
+        tipo = _TIPO_POR_MODELO.get(type(obj))
+        if tipo:
+            pendientes.append((tipo, obj, True, False))
+    for obj in session.deleted:
+        tipo = _TIPO_POR_MODELO.get(type(obj))
+        if tipo:
+            pendientes.append((tipo, obj, True, True))
+    for obj in session.dirty:
+        tipo = _TIPO_POR_MODELO.get(type(obj))
+        if tipo and session.is_modified(obj):
+            pendientes.append((tipo, obj, _cambiaRuta(tipo, obj),
+                               _cambiaCampos(obj, _PADRE.get(tipo, ()))))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _sincronizarJerarquiaTrasFlush(session, contexto):
+    pendientes = session.info.pop('jerarquiaPendiente', None)
+    if not pendientes:
+        return
+
+    cambios, movidos = {}, {}
+    for tipo, obj, afectaRuta, cambiaAncestros in pendientes:
+        if afectaRuta and obj.id is not None:
+            cambios.setdefault(tipo, set()).add(obj.id)
+        if cambiaAncestros and obj.id is not None:
+            movidos.setdefault(tipo, set()).add(obj.id)
+
+    conexion = session.connection()
+    VersionRecurso.incrementar(conexion, VERSION_JERARQUIA)
+    session.info['jerarquiaModificada'] = True
+
+    # OTs colgadas de nodos movidos o borrados, según las rutas aún sin tocar
+    ordenes = _ordenesBajo(conexion, movidos) if movidos else []
+
+    for tipo in NIVELES:
+        if tipo in cambios:
+            _reconstruirSubarbol(conexion, tipo, cambios[tipo])
+
+    if ordenes:
+        _propagarAncestrosOrdenes(conexion, ordenes)
+        from hechos import refrescarHechos  # hechos importa este módulo
+        refrescarHechos(conexion, ordenes)
+
+
+# =============================================================================
+# ANCESTROS DESNORMALIZADOS EN ÓRDENES DE TRABAJO
+# =============================================================================
+# OrdenTrabajo guarda plantaId/zonaId/lineaId/maquinaRefId de su equipo para
+# filtrar y agrupar por cualquier nivel con índices (nivel, fecha). Se rellenan
+# al insertar o cambiar el equipo de una OT y se repropagan al mover activos.
+
+# Columna de OrdenTrabajo -> columna de RutaActivo del equipo
+_ANCESTROS_OT = {
+    'plantaId': 'plantaId',
+    'zonaId': 'zonaId',
+    'lineaId': 'lineaId',
+    'maquinaRefId': 'maquinaId',
+}
+_CAMPOS_EQUIPO_OT = ('equipoTipo', 'equipoId', 'maquinaId')
+_LOTE_OT = 500
+
+# Marca en VersionRecurso del relleno inicial de las columnas
+VERSION_ANCESTROS_OT = 'ancestros_ot'
+
+
+# Nivel -> columna desnormalizada de OrdenTrabajo
+_COLUMNA_OT_POR_NIVEL = {
+    'planta': OrdenTrabajo.plantaId,
+    'zona': OrdenTrabajo.zonaId,
+    'linea': OrdenTrabajo.lineaId,
+    'maquina': OrdenTrabajo.maquinaRefId,
+}
+
+
+def filtroOrdenesSubarbol(tipo, equipoId):
+    """
+    Condición de OTs cuyo equipo está en el subárbol de (tipo, equipoId). Usa
+    la columna desnormalizada del nivel (índice nivel+fecha) y, para empresa o
+    elemento, el EXISTS de filtroSubarbol.
+    """
+    columna = _COLUMNA_OT_POR_NIVEL.get(tipo)
+    if columna is not None:
+        return columna == int(equipoId)
+    return filtroSubarbol(tipo, equipoId, OrdenTrabajo.equipoTipo, OrdenTrabajo.equipoId)
+
+
+def _ordenesBajo(conexion, porTipo):
+    """Ids de las OTs cuyo equipo (o maquinaId legacy) está bajo los nodos dados."""
+    r = RutaActivo.__table__
+    ot = OrdenTrabajo.__table__
+    enSubarbol = or_(*[r.c[f'{tipo}Id'].in_(ids) for tipo, ids in porTipo.items()])
+    consulta = select(ot.c.id).where(or_(
+        exists().where(enSubarbol, r.c.tipo == ot.c.equipoTipo, r.c.equipoId == ot.c.equipoId),
+        ot.c.maquinaId.in_(select(r.c.equipoId).where(enSubarbol, r.c.tipo == 'maquina')),
+    ))
+    return [fila.id for fila in conexion.execute(consulta)]
+
+
+def _propagarAncestrosOrdenes(conexion, ids=None):
+    """
+    Recalcula los ancestros de las OTs indicadas (todas si ids es None) desde
+    RutaActivo, por lotes. Si el equipo no existe se usa el maquinaId legacy.
+    Devuelve {id OT: valores}.
+    """
+    ot = OrdenTrabajo.__table__
+    r = RutaActivo.__table__
+    if ids is None:
+        ids = [fila.id for fila in conexion.execute(select(ot.c.id))]
+    ids = list(ids)
+    sentencia = update(ot).where(ot.c.id == bindparam('_id')).values(
+        {col: bindparam(col) for col in _ANCESTROS_OT})
+
+    resultado = {}
+    for i in range(0, len(ids), _LOTE_OT):
+        filas = conexion.execute(
+            select(ot.c.id, ot.c.equipoTipo, ot.c.equipoId, ot.c.maquinaId)
+            .where(ot.c.id.in_(ids[i:i + _LOTE_OT]))
+        ).all()
+        porTipo = {}
+        for f in filas:
+            if f.equipoTipo in MODELOS and f.equipoId:
+                porTipo.setdefault(f.equipoTipo, set()).add(f.equipoId)
+            if f.maquinaId:
+                porTipo.setdefault('maquina', set()).add(f.maquinaId)
+        rutas = {}
+        if porTipo:
+            rutas = {
+                (fila.tipo, fila.equipoId): fila for fila in conexion.execute(
+                    select(r).where(or_(*[
+                        and_(r.c.tipo == tipo, r.c.equipoId.in_(eids))
+                        for tipo, eids in porTipo.items()
+                    ]))
+                )
+            }
+        valores = []
+        for f in filas:
+            ruta = rutas.get((f.equipoTipo, f.equipoId)) or rutas.get(('maquina', f.maquinaId))
+            fila = {col: (getattr(ruta, origen) if ruta else None)
+                    for col, origen in _ANCESTROS_OT.items()}
+            resultado[f.id] = fila
+            valores.append(dict(fila, _id=f.id))
+        if valores:
+            conexion.execute(sentencia, valores)
+    return resultado
+
+
+@event.listens_for(db.session, 'before_flush')
+def _detectarCambiosOrdenes(session, contexto, instancias):
+    pendientes = session.info.setdefault('ordenesPendientes', [])
+    for obj in session.new:
+        if isinstance(obj, OrdenTrabajo):
+            pendientes.append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, OrdenTrabajo) and _cambiaCampos(obj, _CAMPOS_EQUIPO_OT):
+            pendientes.append(obj)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _propagarOrdenesTrasFlush(session, contexto):
+    # Se registra después de la sincronización de rutas: si la OT y su equipo
+    # se crean en el mismo flush, la ruta del equipo ya existe aquí.
+    pendientes = session.info.pop('ordenesPendientes', None)
+    if not pendientes:
+        return
+    porId = {obj.id: obj for obj in pendientes if obj.id is not None and obj not in session.deleted}
+    if not porId:
+        return
+    valores = _propagarAncestrosOrdenes(session.connection(), porId)
+    # Reflejar en memoria lo escrito por SQL, sin marcar la OT como modificada
+    for otId, fila in valores.items():
+        for col, valor in fila.items():
+            set_committed_value(porId[otId], col, valor)
+
+
+def reconstruirAncestrosOrdenes():
+    """Recalcula los ancestros de todas las OTs (relleno inicial y reparaciones)."""
+    from hechos import reconstruirHechos  # hechos importa este módulo
+    conexion = db.session.connection()
+    valores = _propagarAncestrosOrdenes(conexion)
+    reconstruirHechos(conexion)
+    if VersionRecurso.obtener(VERSION_ANCESTROS_OT) == 0:
+        VersionRecurso.incrementar(conexion, VERSION_ANCESTROS_OT)
+    db.session.commit()
+    return len(valores)
+
+
+def asegurarAncestrosOrdenes():
+    """Rellena las columnas de ancestros de las OTs la primera vez (arranque)."""
+    if VersionRecurso.obtener(VERSION_ANCESTROS_OT) == 0:
+        reconstruirAncestrosOrdenes()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidarSnapshotTrasCommit(session):
+    # El worker que ha hecho el cambio descarta su copia sin esperar a la
+    # siguiente comprobación de versión.
+    global _snapshot
+    if session.info.pop('jerarquiaModificada', False):
+        _snapshot = None
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _limpiarMarcaTrasRollback(session):
+    session.info.pop('jerarquiaModificada', None)
+    session.info.pop('jerarquiaPendiente', None)
+    session.info.pop('ordenesPendientes', None)
+
+
+# =============================================================================
+# RESOLUCIÓN DE RUTAS
+# =============================================================================
+
+def obtenerRuta(tipo, equipoId):
+    """Devuelve la RutaActivo de un nodo (una consulta indexada) o None."""
+    if tipo not in MODELOS or not equipoId:
+        return None
+    return RutaActivo.query.filter_by(tipo=tipo, equipoId=int(equipoId)).first()
+
+
+def obtenerRutas(pares):
+    """
+    Resuelve en una sola consulta las rutas de una colección de pares (tipo, id).
+    Devuelve dict {(tipo, id): RutaActivo}; los pares inexistentes no aparecen.
+    """
+    porTipo = {}
+    for tipo, equipoId in pares:
+        if tipo in MODELOS and equipoId:
+            porTipo.setdefault(tipo, set()).add(int(equipoId))
+    if not porTipo:
+        return {}
+
+    filas = RutaActivo.query.filter(or_(*[
+        and_(RutaActivo.tipo == tipo, RutaActivo.equipoId.in_(ids))
+        for tipo, ids in porTipo.items()
+    ])).all()
+    return {(r.tipo, r.equipoId): r for r in filas}
+
+
+# =============================================================================
+# ALCANCE DE SUBÁRBOL
+# =============================================================================
+# Cada fila de RutaActivo lleva los ids de todos sus ancestros (y el suyo en la
+# columna de su nivel), así que "todo lo que cuelga de la planta X" es el
+# predicado indexado RutaActivo.plantaId == X, sin recorrer niveles.
+
+def _columnaAncestro(tipo):
+    return getattr(RutaActivo, f'{tipo}Id') if tipo in MODELOS else None
+
+
+def filtroSubarbol(tipo, equipoId, columnaTipo, columnaId):
+    """
+    Condición SQL: el equipo (columnaTipo, columnaId) pertenece al subárbol de
+    (tipo, equipoId), nodo incluido. columnaTipo puede ser una columna o un
+    literal ('maquina'). Es un único EXISTS sobre RutaActivo, sea cual sea el
+    tamaño del subárbol; con un nivel no válido no selecciona nada.
+    """
+    columna = _columnaAncestro(tipo)
+    if columna is None:
+        return false()
+    return exists().where(
+        columna == int(equipoId),
+        RutaActivo.tipo == columnaTipo,
+        RutaActivo.equipoId == columnaId,
+    )
+
+
+def idsSubarbol(tipo, equipoId, nivel):
+    """Subconsulta con los ids de `nivel` dentro del subárbol (para IN (...))."""
+    columna = _columnaAncestro(tipo)
+    if columna is None:
+        return select(RutaActivo.equipoId).where(false())
+    return select(RutaActivo.equipoId).where(columna == int(equipoId), RutaActivo.tipo == nivel)
+
+
+def rutasSubarbol(tipo=None, equipoId=None):
+    """
+    RutaActivo del nodo y todos sus descendientes en una consulta. Sin nodo
+    devuelve toda la jerarquía salvo las empresas.
+    """
+    if tipo is None:
+        return RutaActivo.query.filter(RutaActivo.tipo != 'empresa').all()
+    columna = _columnaAncestro(tipo)
+    if columna is None:
+        return []
+    return RutaActivo.query.filter(columna == int(equipoId)).all()
+
+
+# =============================================================================
+# BÚSQUEDA DE EQUIPOS (FTS5)
+# =============================================================================
+
+# Texto de la ruta que se indexa: códigos y nombres de los ancestros
+_RUTA_FTS = ("{f}.rutaCodigos || ' ' || ifnull((SELECT group_concat("
+             "json_extract(value, '$.nombre'), ' ') FROM json_each({f}.rutaNombres)), '')")
+
+_SQL_INDICE_BUSQUEDA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS ruta_activo_fts USING fts5("
+    "codigo, nombre, ruta, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    "CREATE TRIGGER IF NOT EXISTS ruta_activo_fts_ai AFTER INSERT ON ruta_activo BEGIN "
+    "INSERT INTO ruta_activo_fts(rowid, codigo, nombre, ruta) "
+    f"VALUES (new.id, new.codigo, new.nombre, {_RUTA_FTS.format(f='new')}); END",
+    "CREATE TRIGGER IF NOT EXISTS ruta_activo_fts_ad AFTER DELETE ON ruta_activo BEGIN "
+    "DELETE FROM ruta_activo_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS ruta_activo_fts_au AFTER UPDATE ON ruta_activo BEGIN "
+    "DELETE FROM ruta_activo_fts WHERE rowid = old.id; "
+    "INSERT INTO ruta_activo_fts(rowid, codigo, nombre, ruta) "
+    f"VALUES (new.id, new.codigo, new.nombre, {_RUTA_FTS.format(f='new')}); END",
+]
+
+# None = sin comprobar; False si la BD no es SQLite o no incluye FTS5
+_indiceBusqueda = None
+
+
+def asegurarIndiceBusqueda():
+    """Crea el índice FTS5 y sus triggers si faltan y lo rellena si está desfasado."""
+    global _indiceBusqueda
+    if db.engine.dialect.name != 'sqlite':
+        _indiceBusqueda = False
+        return
+    try:
+        with db.engine.begin() as conexion:
+            for sql in _SQL_INDICE_BUSQUEDA:
+                conexion.exec_driver_sql(sql)
+            indexadas = conexion.exec_driver_sql('SELECT count(*) FROM ruta_activo_fts').scalar()
+            rutas = conexion.exec_driver_sql('SELECT count(*) FROM ruta_activo').scalar()
+            if indexadas != rutas:
+                conexion.exec_driver_sql('DELETE FROM ruta_activo_fts')
+                conexion.exec_driver_sql(
+                    'INSERT INTO ruta_activo_fts(rowid, codigo, nombre, ruta) '
+                    f"SELECT r.id, r.codigo, r.nombre, {_RUTA_FTS.format(f='r')} FROM ruta_activo r")
+        _indiceBusqueda = True
+    except Exception as e:
+        print(f"Índice de búsqueda FTS5 no disponible, se usará LIKE: {e}")
+        _indiceBusqueda = False
+
+
+def buscarEquipos(texto, limite=20, tipo=None):
+    """
+    Equipos cuyo código, nombre o ruta contienen todos los términos buscados
+    (como prefijo de palabra), ordenados por relevancia BM25 con más peso en
+    el código que en el nombre y en este que en la ruta. Devuelve RutaActivo.
+    """
+    terminos = re.findall(r'\w+', texto or '')
+    if not terminos:
+        return []
+    if _indiceBusqueda is None:
+        asegurarIndiceBusqueda()
+
+    if _indiceBusqueda:
+        filtroTipo = 'AND ruta_activo.tipo = :tipo' if tipo else ''
+        consulta = text(
+            'SELECT ruta_activo.* FROM ruta_activo_fts '
+            'JOIN ruta_activo ON ruta_activo.id = ruta_activo_fts.rowid '
+            f'WHERE ruta_activo_fts MATCH :consulta {filtroTipo} '
+            'ORDER BY bm25(ruta_activo_fts, 10.0, 5.0, 1.0) LIMIT :limite'
+        )
+        parametros = {'consulta': ' '.join(f'"{t}"*' for t in terminos), 'limite': limite}
+        if tipo:
+            parametros['tipo'] = tipo
+        return db.session.execute(
+            select(RutaActivo).from_statement(consulta), parametros
+        ).scalars().all()
+
+    # Sin FTS5: subcadena en código, nombre o ruta, priorizando el código
+    query = RutaActivo.query
+    for t in terminos:
+        patron = f'%{t}%'
+        query = query.filter(or_(RutaActivo.codigo.ilike(patron), RutaActivo.nombre.ilike(patron),
+                                 RutaActivo.rutaCodigos.ilike(patron), RutaActivo.rutaNombres.ilike(patron)))
+    if tipo:
+        query = query.filter(RutaActivo.tipo == tipo)
+    return query.order_by(RutaActivo.codigo.ilike(f'{terminos[0]}%').desc(),
+                          RutaActivo.codigo).limit(limite).all()
+
+
+# =============================================================================
+# SNAPSHOT VERSIONADO EN MEMORIA
+# =============================================================================
+
+# Columnas que se copian de cada nivel (la FK al padre va siempre en 2ª posición)
+_CAMPOS_SNAPSHOT = {
+    'empresa': ('id', 'codigo', 'nombre'),
+    'planta': ('id', 'empresaId', 'codigo', 'nombre'),
+    'zona': ('id', 'plantaId', 'codigo', 'nombre'),
+    'linea': ('id', 'zonaId', 'codigo', 'nombre'),
+    'maquina': ('id', 'lineaId', 'codigo', 'nombre', 'estado', 'criticidad', 'rav'),
+    'elemento': ('id', 'maquinaId', 'codigo', 'nombre', 'rav'),
+}
+
+_FILAS_SNAPSHOT = {
+    tipo: namedtuple(f'{tipo.capitalize()}Snapshot', campos)
+    for tipo, campos in _CAMPOS_SNAPSHOT.items()
+}
+
+
+class SnapshotJerarquia:
+    """
+    Copia inmutable de la jerarquía completa: por nivel, un dict id → fila
+    (namedtuple con la FK al padre) y un índice de hijos por nodo padre.
+    """
+    __slots__ = ('version', 'nodos', 'hijos', '_porCodigo')
+
+    def __init__(self, version, nodos):
+        self.version = version
+        self.nodos = MappingProxyType({t: MappingProxyType(d) for t, d in nodos.items()})
+
+        hijos = {}
+        for tipo, (fk, _rel) in _PADRE.items():
+            tipoPadre = NIVELES[NIVELES.index(tipo) - 1]
+            for fila in nodos[tipo].values():
+                hijos.setdefault((tipoPadre, getattr(fila, fk)), []).append(fila.id)
+        self.hijos = MappingProxyType({k: tuple(v) for k, v in hijos.items()})
+
+        self._porCodigo = MappingProxyType({
+            tipo: MappingProxyType({f.codigo: f for f in d.values()})
+            for tipo, d in nodos.items()
+        })
+
+    # Accesos por nivel con los nombres que usan los servicios
+    empresas = property(lambda self: self.nodos['empresa'])
+    plantas = property(lambda self: self.nodos['planta'])
+    zonas = property(lambda self: self.nodos['zona'])
+    lineas = property(lambda self: self.nodos['linea'])
+    maquinas = property(lambda self: self.nodos['maquina'])
+    elementos = property(lambda self: self.nodos['elemento'])
+
+    def get(self, tipo, equipoId):
+        """Fila de un nodo o None."""
+        nivel = self.nodos.get(tipo)
+        return nivel.get(equipoId) if nivel is not None else None
+
+    def porCodigo(self, tipo):
+        """Dict codigo → fila de un nivel."""
+        return self._porCodigo[tipo]
+
+    def padre(self, tipo, equipoId):
+        """(tipo, id) del padre de un nodo, o None."""
+        fila = self.get(tipo, equipoId)
+        if fila is None or tipo not in _PADRE:
+            return None
+        return NIVELES[NIVELES.index(tipo) - 1], getattr(fila, _PADRE[tipo][0])
+
+    def ancestro(self, tipo, equipoId, nivel):
+        """
+        Id del ancestro de `nivel` (p. ej. la línea de un elemento). Si el nodo
+        es de ese mismo nivel devuelve su id; None si no existe o está por encima.
+        """
+        if tipo not in self.nodos or nivel not in self.nodos:
+            return None
+        if NIVELES.index(tipo) < NIVELES.index(nivel):
+            return None
+        actual = (tipo, equipoId)
+        while actual is not None and actual[0] != nivel:
+            actual = self.padre(*actual)
+        if actual is None or self.get(*actual) is None:
+            return None
+        return actual[1]
+
+
+_snapshot = None
+_snapshotLock = threading.Lock()
+
+
+def _construirSnapshot(version):
+    nodos = {}
+    for tipo, campos in _CAMPOS_SNAPSHOT.items():
+        tabla = MODELOS[tipo].__table__
+        fila = _FILAS_SNAPSHOT[tipo]
+        nodos[tipo] = {
+            r.id: fila(*r)
+            for r in db.session.execute(select(*[tabla.c[c] for c in campos]))
+        }
+    return SnapshotJerarquia(version, nodos)
+
+
+def obtenerSnapshot():
+    """
+    Devuelve el snapshot de la jerarquía. Cada worker conserva el suyo y solo lo
+    reconstruye cuando la versión en BD difiere (una lectura por clave primaria).
+    """
+    global _snapshot
+    version = VersionRecurso.obtener(VERSION_JERARQUIA)
+    snap = _snapshot
+    if snap is not None and snap.version == version:
+        return snap
+    with _snapshotLock:
+        snap = _snapshot
+        if snap is None or snap.version != version:
+            snap = _construirSnapshot(version)
+            _snapshot = snap
+    return snap
@@ -0,0 +1,223 @@
+"""
+Migraciones versionadas del esquema de la base de datos.
+
+db.create_all() solo crea las tablas que no existen: no añade columnas ni
+índices a una gmao.db ya en uso. Cada cambio de esquema sobre tablas existentes
+se registra aquí como una migración numerada que se aplica una sola vez y en
+orden, anotándose en la tabla migracion_esquema.
+
+Las columnas e índices se declaran en models.py (así una base nueva los recibe
+con create_all) y la migración solo los materializa en las bases existentes,
+por lo que todas son idempotentes: en una base recién creada no hacen nada.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import inspect
+
+from models import db, MigracionEsquema, OrdenTrabajo, CosteExterno
+from busqueda import crearIndiceOrdenes
+from costes import reconstruirCostes, recalcularCostes
+from hechos import reconstruirHechos
+from cache_kpis import vaciarResultados
+
+
+MIGRACIONES = []
+
+
+def migracion(version, nombre):
+    """Registra una función (conexion) -> None como migración de esquema."""
+    def registrar(funcion):
+        MIGRACIONES.append((version, nombre, funcion))
+        return funcion
+    return registrar
+
+
+# =============================================================================
+# OPERACIONES DE ESQUEMA
+# =============================================================================
+
+def _anadirColumnas(conexion, tabla, *columnas):
+    """ALTER TABLE ADD COLUMN de las columnas declaradas en el modelo que falten"""
+    existentes = {c['name'] for c in inspect(conexion).get_columns(tabla)}
+    definicion = db.metadata.tables[tabla]
+    for nombre in columnas:
+        if nombre in existentes:
+            continue
+        columna = definicion.c[nombre]
+        tipo = columna.type.compile(conexion.dialect)
+        conexion.exec_driver_sql(f'ALTER TABLE {tabla} ADD COLUMN "{nombre}" {tipo}')
+
+
+def _crearIndices(conexion, tabla, *indices):
+    """Crea los índices declarados en el modelo que aún no existan"""
+    declarados = {i.name: i for i in db.metadata.tables[tabla].indexes}
+    for nombre in indices:
+        declarados[nombre].create(bind=conexion, checkfirst=True)
+
+
+# =============================================================================
+# MIGRACIONES
+# =============================================================================
+
+@migracion(1, 'ancestros_ot_e_indices_jerarquia')
+def _ancestrosOrdenes(conexion):
+    _crearIndices(conexion, 'planta', 'ix_planta_empresaId')
+    _crearIndices(conexion, 'zona', 'ix_zona_plantaId')
+    _crearIndices(conexion, 'linea', 'ix_linea_zonaId')
+    _crearIndices(conexion, 'maquina', 'ix_maquina_lineaId')
+    _crearIndices(conexion, 'elemento', 'ix_elemento_maquinaId')
+    _anadirColumnas(conexion, 'orden_trabajo', 'plantaId', 'zonaId', 'lineaId', 'maquinaRefId')
+    _crearIndices(conexion, 'orden_trabajo',
+                  'ix_ot_planta_creacion', 'ix_ot_zona_creacion',
+                  'ix_ot_linea_creacion', 'ix_ot_maquina_creacion',
+                  'ix_ot_planta_fin', 'ix_ot_zona_fin',
+                  'ix_ot_linea_fin', 'ix_ot_maquina_fin',
+                  'ix_ot_creacion')
+
+
+@migracion(2, 'indices_consultas_frecuentes')
+def _indicesConsultasFrecuentes(conexion):
+    _crearIndices(conexion, 'orden_trabajo',
+                  'ix_ot_estado_tipo', 'ix_ot_equipo', 'ix_ot_maquina_legacy',
+                  'ix_ot_tipo_creacion', 'ix_ot_tipo_fin', 'ix_ot_programada',
+                  'ix_ot_gama', 'ix_ot_tecnico_estado')
+    _crearIndices(conexion, 'registro_tiempo', 'ix_registro_tiempo_orden_curso')
+    _crearIndices(conexion, 'movimiento_stock', 'ix_movimiento_recambio_fecha')
+    _crearIndices(conexion, 'consumo_recambio', 'ix_consumo_orden')
+
+
+@migracion(3, 'secuencia_numeros_ot')
+def _secuenciaNumerosOrdenes(conexion):
+    # Arranca cada contador anual en el mayor número AAXXXXX ya emitido
+    conexion.exec_driver_sql("""
+        INSERT INTO secuencia_ot (anio, ultimo)
+        SELECT substr(numero, 1, 2), MAX(CAST(substr(numero, 3) AS INTEGER))
+        FROM orden_trabajo
+        WHERE length(numero) > 2 AND numero NOT GLOB '*[^0-9]*'
+        GROUP BY substr(numero, 1, 2)
+        ON CONFLICT(anio) DO UPDATE SET ultimo = MAX(ultimo, excluded.ultimo)
+    """)
+
+
+@migracion(4, 'busqueda_texto_ordenes')
+def _busquedaTextoOrdenes(conexion):
+    # Índice FTS5, triggers y carga del histórico existente
+    crearIndiceOrdenes(conexion)
+
+
+@migracion(5, 'sesiones_abiertas_ot')
+def _sesionesAbiertasOrdenes(conexion):
+    # Contador de registros de tiempo en curso; tiempoReal ya estaba acumulado
+    _anadirColumnas(conexion, 'orden_trabajo', 'sesionesAbiertas')
+    conexion.exec_driver_sql("""
+        UPDATE orden_trabajo SET "sesionesAbiertas" = (
+            SELECT count(*) FROM registro_tiempo
+            WHERE registro_tiempo."ordenId" = orden_trabajo.id AND registro_tiempo."enCurso" = 1
+        )
+    """)
+
+
+@migracion(6, 'resumen_costes_ot')
+def _resumenCostesOrdenes(conexion):
+    # La tabla coste_orden la crea create_all; se carga con el histórico
+    reconstruirCostes(conexion)
+
+
+@migracion(7, 'costes_externos_relacionales')
+def _costesExternosRelacionales(conexion):
+    # Pasa la lista JSON de costes externos (o el coste legacy único) de cada
+    # OT a líneas de coste_externo. Se saltan las OTs que ya tienen líneas.
+    ot = OrdenTrabajo.__table__
+    ce = CosteExterno.__table__
+    conLineas = set(conexion.execute(db.select(ce.c.ordenId).distinct()).scalars())
+    filas = conexion.execute(db.select(
+        ot.c.id, ot.c.costesExternosJson, ot.c.costeTallerExterno, ot.c.proveedorExterno,
+        ot.c.descripcionTallerExterno, ot.c.fechaFin, ot.c.fechaCreacion,
+    ).where(db.or_(ot.c.costesExternosJson.isnot(None), ot.c.costeTallerExterno > 0))).all()
+
+    lineas = []
+    for id, costesJson, total, proveedor, descripcion, fechaFin, fechaCreacion in filas:
+        if id in conLineas:
+            continue
+        try:
+            costes = json.loads(costesJson) if costesJson else []
+        except ValueError:
+            costes = []
+        if not costes and total:
+            costes = [{'proveedor': proveedor, 'descripcion': descripcion, 'coste': total}]
+        for c in costes:
+            lineas.append({
+                'ordenId': id, 'proveedor': (c.get('proveedor') or '').strip(),
+                'descripcion': c.get('descripcion') or '',
+                'coste': round(float(c.get('coste') or 0), 2),
+                'fecha': fechaFin or fechaCreacion,
+            })
+    if not lineas:
+        return
+    conexion.execute(ce.insert(), lineas)
+    totales = {}
+    for l in lineas:
+        totales[l['ordenId']] = totales.get(l['ordenId'], 0) + l['coste']
+    conexion.execute(
+        ot.update().where(ot.c.id == db.bindparam('_id')).values(costeTallerExterno=db.bindparam('_total')),
+        [{'_id': id, '_total': round(total, 2)} for id, total in totales.items()],
+    )
+    recalcularCostes(conexion, totales)
+
+
+@migracion(8, 'agregado_mensual_ot')
+def _agregadoMensualOrdenes(conexion):
+    # La tabla hecho_mensual_orden la crea create_all; se carga con el histórico
+    reconstruirHechos(conexion)
+
+
+@migracion(9, 'turnos_linea_y_festivos')
+def _turnosLineaFestivos(conexion):
+    # Turno propio de cada línea (NULL = el de la planta); la tabla festivo la
+    # crea create_all
+    _anadirColumnas(conexion, 'linea', 'turno')
+
+
+@migracion(10, 'agregado_mensual_kpis')
+def _agregadoMensualKpis(conexion):
+    # Mes programado y recuentos de programa y calidad de datos para los KPIs;
+    # las filas existentes no los tienen, así que se rehace el agregado
+    _anadirColumnas(conexion, 'hecho_mensual_orden', 'mesProgramada', 'programadas',
+                    'programadasCerradas', 'programadasEnPlazo', 'completas')
+    reconstruirHechos(conexion)
+
+
+# =============================================================================
+# EJECUCIÓN
+# =============================================================================
+
+def versionEsquema():
+    """Última migración aplicada (0 si ninguna)"""
+    return db.session.query(db.func.max(MigracionEsquema.version)).scalar() or 0
+
+
+def aplicarMigraciones():
+    """
+    Crea las tablas que falten y aplica en orden las migraciones pendientes.
+    Devuelve la lista de (version, nombre) aplicadas en esta llamada.
+    """
+    db.create_all()
+    tabla = MigracionEsquema.__table__
+    with db.engine.connect() as conexion:
+        hechas = set(conexion.execute(db.select(tabla.c.version)).scalars())
+
+    aplicadas = []
+    for version, nombre, funcion in sorted(MIGRACIONES, key=lambda m: m[0]):
+        if version in hechas:
+            continue
+        # Se anota al terminar; si se interrumpe, al ser idempotente se repite
+        # entera en el siguiente arranque
+        with db.engine.begin() as conexion:
+            funcion(conexion)
+            # Los resultados de KPIs cacheados pueden depender de lo migrado
+            vaciarResultados(conexion)
+            conexion.execute(tabla.insert().values(
+                version=version, nombre=nombre, fechaAplicacion=datetime.now()))
+        aplicadas.append((version, nombre))
+    return aplicadas
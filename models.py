@@ -1,7 +1,10 @@
 # Definición de los modelos de datos para la aplicación GMAO usando SQLAlchemy
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, update, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, date
 import hashlib
+import json
 from werkzeug.security import generate_password_hash, check_password_hash as _check_password_hash
 
 db = SQLAlchemy()
@@ -24,7 +27,7 @@ class Empresa(db.Model):
 # Modelo para representar una Planta, dependiente de una Empresa
 class Planta(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    empresaId = db.Column(db.Integer, db.ForeignKey('empresa.id'), nullable=False)
+    empresaId = db.Column(db.Integer, db.ForeignKey('empresa.id'), nullable=False, index=True)
     codigo = db.Column(db.String(10), nullable=False)
     nombre = db.Column(db.String(100), nullable=False)
     descripcion = db.Column(db.Text)
@@ -34,7 +37,7 @@ class Planta(db.Model):
 # Modelo para representar una Zona dentro de una Planta
 class Zona(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    plantaId = db.Column(db.Integer, db.ForeignKey('planta.id'), nullable=False)
+    plantaId = db.Column(db.Integer, db.ForeignKey('planta.id'), nullable=False, index=True)
     codigo = db.Column(db.String(10), nullable=False)
     nombre = db.Column(db.String(100), nullable=False)
     descripcion = db.Column(db.Text)
@@ -43,16 +46,17 @@ class Zona(db.Model):
 # Modelo para representar una Línea dentro de una Zona
 class Linea(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    zonaId = db.Column(db.Integer, db.ForeignKey('zona.id'), nullable=False)
+    zonaId = db.Column(db.Integer, db.ForeignKey('zona.id'), nullable=False, index=True)
     codigo = db.Column(db.String(10), nullable=False)
     nombre = db.Column(db.String(100), nullable=False)
     descripcion = db.Column(db.Text)
+    turno = db.Column(db.String(10))  # Régimen propio ('16/5'...); None = turno_planta (ver calendario.py)
     maquinas = db.relationship('Maquina', backref='linea', lazy=True, cascade='all, delete-orphan')
 
 # Modelo para representar una Máquina dentro de una Línea
 class Maquina(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    lineaId = db.Column(db.Integer, db.ForeignKey('linea.id'), nullable=False)
+    lineaId = db.Column(db.Integer, db.ForeignKey('linea.id'), nullable=False, index=True)
     codigo = db.Column(db.String(10), nullable=False)
     nombre = db.Column(db.String(100), nullable=False)
     modelo = db.Column(db.String(50))
@@ -72,7 +76,7 @@ class Maquina(db.Model):
 # Modelo para representar un Elemento dentro de una Máquina
 class Elemento(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    maquinaId = db.Column(db.Integer, db.ForeignKey('maquina.id'), nullable=False)
+    maquinaId = db.Column(db.Integer, db.ForeignKey('maquina.id'), nullable=False, index=True)
     codigo = db.Column(db.String(10), nullable=False)
     nombre = db.Column(db.String(100), nullable=False)
     tipo = db.Column(db.String(50))
@@ -82,6 +86,30 @@ class Elemento(db.Model):
     numeroSerie = db.Column(db.String(50))
     rav = db.Column(db.Float, default=0.0)             # Valor de reposición (RAV)
 
+# Índice materializado de rutas: una fila por nodo de la jerarquía con los ids,
+# códigos y nombres de todos sus ancestros. Se mantiene en la misma transacción
+# que los cambios del árbol (ver jerarquia.py).
+class RutaActivo(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), nullable=False)  # empresa, planta, zona, linea, maquina, elemento
+    equipoId = db.Column(db.Integer, nullable=False)
+    codigo = db.Column(db.String(10))
+    nombre = db.Column(db.String(100))
+    empresaId = db.Column(db.Integer, index=True)
+    plantaId = db.Column(db.Integer, index=True)
+    zonaId = db.Column(db.Integer, index=True)
+    lineaId = db.Column(db.Integer, index=True)
+    maquinaId = db.Column(db.Integer, index=True)
+    elementoId = db.Column(db.Integer, index=True)
+    rutaCodigos = db.Column(db.Text)   # 'EMP > PLA > ZON > LIN > MAQ > ELE'
+    rutaNombres = db.Column(db.Text)   # JSON [{id, nombre, codigo, tipo}] desde Planta hasta el nodo
+
+    __table_args__ = (db.UniqueConstraint('tipo', 'equipoId'),)
+
+    @property
+    def rutaNombresLista(self):
+        return json.loads(self.rutaNombres) if self.rutaNombres else []
+
 # =============================================================================
 # MODELO DE RECAMBIOS Y STOCK
 # =============================================================================
@@ -133,6 +161,10 @@ class MovimientoStock(db.Model):
     documentoRef = db.Column(db.String(50))  # Nº albarán, OT, etc.
     usuario = db.Column(db.String(100))
 
+    __table_args__ = (
+        db.Index('ix_movimiento_recambio_fecha', 'recambioId', 'fecha'),
+    )
+
 # =============================================================================
 # TIPOS DE INTERVENCIÓN CONFIGURABLES
 # =============================================================================
@@ -194,45 +226,195 @@ class OrdenTrabajo(db.Model):
     # Trabajo realizado
     tecnicoAsignado = db.Column(db.String(100))  # Técnico principal (legacy)
     tiempoEstimado = db.Column(db.Float)  # horas
-    tiempoReal = db.Column(db.Float)  # horas (calculado de registros)
+    tiempoReal = db.Column(db.Float)  # horas (acumulado al cerrar cada registro de tiempo)
+    sesionesAbiertas = db.Column(db.Integer, default=0)  # registros de tiempo en curso
     tiempoParada = db.Column(db.Float)  # horas de parada de máquina
     
     # Coste de talleres externos
-    costeTallerExterno = db.Column(db.Float, default=0)  # Total acumulado (calculado)
-    descripcionTallerExterno = db.Column(db.Text)  # LEGACY - primer coste
-    proveedorExterno = db.Column(db.String(100))   # LEGACY - primer coste
-    costesExternosJson = db.Column(db.Text)  # JSON list de {proveedor, descripcion, coste}
+    costeTallerExterno = db.Column(db.Float, default=0)  # Total de las líneas de CosteExterno (calculado)
+    descripcionTallerExterno = db.Column(db.Text)  # LEGACY - migrado a CosteExterno
+    proveedorExterno = db.Column(db.String(100))   # LEGACY - migrado a CosteExterno
+    costesExternosJson = db.Column(db.Text)  # LEGACY - migrado a CosteExterno (migración 7)
 
     
     # Auditoría
     creadoPor = db.Column(db.String(100))
     cerradoPor = db.Column(db.String(100))
+
+    # Ancestros resueltos del equipo (desnormalizados; los mantiene jerarquia.py
+    # al crear/editar la OT y al mover activos). maquinaRefId incluye el legacy maquinaId.
+    plantaId = db.Column(db.Integer)
+    zonaId = db.Column(db.Integer)
+    lineaId = db.Column(db.Integer)
+    maquinaRefId = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_ot_planta_creacion', 'plantaId', 'fechaCreacion'),
+        db.Index('ix_ot_zona_creacion', 'zonaId', 'fechaCreacion'),
+        db.Index('ix_ot_linea_creacion', 'lineaId', 'fechaCreacion'),
+        db.Index('ix_ot_maquina_creacion', 'maquinaRefId', 'fechaCreacion'),
+        db.Index('ix_ot_planta_fin', 'plantaId', 'fechaFin'),
+        db.Index('ix_ot_zona_fin', 'zonaId', 'fechaFin'),
+        db.Index('ix_ot_linea_fin', 'lineaId', 'fechaFin'),
+        db.Index('ix_ot_maquina_fin', 'maquinaRefId', 'fechaFin'),
+        db.Index('ix_ot_creacion', 'fechaCreacion'),
+        # Listados y filtros frecuentes (migración 2)
+        db.Index('ix_ot_estado_tipo', 'estado', 'tipo'),
+        db.Index('ix_ot_equipo', 'equipoTipo', 'equipoId'),
+        db.Index('ix_ot_maquina_legacy', 'maquinaId'),
+        db.Index('ix_ot_tipo_creacion', 'tipo', 'fechaCreacion'),
+        db.Index('ix_ot_tipo_fin', 'tipo', 'fechaFin'),
+        db.Index('ix_ot_programada', 'fechaProgramada'),
+        db.Index('ix_ot_gama', 'gamaId'),
+        db.Index('ix_ot_tecnico_estado', 'tecnicoAsignado', 'estado'),
+    )
     
     # Relaciones
     consumos = db.relationship('ConsumoRecambio', backref='ordenTrabajo', lazy=True, cascade='all, delete-orphan')
+    costesExternos = db.relationship('CosteExterno', backref='ordenTrabajo', lazy=True,
+                                     cascade='all, delete-orphan', order_by='CosteExterno.id')
     registrosTiempo = db.relationship('RegistroTiempo', backref='ordenTrabajo', lazy=True, cascade='all, delete-orphan')
     respuestasChecklist = db.relationship('RespuestaChecklist', backref='ordenTrabajo', lazy=True, cascade='all, delete-orphan')
     
+    def abrirSesion(self, tecnico, inicio=None):
+        """Crea un registro de tiempo en curso para el técnico y lo cuenta como abierto"""
+        registro = RegistroTiempo(ordenId=self.id, tecnico=tecnico,
+                                  inicio=inicio or datetime.now(), enCurso=True)
+        # Incremento en SQL: dos peticiones simultáneas no pierden ninguno
+        ot = OrdenTrabajo.__table__
+        db.session.execute(update(ot).where(ot.c.id == self.id).values(
+            sesionesAbiertas=func.coalesce(ot.c.sesionesAbiertas, 0) + 1))
+        db.session.expire(self, ['sesionesAbiertas'])
+        return registro
+
+    def cerrarSesion(self, registro, fin=None):
+        """
+        Cierra un registro de tiempo y suma su duración a tiempoReal, sin
+        recorrer el resto de registros de la OT (scripts/verificar_tiempos.py
+        recalcula desde cero para comprobarlo).
+
+        El cierre es un UPDATE condicionado a enCurso: si otra petición ya lo
+        cerró (p. ej. doble pulsación de "pausar") no se suma nada y devuelve
+        None; si no, devuelve la duración en horas. tiempoReal y
+        sesionesAbiertas se actualizan en SQL sobre el valor guardado.
+        """
+        cerrados = OrdenTrabajo.cerrarSesiones([(self, [registro], fin or datetime.now())])
+        return registro.duracionHoras if cerrados else None
+
+    @staticmethod
+    def cerrarSesiones(cierres):
+        """
+        Cierre de registros de tiempo de varias OTs a la vez, con las mismas
+        reglas que cerrarSesion. `cierres` es una lista de (orden, registros,
+        fin); cada registro se cierra con el fin de su OT. Son dos sentencias
+        para todo el lote: un UPDATE de los registros condicionado a enCurso
+        (RETURNING dice cuáles cerró esta petición) y otro que suma a cada OT
+        sus duraciones y descuenta sus sesiones abiertas.
+        Devuelve los registros cerrados; los que ya estaban cerrados se recargan.
+        """
+        registros = [r for _, regs, _ in cierres for r in regs]
+        if not registros:
+            return []
+        fines = {orden.id: fin for orden, regs, fin in cierres if regs}
+        rt = RegistroTiempo.__table__
+        cerradosIds = set(db.session.execute(
+            update(rt).where(rt.c.id.in_([r.id for r in registros]), rt.c.enCurso == True)
+            .values(fin=case(fines, value=rt.c.ordenId), enCurso=False)
+            .returning(rt.c.id)
+        ).scalars())
+
+        cerrados, horas, sesiones = [], {}, {}
+        for orden, regs, fin in cierres:
+            for registro in regs:
+                if registro.id not in cerradosIds:
+                    db.session.refresh(registro)
+                    continue
+                # Mismos valores en el objeto: la sesión lo ve modificado (eventos, costes, caché)
+                registro.fin = fin
+                registro.enCurso = False
+                horas[orden.id] = horas.get(orden.id, 0) + max(registro.duracionHoras, 0)
+                sesiones[orden.id] = sesiones.get(orden.id, 0) + 1
+                cerrados.append(registro)
+        if not cerrados:
+            return cerrados
+
+        ot = OrdenTrabajo.__table__
+        db.session.execute(update(ot).where(ot.c.id.in_(list(horas))).values(
+            tiempoReal=func.round(func.coalesce(ot.c.tiempoReal, 0) + case(horas, value=ot.c.id), 2),
+            sesionesAbiertas=func.max(func.coalesce(ot.c.sesionesAbiertas, 0)
+                                      - case(sesiones, value=ot.c.id), 0)))
+        for orden, _, _ in cierres:
+            if orden.id in horas:
+                db.session.expire(orden, ['tiempoReal', 'sesionesAbiertas'])
+        return cerrados
+
     @staticmethod
     def generarNumero():
         """Genera un número de OT con formato AAXXXXX (AA = año, XXXXX = contador anual)"""
+        return OrdenTrabajo.reservarNumeros(1)[0]
+
+    @staticmethod
+    def reservarNumeros(cantidad):
+        """Reserva `cantidad` números de OT consecutivos del año en curso (una sola sentencia)"""
+        if cantidad <= 0:
+            return []
         anio = date.today().strftime('%y')  # Últimas 2 cifras del año
-        
-        # Buscar la última OT del año actual
-        ultima = OrdenTrabajo.query.filter(
-            OrdenTrabajo.numero.like(f'{anio}%')
-        ).order_by(OrdenTrabajo.numero.desc()).first()
-        
-        if ultima:
-            try:
-                # Extraer el contador de los últimos 5 dígitos
-                secuencia = int(ultima.numero[2:]) + 1
-            except:
-                secuencia = 1
-        else:
-            secuencia = 1
-        
-        return f'{anio}{secuencia:05d}'
+        ultimo = SecuenciaOT.reservar(anio, cantidad)
+        return [f'{anio}{n:05d}' for n in range(ultimo - cantidad + 1, ultimo + 1)]
+
+# Contador anual de números de OT. La fila del año se incrementa con un upsert
+# atómico dentro de la transacción que crea las OTs: dos procesos no pueden
+# obtener el mismo número y no hace falta buscar la última OT del año.
+class SecuenciaOT(db.Model):
+    anio = db.Column(db.String(2), primary_key=True)  # AA
+    ultimo = db.Column(db.Integer, nullable=False, default=0)  # último contador emitido
+
+    @staticmethod
+    def reservar(anio, cantidad=1):
+        """Incrementa el contador del año en `cantidad` y devuelve el nuevo último valor"""
+        tabla = SecuenciaOT.__table__
+        sentencia = sqlite_insert(tabla).values(anio=anio, ultimo=cantidad)
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=[tabla.c.anio],
+            set_={'ultimo': tabla.c.ultimo + cantidad},
+        ).returning(tabla.c.ultimo)
+        return db.session.execute(sentencia).scalar_one()
+
+    @staticmethod
+    def sincronizar(numeros):
+        """
+        Avanza los contadores hasta los números AAXXXXX dados si los superan
+        (OTs importadas con número propio). Ignora los de otro formato.
+        """
+        maximos = {}
+        for numero in numeros:
+            numero = str(numero or '')
+            if len(numero) > 2 and numero.isdigit():
+                anio, valor = numero[:2], int(numero[2:])
+                maximos[anio] = max(valor, maximos.get(anio, 0))
+        if not maximos:
+            return
+        tabla = SecuenciaOT.__table__
+        sentencia = sqlite_insert(tabla)
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=[tabla.c.anio],
+            set_={'ultimo': func.max(tabla.c.ultimo, sentencia.excluded.ultimo)},
+        )
+        db.session.execute(sentencia, [{'anio': a, 'ultimo': v} for a, v in maximos.items()])
+
+# Línea de coste de taller / proveedor externo en una OT
+class CosteExterno(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    ordenId = db.Column(db.Integer, db.ForeignKey('orden_trabajo.id'), nullable=False)
+    proveedor = db.Column(db.String(100))
+    descripcion = db.Column(db.Text)
+    coste = db.Column(db.Float, nullable=False, default=0)
+    fecha = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_coste_externo_orden', 'ordenId'),
+        db.Index('ix_coste_externo_proveedor_fecha', 'proveedor', 'fecha'),
+    )
 
 # Consumo de recambios en una OT
 class ConsumoRecambio(db.Model):
@@ -243,6 +425,10 @@ class ConsumoRecambio(db.Model):
     precioUnitario = db.Column(db.Float)
     fecha = db.Column(db.DateTime, default=datetime.now)
 
+    __table_args__ = (
+        db.Index('ix_consumo_orden', 'ordenId'),
+    )
+
 # Registro de tiempo de trabajo en una OT
 class RegistroTiempo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -251,6 +437,10 @@ class RegistroTiempo(db.Model):
     inicio = db.Column(db.DateTime, nullable=False)
     fin = db.Column(db.DateTime)  # NULL si está en curso
     enCurso = db.Column(db.Boolean, default=True)
+
+    __table_args__ = (
+        db.Index('ix_registro_tiempo_orden_curso', 'ordenId', 'enCurso'),
+    )
     
     @property
     def duracionHoras(self):
@@ -259,6 +449,89 @@ class RegistroTiempo(db.Model):
             return (datetime.now() - self.inicio).total_seconds() / 3600
         return (self.fin - self.inicio).total_seconds() / 3600
 
+# Registro de cambios de las OTs para notificar a los clientes (ver eventos.py).
+# AUTOINCREMENT evita reutilizar ids tras purgar: el id es la posición del
+# cliente en el flujo (Last-Event-ID).
+class EventoOrden(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    ordenId = db.Column(db.Integer, nullable=False)  # sin FK: sobrevive al borrado de la OT
+    tipo = db.Column(db.String(20), nullable=False)  # creada, estado, asignada, trabajo_iniciado...
+    datos = db.Column(db.Text)  # JSON compacto con los campos que cambian en los listados
+    fecha = db.Column(db.DateTime, default=datetime.now, index=True)
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+# Resumen de horas y costes de una OT, mantenido al escribir sus registros de
+# tiempo, consumos y costes externos (ver costes.py). Los informes lo leen con
+# un join en lugar de cargar los registros de cada OT.
+class CosteOrden(db.Model):
+    ordenId = db.Column(db.Integer, primary_key=True, autoincrement=False)  # OT (se borra con ella)
+    horas = db.Column(db.Float, nullable=False, default=0)           # horas de intervención
+    costeManoObra = db.Column(db.Float, nullable=False, default=0)
+    costeRecambios = db.Column(db.Float, nullable=False, default=0)
+    costeExterno = db.Column(db.Float, nullable=False, default=0)
+    registros = db.Column(db.Integer, nullable=False, default=0)      # registros de tiempo de la OT
+    fechaCalculo = db.Column(db.DateTime, default=datetime.now)
+
+    @property
+    def costeTotal(self):
+        return self.costeManoObra + self.costeRecambios + self.costeExterno
+
+# Agregado mensual de OTs por (mes de creación, equipo, tipo, prioridad),
+# mantenido al escribir las OTs y su resumen de costes (ver hechos.py). Los
+# dashboards lo leen en lugar de agrupar orden_trabajo por strftime.
+class HechoMensualOrden(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.String(7), nullable=False)  # 'AAAA-MM' de fechaCreacion
+    equipoTipo = db.Column(db.String(20))
+    equipoId = db.Column(db.Integer)
+    # Ancestros del equipo, copiados de la OT para filtrar por nivel
+    plantaId = db.Column(db.Integer)
+    zonaId = db.Column(db.Integer)
+    lineaId = db.Column(db.Integer)
+    maquinaRefId = db.Column(db.Integer)
+    tipo = db.Column(db.String(50))
+    prioridad = db.Column(db.String(20))
+    ordenes = db.Column(db.Integer, nullable=False, default=0)
+    fallos = db.Column(db.Integer, nullable=False, default=0)         # OTs con tiempoParada > 0
+    horasParo = db.Column(db.Float, nullable=False, default=0)        # suma de tiempoParada
+    horasFallo = db.Column(db.Float, nullable=False, default=0)       # tiempoParada de los fallos
+    horas = db.Column(db.Float, nullable=False, default=0)            # horas de intervención
+    costeManoObra = db.Column(db.Float, nullable=False, default=0)
+    costeRecambios = db.Column(db.Float, nullable=False, default=0)
+    costeExterno = db.Column(db.Float, nullable=False, default=0)
+    # Cumplimiento de programa y calidad de datos (KPIs O12, T12, O18; migración 10)
+    mesProgramada = db.Column(db.String(7))                           # 'AAAA-MM' de fechaProgramada
+    programadas = db.Column(db.Integer, nullable=False, default=0)    # con fechaProgramada
+    programadasCerradas = db.Column(db.Integer, nullable=False, default=0)
+    programadasEnPlazo = db.Column(db.Integer, nullable=False, default=0)  # cerradas en o antes de fechaProgramada
+    completas = db.Column(db.Integer, nullable=False, default=0)      # con fechas, tiempo, solución y registros
+
+    __table_args__ = (
+        db.Index('ix_hecho_mes', 'mes'),
+        db.Index('ix_hecho_equipo_mes', 'equipoTipo', 'equipoId', 'mes'),
+        db.Index('ix_hecho_planta_mes', 'plantaId', 'mes'),
+        db.Index('ix_hecho_zona_mes', 'zonaId', 'mes'),
+        db.Index('ix_hecho_linea_mes', 'lineaId', 'mes'),
+        db.Index('ix_hecho_maquina_mes', 'maquinaRefId', 'mes'),
+    )
+
+
+# Resultado cacheado de un servicio de KPIs para unos parámetros (ver
+# cache_kpis.py). Se comparte entre workers y se invalida al escribir OTs,
+# registros de tiempo, consumos o configuración dentro de [fechaIni, fechaFin].
+class ResultadoKpi(db.Model):
+    clave = db.Column(db.String(64), primary_key=True)      # sha256 de servicio y parámetros
+    servicio = db.Column(db.String(60), nullable=False, index=True)
+    fechaIni = db.Column(db.Date, nullable=False)
+    fechaFin = db.Column(db.Date, nullable=False)
+    resultado = db.Column(db.Text, nullable=False)           # JSON
+    tamano = db.Column(db.Integer, nullable=False)           # bytes de resultado
+    ultimoAcceso = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+
+    __table_args__ = (
+        db.Index('ix_resultado_kpi_rango', 'fechaIni', 'fechaFin'),
+    )
 
 
 # Maestro de Técnicos
@@ -560,6 +833,49 @@ class ConfiguracionGeneral(db.Model):
         return reg
 
 
+class Festivo(db.Model):
+    """Día no laborable del calendario: común (plantaId None) o de una planta."""
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.Date, nullable=False, index=True)
+    plantaId = db.Column(db.Integer, db.ForeignKey('planta.id'), index=True)
+    descripcion = db.Column(db.String(200))
+
+
+class VersionRecurso(db.Model):
+    """Contador de versión por recurso (jerarquía, catálogos...) para invalidar cachés."""
+    clave = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def obtener(clave):
+        """Devuelve la versión actual de un recurso (0 si nunca se ha modificado)."""
+        tabla = VersionRecurso.__table__
+        version = db.session.execute(
+            db.select(tabla.c.version).where(tabla.c.clave == clave)
+        ).scalar()
+        return version or 0
+
+    @staticmethod
+    def incrementar(conexion, clave):
+        """
+        Incrementa la versión de un recurso usando la conexión de la transacción
+        en curso (utilizable desde eventos de flush de la sesión).
+        """
+        tabla = VersionRecurso.__table__
+        r = conexion.execute(
+            tabla.update().where(tabla.c.clave == clave).values(version=tabla.c.version + 1)
+        )
+        if r.rowcount == 0:
+            conexion.execute(tabla.insert().values(clave=clave, version=1))
+
+
+class MigracionEsquema(db.Model):
+    """Migración de esquema ya aplicada a la base de datos (ver migraciones.py)."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    nombre = db.Column(db.String(100), nullable=False)
+    fechaAplicacion = db.Column(db.DateTime, default=datetime.now)
+
+
 # =============================================================================
 # USUARIOS Y CONTROL DE ACCESO
 # =============================================================================
@@ -0,0 +1,16 @@
+# Aplica sobre la base de datos existente las migraciones de esquema pendientes
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app
+from migraciones import aplicarMigraciones, versionEsquema
+
+if __name__ == '__main__':
+    with app.app_context():
+        aplicadas = aplicarMigraciones()
+        for version, nombre in aplicadas:
+            print(f"  · {version:03d} {nombre}")
+        print(f"✓ Esquema en la versión {versionEsquema()} ({len(aplicadas)} migraciones aplicadas)")
@@ -0,0 +1,17 @@
+# Recalcula planta/zona/línea/máquina desnormalizadas de todas las órdenes de trabajo
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app
+from migraciones import aplicarMigraciones
+from jerarquia import asegurarRutas, reconstruirAncestrosOrdenes
+
+if __name__ == '__main__':
+    with app.app_context():
+        aplicarMigraciones()
+        asegurarRutas()
+        total = reconstruirAncestrosOrdenes()
+        print(f"✓ Ancestros recalculados en {total} órdenes de trabajo")
@@ -0,0 +1,19 @@
+# Rehace el resumen de horas y costes de todas las órdenes de trabajo (tabla coste_orden)
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from migraciones import aplicarMigraciones
+from costes import reconstruirCostes
+from cache_kpis import vaciarResultados
+
+if __name__ == '__main__':
+    with app.app_context():
+        aplicarMigraciones()
+        with db.engine.begin() as conexion:
+            total = reconstruirCostes(conexion)
+            vaciarResultados(conexion)
+        print(f"✓ Costes recalculados en {total} órdenes de trabajo")
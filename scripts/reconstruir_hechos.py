@@ -0,0 +1,19 @@
+# Rehace el agregado mensual de las órdenes de trabajo (tabla hecho_mensual_orden)
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from migraciones import aplicarMigraciones
+from hechos import reconstruirHechos
+from cache_kpis import vaciarResultados
+
+if __name__ == '__main__':
+    with app.app_context():
+        aplicarMigraciones()
+        with db.engine.begin() as conexion:
+            total = reconstruirHechos(conexion)
+            vaciarResultados(conexion)
+        print(f"✓ Agregado mensual reconstruido: {total} filas")
@@ -0,0 +1,15 @@
+# Reconstruye por completo el índice materializado de rutas de activos (RutaActivo)
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from jerarquia import reconstruirRutas
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.create_all()
+        total = reconstruirRutas()
+        print(f"✓ Índice de rutas reconstruido: {total} nodos")
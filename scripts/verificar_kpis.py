@@ -0,0 +1,78 @@
+# Comprueba los agregados de calcular_indicadores contra una consulta directa.
+#
+# _agregar_ordenes lee los meses completos del rango del agregado mensual
+# (hecho_mensual_orden) y agrupa sobre orden_trabajo solo los días sueltos de
+# los extremos. Este script repite cada agregado con una sola consulta GROUP BY
+# sobre orden_trabajo + coste_orden para todo el rango y compara los campos por
+# tipo, para rangos de meses completos, rangos con extremos sueltos y rangos de
+# pocos días, en el alcance global y en cada planta y línea.
+#
+# Uso: python scripts/verificar_kpis.py [fecha_ini fecha_fin]   (AAAA-MM-DD)
+import sys
+import os
+from datetime import date, timedelta
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app
+from migraciones import aplicarMigraciones
+from models import OrdenTrabajo, Linea, Planta
+from jerarquia import filtroOrdenesSubarbol
+from hechos import entreFechas
+from blueprints.indicadores.services import _agregar_ordenes, _sumas_ordenes, _CAMPOS_AGREGADOS
+
+TOLERANCIA = 0.005
+
+
+def _directo(fechaIni, fechaFin, nivel=None, nivelId=None):
+    alcance = [filtroOrdenesSubarbol(nivel, nivelId)] if nivel else []
+    return _sumas_ordenes(entreFechas(OrdenTrabajo.fechaProgramada, fechaIni, fechaFin),
+                          entreFechas(OrdenTrabajo.fechaCreacion, fechaIni, fechaFin), *alcance)
+
+
+def _rangos(fechaIni, fechaFin):
+    """Rango pedido, meses completos, extremos sueltos y unos días sueltos"""
+    inicioMes = fechaIni.replace(day=1)
+    finMes = fechaFin.replace(day=1) - timedelta(days=1)
+    return [
+        (fechaIni, fechaFin),
+        (inicioMes, finMes),
+        (inicioMes + timedelta(days=9), finMes - timedelta(days=12)),
+        (fechaFin - timedelta(days=20), fechaFin - timedelta(days=3)),
+    ]
+
+
+def verificar(fechaIni, fechaFin):
+    alcances = [('global', None, None)]
+    alcances += [(f'planta {p.id}', 'planta', p.id) for p in Planta.query]
+    alcances += [(f'línea {l.id}', 'linea', l.id) for l in Linea.query]
+    errores = comparaciones = 0
+    for nombre, nivel, nivelId in alcances:
+        for desde, hasta in _rangos(fechaIni, fechaFin):
+            obtenido = _agregar_ordenes(desde, hasta, nivel, nivelId)
+            esperado = _directo(desde, hasta, nivel, nivelId)
+            comparaciones += 1
+            for tipo in set(obtenido) | set(esperado):
+                o = obtenido.get(tipo, {})
+                e = esperado.get(tipo, {})
+                for campo in _CAMPOS_AGREGADOS:
+                    if abs(o.get(campo, 0) - e.get(campo, 0)) > TOLERANCIA:
+                        print(f'✗ {nombre} {desde}..{hasta} {tipo} {campo}: '
+                              f'{o.get(campo, 0)} (directo {e.get(campo, 0)})')
+                        errores += 1
+
+    if errores:
+        print(f'✗ {errores} diferencias')
+    else:
+        print(f'✓ Agregados de KPIs coinciden en {comparaciones} combinaciones de alcance y rango')
+    return errores == 0
+
+
+if __name__ == '__main__':
+    fechaIni = date.fromisoformat(sys.argv[1]) if len(sys.argv) > 2 else date(date.today().year - 2, 1, 15)
+    fechaFin = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else date.today()
+    with app.app_context():
+        aplicarMigraciones()
+        ok = verificar(fechaIni, fechaFin)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,115 @@
+# Comprueba calcular_paros (agrupado con pandas) contra un recorrido OT a OT.
+#
+# calcular_paros carga los paros en un DataFrame y acumula por periodo, línea,
+# máquina y (línea, máquina) con groupby. Este script vuelve a contar cada OT de
+# paro en su periodo con un bucle, como se hacía antes, y compara nº de paros y
+# horas de paro del global, de cada grupo y del top 10 para el alcance global,
+# cada planta y cada línea, en agrupación mensual y anual.
+#
+# Uso: python scripts/verificar_paros.py [fecha_ini fecha_fin]   (AAAA-MM-DD)
+import sys
+import os
+from datetime import date
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app
+from migraciones import aplicarMigraciones
+from models import OrdenTrabajo, Linea, Planta
+from blueprints.kpis.paros_services import calcular_paros, _periodos_mensuales, _periodos_anuales
+
+
+def _fechaReferencia(ot):
+    d = ot.fechaFin or ot.fechaCreacion
+    return d.date() if hasattr(d, 'date') else d
+
+
+def _recorrer(fechaIni, fechaFin, agrupacion, plantaId=None, lineaId=None):
+    """(global, por línea, por máquina, top) contando OT a OT: {clave: [n, horas]}"""
+    periodos = (_periodos_anuales if agrupacion == 'anual' else _periodos_mensuales)(fechaIni, fechaFin)
+    q = OrdenTrabajo.query.filter(OrdenTrabajo.tipo == 'correctivo', OrdenTrabajo.tiempoParada > 0)
+    if plantaId:
+        q = q.filter(OrdenTrabajo.plantaId == plantaId, OrdenTrabajo.lineaId.isnot(None))
+    if lineaId:
+        q = q.filter(OrdenTrabajo.lineaId == lineaId)
+
+    total, porLinea, porMaquina, top = {}, {}, {}, {}
+
+    def _sumar(d, k, h):
+        acc = d.setdefault(k, [0, 0.0])
+        acc[0] += 1
+        acc[1] += h
+
+    for ot in q.order_by(OrdenTrabajo.id):
+        ref = _fechaReferencia(ot)
+        clave = next((k for k, _, ini, fin in periodos if ini <= ref <= fin), None)
+        if clave is None:
+            continue
+        h = float(ot.tiempoParada)
+        _sumar(total, clave, h)
+        if ot.lineaId:
+            _sumar(porLinea, (clave, ot.lineaId), h)
+        if ot.maquinaRefId:
+            _sumar(porMaquina, (clave, ot.maquinaRefId), h)
+        _sumar(top, (ot.lineaId, ot.maquinaRefId), h)
+    return total, porLinea, porMaquina, top
+
+
+def _comparar(nombre, esperado, obtenido):
+    n, h = esperado or (0, 0.0)
+    if obtenido['n_paros'] != n or abs(obtenido['h_paros'] - round(h, 2)) > 0.005:
+        print(f'✗ {nombre}: {obtenido["n_paros"]} paros / {obtenido["h_paros"]} h '
+              f'(recorrido {n} / {round(h, 2)} h)')
+        return 1
+    return 0
+
+
+def verificar(fechaIni, fechaFin):
+    alcances = [('global', {}, {})]
+    alcances += [(f'planta {p.id}', {'plantas_ids': [p.id]}, {'plantaId': p.id}) for p in Planta.query]
+    alcances += [(f'línea {l.id}', {'lineas_ids': [l.id]}, {'lineaId': l.id}) for l in Linea.query]
+    errores = 0
+    for nombre, filtros, filtroRecorrido in alcances:
+        for agrupacion in ('mensual', 'anual'):
+            datos = calcular_paros(fechaIni, fechaFin, agrupacion, **filtros)
+            total, porLinea, porMaquina, top = _recorrer(fechaIni, fechaFin, agrupacion, **filtroRecorrido)
+            etiqueta = f'{nombre} {agrupacion}'
+
+            for p in datos['global']:
+                errores += _comparar(f'{etiqueta} {p["key"]}', total.get(p['key']), p)
+
+            grupos = porMaquina if datos['por_grupo']['agrupado_por'] == 'maquina' else porLinea
+            vistos = set()
+            for g in datos['por_grupo']['grupos']:
+                for p in g['periodos']:
+                    vistos.add((p['key'], g['id']))
+                    errores += _comparar(f'{etiqueta} grupo {g["id"]} {p["key"]}', grupos.get((p['key'], g['id'])), p)
+            for clave in set(grupos) - vistos:
+                errores += _comparar(f'{etiqueta} grupo {clave[1]} {clave[0]} (falta)', grupos[clave],
+                                     {'n_paros': 0, 'h_paros': 0.0})
+
+            # El top 10 desempata por la primera OT de cada equipo (orden estable)
+            esperado = sorted(top.items(), key=lambda x: x[1][0], reverse=True)[:10]
+            obtenido = [((t['linea_id'], t['maquina_id']), t) for t in datos['top10']]
+            if [k for k, _ in esperado] != [k for k, _ in obtenido]:
+                print(f'✗ {etiqueta}: top 10 distinto')
+                errores += 1
+            else:
+                for (clave, acc), (_, t) in zip(esperado, obtenido):
+                    errores += _comparar(f'{etiqueta} top {clave}', acc, t)
+
+    if errores:
+        print(f'✗ {errores} diferencias')
+    else:
+        print(f'✓ Paros coinciden en {len(alcances) * 2} combinaciones de alcance y agrupación')
+    return errores == 0
+
+
+if __name__ == '__main__':
+    fechaIni = date.fromisoformat(sys.argv[1]) if len(sys.argv) > 2 else date(date.today().year - 2, 1, 1)
+    fechaFin = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else date.today()
+    with app.app_context():
+        aplicarMigraciones()
+        ok = verificar(fechaIni, fechaFin)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,128 @@
+# Comprueba con EXPLAIN QUERY PLAN que las consultas frecuentes usan índices.
+#
+# Recorre los endpoints de los listados de órdenes, dashboard, paros y móvil,
+# captura las SELECT que ejecutan y falla (código de salida 1) si alguna recorre
+# entera una tabla grande ("SCAN tabla" sin índice). Los recorridos en orden de
+# un índice (paginación con LIMIT, conteos cubiertos) se aceptan.
+#
+# Uso: DATABASE_URL=sqlite:////ruta/copia.db python scripts/verificar_planes.py
+# (aplica las migraciones pendientes a la base indicada)
+import sys
+import os
+import re
+from datetime import date
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import event
+
+from app import app, db
+from models import OrdenTrabajo, Planta, Linea, Maquina, Recambio
+
+# Tablas que crecen con el uso; las maestras (tipos, técnicos...) pueden recorrerse
+TABLAS_VIGILADAS = {'orden_trabajo', 'registro_tiempo', 'movimiento_stock',
+                    'consumo_recambio', 'ruta_activo', 'coste_externo'}
+
+_SCAN = re.compile(r'^SCAN (\w+)(.*)$')
+
+
+def _consultas():
+    """(descripción, url) de los endpoints a analizar, con ids reales de la base"""
+    ot = db.session.query(db.func.min(OrdenTrabajo.id)).scalar() or 1
+    planta = db.session.query(db.func.min(Planta.id)).scalar() or 1
+    linea = db.session.query(db.func.min(Linea.id)).scalar() or 1
+    maquina = db.session.query(db.func.min(Maquina.id)).scalar() or 1
+    recambio = db.session.query(db.func.min(Recambio.id)).scalar() or 1
+    dash = '/informes/api/dashboard'
+    hoy = date.today().isoformat()
+    mes = hoy[:7]
+    return [
+        ('Órdenes: página por prioridad', '/api/ordenes?limite=50'),
+        ('Órdenes: página reciente', '/api/ordenes?limite=50&orden=reciente&incluirCerradas=true'),
+        ('Órdenes: subárbol de planta', f'/api/ordenes?limite=50&nivel=planta&nivelId={planta}'),
+        ('Órdenes: por equipo', f'/api/ordenes?limite=50&equipoTipo=maquina&equipoId={maquina}'),
+        ('Órdenes: conteo', '/api/ordenes/conteo'),
+        ('Órdenes: búsqueda de texto', '/api/ordenes/buscar?q=revision'),
+        ('Calendario: mes agregado', f'/api/ordenes-calendario?start={mes}-01&end={mes}-28&agrupar=dia'),
+        ('Calendario: detalle de un día', f'/api/ordenes-calendario?start={hoy}&end={hoy}'),
+        ('Dashboard: tipos mensuales', f'{dash}/tipos-mensuales'),
+        ('Dashboard: tipos mensuales (línea)', f'{dash}/tipos-mensuales?nivel=linea&nivel_id={linea}'),
+        ('Dashboard: prioridades', f'{dash}/prioridades'),
+        ('Dashboard: top equipos', f'{dash}/top-equipos'),
+        ('Dashboard: pareto averías', f'{dash}/pareto-averias'),
+        ('Dashboard: tiempos técnicos', f'{dash}/tiempos-tecnicos'),
+        ('Dashboard: tiempos línea', f'{dash}/tiempos-linea'),
+        ('Dashboard: heatmap', f'{dash}/heatmap-equipos'),
+        ('Dashboard: KPIs evolución', f'{dash}/kpis-evolucion?nivel=planta&nivel_id={planta}'),
+        ('Dashboard: gasto por proveedor', f'{dash}/gasto-proveedores'),
+        ('Paros', '/kpis/paros/datos'),
+        ('Paros (línea)', f'/kpis/paros/datos?linea={linea}'),
+        ('Móvil: inicio', '/movil/'),
+        ('Móvil: preventivo', '/movil/preventivo'),
+        ('Móvil: detalle OT', f'/movil/ot/{ot}'),
+        ('Móvil: QR de planta', f'/movil/qr/planta/{planta}'),
+        ('Recambio: movimientos', f'/api/recambio/{recambio}/movimientos'),
+    ]
+
+
+def _recorridosCompletos(cursor, sentencia, parametros):
+    """Tablas vigiladas que el plan recorre enteras sin índice"""
+    plan = cursor.execute('EXPLAIN QUERY PLAN ' + sentencia, parametros).fetchall()
+    tablas = []
+    for *_, detalle in plan:
+        m = _SCAN.match(detalle)
+        if m and m.group(1) in TABLAS_VIGILADAS and 'USING' not in m.group(2):
+            tablas.append(m.group(1))
+    return tablas
+
+
+def verificar():
+    cliente = app.test_client()
+    r = cliente.post('/api/auth/login', json={'username': 'admin', 'password': 'admin123'})
+    if r.status_code != 200:
+        print('✗ No se pudo iniciar sesión como admin')
+        return False
+
+    capturadas = []
+
+    def capturar(conn, cursor, sentencia, parametros, contexto, executemany):
+        if sentencia.lstrip().upper().startswith('SELECT'):
+            capturadas.append((sentencia, parametros))
+
+    with app.app_context():
+        consultas = _consultas()
+        event.listen(db.engine, 'before_cursor_execute', capturar)
+
+    correcto = True
+    for descripcion, url in consultas:
+        capturadas.clear()
+        r = cliente.get(url)
+        if r.status_code != 200:
+            print(f'✗ {descripcion}: HTTP {r.status_code} en {url}')
+            correcto = False
+            continue
+
+        fallos = []
+        with app.app_context():
+            conexion = db.engine.raw_connection()
+            try:
+                cursor = conexion.cursor()
+                for sentencia, parametros in dict(capturadas).items():
+                    for tabla in _recorridosCompletos(cursor, sentencia, parametros):
+                        fallos.append((tabla, sentencia))
+            finally:
+                conexion.close()
+
+        if fallos:
+            correcto = False
+            print(f'✗ {descripcion} ({url})')
+            for tabla, sentencia in fallos:
+                print(f'    SCAN {tabla}: {" ".join(sentencia.split())[:200]}')
+        else:
+            print(f'✓ {descripcion}')
+    return correcto
+
+
+if __name__ == '__main__':
+    sys.exit(0 if verificar() else 1)
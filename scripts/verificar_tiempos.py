@@ -0,0 +1,85 @@
+# Comprueba tiempoReal y sesionesAbiertas de las OTs recalculándolos desde cero.
+#
+# Pausar y cerrar una OT acumulan la duración de cada registro de tiempo en
+# tiempoReal y llevan la cuenta de registros en curso (OrdenTrabajo.cerrarSesion).
+# Este script recorre todos los registros en lotes, recalcula ambos valores y
+# lista las OTs que no cuadran; con --corregir los sobrescribe. Las OTs sin
+# registros cerrados (p. ej. importadas con tiempoReal propio) no se tocan.
+#
+# Uso: python scripts/verificar_tiempos.py [--corregir]
+import sys
+import os
+
+# Add the parent directory to the path so we can import the app
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db
+from migraciones import aplicarMigraciones
+from models import OrdenTrabajo, RegistroTiempo
+
+LOTE = 1000
+# Redondeo a 2 decimales en cada sesión acumulada
+TOLERANCIA_HORAS = 0.01
+
+
+def _recalcular():
+    """{ordenId: (horas, abiertas)} a partir de todos los registros de tiempo"""
+    totales = {}
+    ultimo = 0
+    while True:
+        filas = db.session.query(
+            RegistroTiempo.id, RegistroTiempo.ordenId, RegistroTiempo.inicio,
+            RegistroTiempo.fin, RegistroTiempo.enCurso
+        ).filter(RegistroTiempo.id > ultimo).order_by(RegistroTiempo.id).limit(LOTE).all()
+        if not filas:
+            return totales
+        for id, ordenId, inicio, fin, enCurso in filas:
+            horas, abiertas, cerradas = totales.get(ordenId, (0.0, 0, 0))
+            if enCurso:
+                abiertas += 1
+            if fin:
+                horas += max((fin - inicio).total_seconds() / 3600, 0)
+                cerradas += 1
+            totales[ordenId] = (horas, abiertas, cerradas)
+        ultimo = filas[-1][0]
+
+
+def verificar(corregir=False):
+    totales = _recalcular()
+    descuadres = 0
+    ultimo = 0
+    while True:
+        ordenes = OrdenTrabajo.query.filter(OrdenTrabajo.id > ultimo).order_by(
+            OrdenTrabajo.id).limit(LOTE).all()
+        if not ordenes:
+            break
+        for orden in ordenes:
+            horas, abiertas, cerradas = totales.get(orden.id, (0.0, 0, 0))
+            tiempoReal = round(horas, 2) if cerradas else orden.tiempoReal
+            # Acumular sesión a sesión redondeando puede desviarse un poco
+            margen = TOLERANCIA_HORAS * max(cerradas, 1)
+            mal = (orden.sesionesAbiertas or 0) != abiertas or (
+                cerradas and abs((orden.tiempoReal or 0) - tiempoReal) > margen)
+            if not mal:
+                continue
+            descuadres += 1
+            print(f'✗ OT {orden.numero}: tiempoReal {orden.tiempoReal} (calculado {tiempoReal}), '
+                  f'sesiones abiertas {orden.sesionesAbiertas} (calculado {abiertas})')
+            if corregir:
+                orden.tiempoReal = tiempoReal
+                orden.sesionesAbiertas = abiertas
+        if corregir:
+            db.session.commit()
+        ultimo = ordenes[-1].id
+
+    if descuadres:
+        print(f"{'✓ Corregidas' if corregir else '✗ Descuadradas'} {descuadres} órdenes de trabajo")
+    else:
+        print('✓ Tiempos de todas las órdenes de trabajo correctos')
+    return descuadres == 0 or corregir
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        aplicarMigraciones()
+        sys.exit(0 if verificar('--corregir' in sys.argv[1:]) else 1)
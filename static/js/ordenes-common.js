@@ -81,6 +81,37 @@ function setRefreshCallback(callback) {
     window.refreshOrdenesCallback = callback;
 }
 
+/**
+ * Se suscribe al flujo de cambios de OTs (/api/ordenes/eventos).
+ * onEvento recibe {id, ordenId, evento, ...campos}; evento es creada, estado,
+ * asignada, trabajo_iniciado, trabajo_pausado o eliminada. EventSource se
+ * reconecta solo y reenvía Last-Event-ID, así que no se pierden cambios. Si el
+ * servidor rechaza la conexión (503, demasiados flujos abiertos) EventSource
+ * se cierra: se vuelve a abrir pasados unos segundos desde el último id.
+ * Devuelve false si el navegador no soporta EventSource.
+ */
+function suscribirEventosOrdenes(onEvento) {
+    if (!window.EventSource) return false;
+    let fuente = null;
+    let ultimoId = null;
+
+    function abrir() {
+        fuente = new EventSource('/api/ordenes/eventos' + (ultimoId !== null ? '?desde=' + ultimoId : ''));
+        fuente.addEventListener('inicio', (e) => { ultimoId = e.lastEventId; });
+        fuente.addEventListener('orden', (e) => {
+            ultimoId = e.lastEventId;
+            try { onEvento(JSON.parse(e.data)); } catch (err) { console.error('Evento de OT no válido', err); }
+        });
+        fuente.addEventListener('error', () => {
+            if (fuente.readyState === EventSource.CLOSED) setTimeout(abrir, 5000 + Math.random() * 5000);
+        });
+    }
+
+    abrir();
+    window.addEventListener('beforeunload', () => fuente.close());
+    return true;
+}
+
 // Helper para obtener info del tipo desde la cache global o por defecto
 function getTipoInfo(codigo) {
     const cache = window.tiposCache || [];
@@ -1139,21 +1170,16 @@ async function confirmarConsumo(ordenId) {
 
 // ─── Helper: renderiza la tabla de costes externos ─────────────────────────
 function renderCostesExternos(o) {
-    let costes = [];
-    if (o.costesExternosJson) {
-        try { costes = JSON.parse(o.costesExternosJson); } catch (e) { }
-    } else if (o.costeTallerExterno) {
-        costes = [{ proveedor: o.proveedorExterno || '', descripcion: o.descripcionTallerExterno || '', coste: o.costeTallerExterno }];
-    }
+    const costes = o.costesExternos || [];
     if (costes.length === 0) {
         return '<p class="emptyState small">Sin costes externos registrados</p>';
     }
     const total = costes.reduce(function (s, c) { return s + (c.coste || 0); }, 0);
     const canDel = o.estado !== 'cerrada' && o.estado !== 'cancelada';
     let rows = '';
-    costes.forEach(function (c, idx) {
+    costes.forEach(function (c) {
         const delBtn = canDel
-            ? '<td><button class="btn btnSm btnDanger" onclick="eliminarCosteExternoItem(' + o.id + ',' + idx + ')" title="Eliminar"><i class="fas fa-trash"></i></button></td>'
+            ? '<td><button class="btn btnSm btnDanger" onclick="eliminarCosteExternoItem(' + o.id + ',' + c.id + ')" title="Eliminar"><i class="fas fa-trash"></i></button></td>'
             : '';
         rows += '<tr><td>' + (c.proveedor || '-') + '</td><td>' + (c.descripcion || '-') + '</td><td><strong>' + formatoEspanol(c.coste, 2) + ' \u20ac</strong></td>' + delBtn + '</tr>';
     });
@@ -1208,10 +1234,10 @@ async function confirmarCosteExterno(ordenId) {
     }
 }
 
-async function eliminarCosteExternoItem(ordenId, idx) {
+async function eliminarCosteExternoItem(ordenId, costeId) {
     if (!confirm('¿Eliminar este coste externo?')) return;
     try {
-        await apiCall(`/api/orden/${ordenId}/coste-externo/${idx}`, 'DELETE');
+        await apiCall(`/api/orden/${ordenId}/coste-externo/${costeId}`, 'DELETE');
         showToast('Coste eliminado', 'success');
         verOrden(ordenId);
     } catch (error) {
@@ -0,0 +1,96 @@
+"""
+Versiones de recurso y GET condicional para los datos maestros.
+
+Cada recurso cacheable (jerarquía, técnicos, tipos de intervención, gamas) tiene
+un contador en VersionRecurso que se incrementa en la misma transacción que
+modifica sus tablas. Los endpoints decorados con @condicional exponen esas
+versiones como ETag y responden 304 a un If-None-Match coincidente sin ejecutar
+la consulta.
+
+La versión 'jerarquia' la mantiene jerarquia.py; aquí se registran el resto.
+"""
+from functools import wraps
+
+from flask import request, make_response
+from sqlalchemy import event
+
+from models import (db, VersionRecurso, Tecnico, TipoIntervencion,
+                    GamaMantenimiento, TareaGama, RecambioGama, AsignacionGama,
+                    ChecklistItem)
+from jerarquia import VERSION_JERARQUIA
+
+
+VERSION_TECNICOS = 'tecnicos'
+VERSION_TIPOS_INTERVENCION = 'tipos_intervencion'
+VERSION_GAMAS = 'gamas'
+
+# Modelo -> recurso cuya versión invalida un cambio en sus filas
+_RECURSO_POR_MODELO = {
+    Tecnico: VERSION_TECNICOS,
+    TipoIntervencion: VERSION_TIPOS_INTERVENCION,
+    GamaMantenimiento: VERSION_GAMAS,
+    TareaGama: VERSION_GAMAS,
+    RecambioGama: VERSION_GAMAS,
+    AsignacionGama: VERSION_GAMAS,
+    ChecklistItem: VERSION_GAMAS,
+}
+
+
+# =============================================================================
+# INCREMENTO DE VERSIONES EN LA SESIÓN
+# =============================================================================
+
+@event.listens_for(db.session, 'before_flush')
+def _detectarCambiosRecursos(session, contexto, instancias):
+    pendientes = session.info.setdefault('recursosModificados', set())
+    for obj in list(session.new) + list(session.deleted):
+        clave = _RECURSO_POR_MODELO.get(type(obj))
+        if clave:
+            pendientes.add(clave)
+    for obj in session.dirty:
+        clave = _RECURSO_POR_MODELO.get(type(obj))
+        if clave and session.is_modified(obj):
+            pendientes.add(clave)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _incrementarVersionesTrasFlush(session, contexto):
+    pendientes = session.info.pop('recursosModificados', None)
+    if not pendientes:
+        return
+    conexion = session.connection()
+    for clave in sorted(pendientes):
+        VersionRecurso.incrementar(conexion, clave)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartarCambiosRecursos(session):
+    session.info.pop('recursosModificados', None)
+
+
+# =============================================================================
+# GET CONDICIONAL
+# =============================================================================
+
+def condicional(*claves):
+    """Decorador de endpoints GET: ETag según las versiones de los recursos.
+
+    Si el cliente envía un If-None-Match con la versión vigente se responde 304
+    sin llamar a la vista. La respuesta se marca 'no-cache' (revalidar siempre)
+    en lugar del 'no-store' global, para que el navegador conserve la copia.
+    """
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            etag = '-'.join(f'{c}.{VersionRecurso.obtener(c)}' for c in claves)
+            if request.if_none_match.contains_weak(etag):
+                respuesta = make_response('', 304)
+            else:
+                respuesta = make_response(vista(*args, **kwargs))
+                if respuesta.status_code != 200:
+                    return respuesta
+            respuesta.set_etag(etag, weak=True)
+            respuesta.headers['Cache-Control'] = 'private, no-cache'
+            return respuesta
+        return envoltura
+    return decorador